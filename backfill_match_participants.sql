@@ -0,0 +1,8 @@
+INSERT INTO
+    match_participants
+SELECT
+    participants.*
+FROM
+    matches,
+    get_match_participants(match_id, ended_at, region, dump) AS participants
+ON CONFLICT (match_id, participant_id) DO NOTHING
@@ -13,17 +13,27 @@ This crawler assumes that the ultimate bottleneck is the API rate limits
 
 import logging
 import os
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from itertools import count
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 
+import requests
 import structlog
 import typer
 from dotenv import load_dotenv
 
-from src.client import Division, LeagueClient, Queue, QueueId, Region, RegionGroup, Tier
-from src.database import DatabaseHandler
-from src.util import now
+from src.client import Division, LeagueClient, Queue, Region, Tier
+from src.crawl import LEAGUE_PAGE_LOOKAHEAD, CrawlState
+from src.database import DatabaseHandler, LeagueSnapshotMode, StorageProfile
+from src.estimator import MatchCountEstimatorKind, create_match_count_estimator
+from src.match_index import MatchIdIndex
+from src.player import MATCH_TIME_WINDOW, Player
+from src.registry import PlayerRegistry
+from src.retry import CircuitOpenError, is_retryable_status_code
+from src.scheduler import PlayerScheduler, ScheduleReason
+from src.util import convert_epoch_to_datetime, now
+from src.writer import DatabaseWriter
 
 load_dotenv(override=True)
 API_KEY = os.environ["API_KEY"]
@@ -32,9 +42,12 @@ POSTGRES_PASSWORD = os.environ["POSTGRES_PASSWORD"]
 POSTGRES_HOST = os.environ["POSTGRES_HOST"]
 POSTGRES_PORT = os.environ["POSTGRES_PORT"]
 POSTGRES_DATABASE = os.environ["POSTGRES_DATABASE"]
-LEAGUE_CRAWL_INTERVAL = timedelta(days=1)
-MATCH_TIME_WINDOW = timedelta(days=7)
-MATCH_COUNT_MAXIMUM = 100
+LEAGUE_CRAWL_RETRY_INTERVAL = timedelta(minutes=1)
+THROUGHPUT_REPORT_INTERVAL = timedelta(minutes=1)
+SCHEDULER_MAXIMUM_WAIT = timedelta(seconds=1)
+SPOOL_REPLAY_TIMEOUT = timedelta(minutes=1)
+MATCH_ID_RETRY_INTERVAL = timedelta(seconds=10)
+LEAGUE_PAGE_CONCURRENCY = 6
 
 
 structlog.configure(
@@ -56,253 +69,664 @@ structlog.configure(
 logger = structlog.get_logger()
 
 
-@dataclass
-class Player:
-    puuid: str
-    tier: Tier
-    division: Division
-    last_league_crawl_time: datetime
-    last_match_crawl_time: datetime | None = None
-    last_match_count: int | None = None
-
-    def __str__(self):
-        puuid = self.puuid
-        tier = self.tier.value
-        division = self.division.value
-        last_league_crawl_time = self.last_league_crawl_time.isoformat().replace("+00:00", "Z")
-        last_match_crawl_time = (
-            self.last_match_crawl_time.isoformat().replace("+00:00", "Z")
-            if self.last_match_crawl_time
-            else None
-        )
-        last_match_count = self.last_match_count if self.last_match_count else None
-        return f"Player(puuid={puuid}, tier={tier}, division={division}, last_league_crawl_time={last_league_crawl_time}, last_match_crawl_time={last_match_crawl_time}, last_match_count={last_match_count})"
-
-    def __repr__(self):
-        return str(self)
-
-    def from_league_entry(league_entry: dict):
-        player = Player(
-            puuid=league_entry["puuid"],
-            tier=Tier[league_entry["tier"]],
-            division=Division[league_entry["rank"]],
-            last_league_crawl_time=now(),
+class LeagueCrawl:
+    # Fetches the league pages of a region in the background while the region keeps crawling
+    # matches. Each finished page submits the next ones, and the region step collects the entries
+    # gathered so far, since it alone touches the region state
+
+    def __init__(
+        self,
+        league_client: LeagueClient,
+        executor: ThreadPoolExecutor,
+        region: Region,
+        crawl_tiers: list[Tier],
+    ):
+        self._league_client = league_client
+        self._executor = executor
+        self._region = region
+        self._divisions = [
+            (tier, division)
+            for tier in crawl_tiers
+            for division in Division
+            if not tier.is_apex_tier() or division == Division.I
+        ]
+        self._next_pages = [1] * len(self._divisions)
+        self._last_full_pages = [0] * len(self._divisions)
+        self._empty_pages: list[int | None] = [None] * len(self._divisions)
+        self._division_index_and_page_by_future: dict[Future, tuple[int, int]] = {}
+        self._league_entries: list[dict] = []
+        self._error: BaseException | None = None
+        self._is_cancelled = False
+        self._condition = threading.Condition()
+        with self._condition:
+            futures = self._submit_pages()
+        self._watch(futures)
+
+    def collect(self) -> tuple[list[dict], bool]:
+        # Returns the entries of the pages fetched since the last call and whether every page has
+        # been fetched. Raises the first error of a page, after which no more pages are fetched
+        with self._condition:
+            if self._error is not None:
+                raise self._error
+            league_entries, self._league_entries = self._league_entries, []
+            is_done = len(self._division_index_and_page_by_future) == 0 and all(
+                empty_page is not None for empty_page in self._empty_pages
+            )
+            return league_entries, is_done
+
+    def wait_for_entries(self, timeout: float):
+        with self._condition:
+            if len(self._league_entries) == 0 and len(self._division_index_and_page_by_future) > 0:
+                self._condition.wait(timeout)
+
+    def cancel(self):
+        with self._condition:
+            self._is_cancelled = True
+            for future in list(self._division_index_and_page_by_future):
+                future.cancel()
+
+    def _submit_pages(self) -> list[Future]:
+        # Divisions are fetched in order, moving on to the next one once a division has as many
+        # pages in flight as it may. Called with the condition held
+        futures = []
+        if self._error is not None or self._is_cancelled:
+            return futures
+        for division_index, (tier, division) in enumerate(self._divisions):
+            if self._empty_pages[division_index] is not None:
+                continue
+            while (
+                len(self._division_index_and_page_by_future) < LEAGUE_PAGE_CONCURRENCY
+                and self._next_pages[division_index]
+                <= self._last_full_pages[division_index] + LEAGUE_PAGE_LOOKAHEAD
+            ):
+                page = self._next_pages[division_index]
+                future = self._executor.submit(
+                    self._league_client.get_league,
+                    self._region,
+                    Queue.RANKED_SOLO_5x5,
+                    tier,
+                    division,
+                    page,
+                )
+                self._division_index_and_page_by_future[future] = (division_index, page)
+                self._next_pages[division_index] += 1
+                futures.append(future)
+        return futures
+
+    def _watch(self, futures: list[Future]):
+        # Callbacks are added without the condition held, since those of finished futures run
+        # right away
+        for future in futures:
+            future.add_done_callback(self._on_page_done)
+
+    def _on_page_done(self, future: Future):
+        with self._condition:
+            division_index, page = self._division_index_and_page_by_future.pop(future)
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                self._error = self._error or error
+                self._condition.notify_all()
+                return
+            league_page = future.result()
+            tier, division = self._divisions[division_index]
+            logger.info(
+                f"Got {len(league_page)} players",
+                region=self._region.name,
+                tier=tier.value,
+                division=division.value,
+                page=page,
+            )
+            empty_page = self._empty_pages[division_index]
+            # Pages past the first empty one are dropped, as they would not have been fetched
+            # one page at a time
+            if empty_page is None or page < empty_page:
+                if len(league_page) == 0:
+                    self._empty_pages[division_index] = page
+                else:
+                    self._last_full_pages[division_index] = max(
+                        self._last_full_pages[division_index], page
+                    )
+                    self._league_entries.extend(league_page)
+            futures = self._submit_pages()
+            self._condition.notify_all()
+        self._watch(futures)
+
+
+@dataclass(eq=False)
+class RegionState(CrawlState):
+    league_crawl: LeagueCrawl | None = None
+    ready_time: datetime = field(default_factory=now)
+    player_count: int = 0
+    match_count: int = 0
+
+    def get_next_request(self) -> tuple[str, str]:
+        # Matches are crawled while the league pages are fetched in the background
+        if self.league_crawl is None and self.is_league_outdated(now()):
+            return LeagueClient.get_host(self.region), LeagueClient.METHOD_GET_LEAGUE
+        return (
+            LeagueClient.get_host(self.region_group),
+            LeagueClient.METHOD_GET_MATCH_IDS_BY_PUUID,
         )
-        return player
-
-    def update_from_league_entry(self, league_entry: dict):
-        self.tier = Tier[league_entry["tier"]]
-        self.division = Division[league_entry["rank"]]
-        self.last_league_crawl_time = now()
-
-    def update_from_match_ids(self, match_ids: set[str]):
-        self.last_match_crawl_time = now()
-        self.last_match_count = len(match_ids)
-
-    def is_match_never_crawled(self) -> bool:
-        return self.last_match_crawl_time is None
-
-    def get_period_since_last_match_crawl(self) -> timedelta:
-        if self.last_match_crawl_time is None:
-            return timedelta.max
-        period_since_last_match_crawl = now() - self.last_match_crawl_time
-        return period_since_last_match_crawl
-
-    def estimate_new_match_count(self) -> float:
-        if self.last_match_crawl_time is None:
-            return float("inf")
-        period_since_last_match_crawl = self.get_period_since_last_match_crawl()
-        estimated_new_match_count = (
-            self.last_match_count * period_since_last_match_crawl / MATCH_TIME_WINDOW
+
+
+@dataclass
+class ThroughputReporter:
+    last_report_time: datetime = field(default_factory=now)
+    last_request_count_by_host: dict[str, int] = field(default_factory=dict)
+    last_player_count_by_region: dict[Region, int] = field(default_factory=dict)
+    last_match_count_by_region: dict[Region, int] = field(default_factory=dict)
+    last_request_count: int = 0
+    last_match_count: int = 0
+    last_applied_record_count: int = 0
+
+    def report_if_needed(
+        self,
+        league_client: LeagueClient,
+        database_writer: DatabaseWriter,
+        region_states: list[RegionState],
+    ):
+        period_since_last_report = now() - self.last_report_time
+        if period_since_last_report < THROUGHPUT_REPORT_INTERVAL:
+            return
+        seconds_since_last_report = period_since_last_report.total_seconds()
+        for host in league_client.get_hosts():
+            request_count = league_client.get_request_count(host)
+            last_request_count = self.last_request_count_by_host.get(host, 0)
+            requests_per_second = (request_count - last_request_count) / seconds_since_last_report
+            allowed_requests_per_second = league_client.get_allowed_requests_per_second(host)
+            rate_limit_usage = (
+                requests_per_second / allowed_requests_per_second
+                if allowed_requests_per_second
+                else None
+            )
+            logger.info(
+                f"Sent {requests_per_second:.2f} requests per second to {host}",
+                host=host,
+                requests_per_second=requests_per_second,
+                allowed_requests_per_second=allowed_requests_per_second,
+                rate_limit_usage=rate_limit_usage,
+            )
+            self.last_request_count_by_host[host] = request_count
+        for region_state in region_states:
+            region = region_state.region
+            players_per_second = (
+                region_state.player_count - self.last_player_count_by_region.get(region, 0)
+            ) / seconds_since_last_report
+            matches_per_second = (
+                region_state.match_count - self.last_match_count_by_region.get(region, 0)
+            ) / seconds_since_last_report
+            logger.info(
+                f"Crawled {matches_per_second:.2f} matches per second in {region.name}",
+                region=region.name,
+                players_per_second=players_per_second,
+                matches_per_second=matches_per_second,
+                player_count=len(region_state.player_registry),
+            )
+            self.last_player_count_by_region[region] = region_state.player_count
+            self.last_match_count_by_region[region] = region_state.match_count
+        # Requests are shared by the regions of a region group, so the yield is reported overall
+        request_count = league_client.get_request_count()
+        match_count = sum(region_state.match_count for region_state in region_states)
+        if request_count > self.last_request_count:
+            matches_per_request = (match_count - self.last_match_count) / (
+                request_count - self.last_request_count
+            )
+            logger.info(
+                f"Gained {matches_per_request:.3f} new matches per request",
+                matches_per_request=matches_per_request,
+            )
+        self.last_request_count = request_count
+        self.last_match_count = match_count
+        applied_record_count = database_writer.get_applied_record_count()
+        applied_records_per_second = (
+            applied_record_count - self.last_applied_record_count
+        ) / seconds_since_last_report
+        apply_lag = database_writer.get_apply_lag()
+        logger.info(
+            f"Stored spooled records {apply_lag:.2f} seconds after crawling them",
+            apply_lag=apply_lag,
+            applied_records_per_second=applied_records_per_second,
+            unapplied_byte_count=database_writer.get_unapplied_byte_count(),
         )
-        return estimated_new_match_count
+        self.last_applied_record_count = applied_record_count
+        self.last_report_time = now()
 
 
 def main(
-    region: Region = typer.Option(..., "--region", help="Region to crawl", case_sensitive=False),
+    regions: list[Region] = typer.Option(
+        ..., "--region", help="Region(s) to crawl", case_sensitive=False
+    ),
     crawl_tiers: list[Tier] = typer.Option(
         ..., "--tier", help="Tier(s) to crawl", case_sensitive=False
     ),
+    concurrency: int = typer.Option(
+        1, "--concurrency", min=1, help="Maximum number of match requests in flight"
+    ),
+    timeout: float = typer.Option(
+        LeagueClient.DEFAULT_TIMEOUT, "--timeout", min=0, help="Request timeout in seconds"
+    ),
+    rate_limit_directory: str | None = typer.Option(
+        None,
+        "--rate-limit-directory",
+        help="Directory to share rate limit state with other crawlers using the same API key",
+    ),
+    spool_directory: str = typer.Option(
+        "spool", "--spool-directory", help="Directory to spool records to before they are stored"
+    ),
+    warm_start: bool = typer.Option(
+        True, "--warm-start/--cold-start", help="Load the crawl state from the database"
+    ),
+    storage_profile: StorageProfile = typer.Option(
+        DatabaseHandler.STORAGE_PROFILE,
+        "--storage-profile",
+        help="How much of each match payload to store",
+        case_sensitive=False,
+    ),
+    incremental_match_ids: bool = typer.Option(
+        False,
+        "--incremental-match-ids/--windowed-match-ids",
+        help="Fetch match ids since the last crawl of each player instead of the whole window",
+    ),
+    league_snapshot_mode: LeagueSnapshotMode = typer.Option(
+        DatabaseHandler.LEAGUE_SNAPSHOT_MODE,
+        "--league-snapshot-mode",
+        help="Whether to store unchanged league entries in full or as heartbeats",
+        case_sensitive=False,
+    ),
+    base_url: str | None = typer.Option(
+        None,
+        "--base-url",
+        help="URL to send requests to instead of the Riot API, e.g. that of a mock server",
+    ),
+    match_count_estimator_kind: MatchCountEstimatorKind = typer.Option(
+        MatchCountEstimatorKind.LINEAR,
+        "--match-count-estimator",
+        help="How to estimate the new matches of each player when picking the next one to crawl",
+        case_sensitive=False,
+    ),
 ):
-    logger.info("Starting crawler")
-    region_group = RegionGroup.from_region(region)
-    league_client = LeagueClient(API_KEY)
+    logger.info(
+        "Starting crawler",
+        regions=[region.name for region in regions],
+        concurrency=concurrency,
+        timeout=timeout,
+        rate_limit_directory=rate_limit_directory,
+        spool_directory=spool_directory,
+        warm_start=warm_start,
+    )
+    league_client = LeagueClient(
+        API_KEY,
+        pool_size=concurrency,
+        timeout=timeout,
+        rate_limit_directory=rate_limit_directory,
+        base_url=base_url,
+    )
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    throughput_reporter = ThroughputReporter()
     database_handler = DatabaseHandler(
-        POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DATABASE
+        POSTGRES_USER,
+        POSTGRES_PASSWORD,
+        POSTGRES_HOST,
+        POSTGRES_PORT,
+        POSTGRES_DATABASE,
+        storage_profile=storage_profile,
+        league_snapshot_mode=league_snapshot_mode,
     )
-    last_league_crawl_time = datetime.min.replace(tzinfo=timezone.utc)
-    player_by_puuid = {}
-    crawl_time_by_match_id = {}
-    while True:
-        if now() - last_league_crawl_time >= LEAGUE_CRAWL_INTERVAL:
-            logger.info(
-                "League data is outdated. Crawling leagues",
-                last_league_crawl_time=last_league_crawl_time.isoformat(),
+    # Each region learns its own activity, since its players are awake at other hours
+    region_states = [
+        RegionState(
+            region, match_count_estimator=create_match_count_estimator(match_count_estimator_kind)
+        )
+        for region in dict.fromkeys(regions)
+    ]
+    database_writer = DatabaseWriter(database_handler, spool_directory)
+    if warm_start:
+        # Records spooled before a crash are applied first, so that they are part of the state
+        if not database_writer.wait_until_drained(SPOOL_REPLAY_TIMEOUT.total_seconds()):
+            logger.warning(
+                "Spooled records are still being applied. Starting with the stored state",
+                unapplied_byte_count=database_writer.get_unapplied_byte_count(),
             )
-            crawl_leagues(league_client, database_handler, region, crawl_tiers, player_by_puuid)
-            player_by_puuid = clean_player_by_puuid(player_by_puuid)
-            crawl_time_by_match_id = clean_crawl_time_by_match_id(crawl_time_by_match_id)
-            last_league_crawl_time = now()
-            continue
-        player = get_next_player_for_crawl(player_by_puuid)
-        new_match_ids = crawl_new_match_ids(
-            league_client, region_group, player, crawl_time_by_match_id
+        for region_state in region_states:
+            load_region_state(database_handler, region_state, crawl_tiers)
+    # Each region has at most one step in flight, since its state is not shared between threads.
+    # This thread decides when each region runs next: a region whose routing host is saturated or
+    # unhealthy is deferred instead of holding a worker that would only sleep, so the budget of
+    # every host is spent by whichever region can use it
+    step_executor = ThreadPoolExecutor(max_workers=len(region_states))
+    league_executor = ThreadPoolExecutor(max_workers=LEAGUE_PAGE_CONCURRENCY * len(region_states))
+    region_state_by_future = {}
+    try:
+        while True:
+            throughput_reporter.report_if_needed(league_client, database_writer, region_states)
+            running_region_states = set(region_state_by_future.values())
+            for region_state in region_states:
+                if region_state in running_region_states or region_state.ready_time > now():
+                    continue
+                host, method = region_state.get_next_request()
+                wait_for = league_client.get_wait_time(host, method)
+                if wait_for > 0:
+                    region_state.ready_time = now() + timedelta(seconds=wait_for)
+                    continue
+                future = step_executor.submit(
+                    crawl_region_step,
+                    league_client,
+                    database_handler,
+                    database_writer,
+                    executor,
+                    league_executor,
+                    region_state,
+                    crawl_tiers,
+                    incremental_match_ids,
+                )
+                region_state_by_future[future] = region_state
+            next_ready_time = min(
+                (
+                    region_state.ready_time
+                    for region_state in region_states
+                    if region_state not in region_state_by_future.values()
+                ),
+                default=now() + SCHEDULER_MAXIMUM_WAIT,
+            )
+            wait_timeout = min(next_ready_time - now(), SCHEDULER_MAXIMUM_WAIT).total_seconds()
+            done, _ = wait(
+                region_state_by_future, timeout=max(0, wait_timeout), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                region_state = region_state_by_future.pop(future)
+                defer_for = future.result()
+                region_state.ready_time = now() + timedelta(seconds=defer_for)
+    finally:
+        database_writer.close()
+
+
+def load_region_state(
+    database_handler: DatabaseHandler, region_state: RegionState, crawl_tiers: list[Tier]
+):
+    # Restores what the crawler knew before a restart, so that it neither crawls the leagues again
+    # nor spends requests on matches that are already stored
+    region = region_state.region
+    since = now() - MATCH_TIME_WINDOW
+    crawl_time_and_count_by_puuid = {
+        puuid: (crawled_at, match_count)
+        for puuid, crawled_at, match_count in database_handler.read_player_crawls(region.name)
+    }
+    region_state.player_registry = player_registry = PlayerRegistry()
+    for puuid, tier, rank, crawled_at in database_handler.read_latest_leagues(
+        region.name, [tier.value for tier in crawl_tiers], since
+    ):
+        last_match_crawl_time, last_match_count = crawl_time_and_count_by_puuid.get(
+            puuid, (None, None)
         )
-        crawl_matches(
-            league_client,
-            database_handler,
-            region_group,
-            new_match_ids,
-            crawl_time_by_match_id,
-            player,
+        player_registry.put(
+            Player(
+                puuid=puuid,
+                tier=Tier[tier],
+                division=Division[rank],
+                last_league_crawl_time=crawled_at,
+                last_match_crawl_time=last_match_crawl_time,
+                last_match_count=last_match_count,
+            )
         )
+    removed_player_count = region_state.remove_players_before(now() - MATCH_TIME_WINDOW)
+    log_player_registry(player_registry, removed_player_count)
+    for match_id, crawled_at in database_handler.read_match_crawl_times(region.name, since):
+        region_state.match_id_index.add(match_id, crawled_at)
+    last_league_crawl_time = database_handler.read_league_crawl_time(region.name)
+    # Without players there is nothing to crawl until the next league crawl, so it runs right away
+    if last_league_crawl_time is not None and len(region_state.player_registry) > 0:
+        region_state.last_league_crawl_time = last_league_crawl_time
+    logger.info(
+        "Loaded crawl state from database",
+        region=region.name,
+        player_count=len(region_state.player_registry),
+        match_count=len(region_state.match_id_index),
+        last_league_crawl_time=region_state.last_league_crawl_time.isoformat(),
+    )
 
 
-def crawl_leagues(
+def crawl_region_step(
     league_client: LeagueClient,
     database_handler: DatabaseHandler,
-    region: Region,
+    database_writer: DatabaseWriter,
+    executor: ThreadPoolExecutor,
+    league_executor: ThreadPoolExecutor,
+    region_state: RegionState,
     crawl_tiers: list[Tier],
-    player_by_puuid: dict[str, Player],
-):
-    for tier in crawl_tiers:
-        for division in Division:
-            if tier.is_apex_tier() and division != Division.I:
-                continue
-            for page in count(1):
-                league_page = league_client.get_league(
-                    region, Queue.RANKED_SOLO_5x5, tier, division, page
-                )
-                logger.info(
-                    f"Got {len(league_page)} players",
-                    tier=tier.value,
-                    division=division.value,
-                    page=page,
-                )
-                if len(league_page) == 0:
-                    break
-                database_handler.write_leagues(league_page)
-                for entry in league_page:
-                    puuid = entry["puuid"]
-                    if puuid not in player_by_puuid:
-                        player_by_puuid[puuid] = Player.from_league_entry(entry)
-                    else:
-                        player_by_puuid[puuid].update_from_league_entry(entry)
-
-
-def clean_player_by_puuid(player_by_puuid: dict[str, Player]) -> dict[str, Player]:
-    player_by_puuid = remove_old_players(player_by_puuid)
-    player_by_puuid = sort_players_by_league(player_by_puuid)
-    logger.info(f"There are {len(player_by_puuid)} players being tracked")
-    return player_by_puuid
-
-
-def remove_old_players(player_by_puuid: dict[str, Player]) -> dict[str, Player]:
-    player_by_puuid = {
-        puuid: player
-        for puuid, player in player_by_puuid.items()
-        if now() - player.last_league_crawl_time <= MATCH_TIME_WINDOW
-    }
-    return player_by_puuid
+    incremental_match_ids: bool,
+) -> float:
+    # Runs one unit of work for a region and returns for how many seconds to defer the next one
+    local_logger = logger.bind(region=region_state.region.name)
+    league_crawl = region_state.league_crawl
+    if league_crawl is None and region_state.is_league_outdated(now()):
+        local_logger.info(
+            "League data is outdated. Crawling leagues",
+            last_league_crawl_time=region_state.last_league_crawl_time.isoformat(),
+        )
+        league_crawl = LeagueCrawl(league_client, league_executor, region_state.region, crawl_tiers)
+        region_state.league_crawl = league_crawl
+    if league_crawl is not None:
+        # A failed page fails the whole league crawl, which starts over later, as the pages
+        # already fetched are only written and not marked as crawled
+        try:
+            league_entries, is_league_crawl_done = league_crawl.collect()
+        except CircuitOpenError as e:
+            local_logger.warning(
+                "Routing host is unhealthy. Waiting before crawling leagues again",
+                host=e.host,
+                retry_after=e.retry_after,
+            )
+            league_crawl.cancel()
+            region_state.league_crawl = None
+            return e.retry_after
+        except requests.RequestException:
+            retry_after = LEAGUE_CRAWL_RETRY_INTERVAL.total_seconds()
+            local_logger.exception(
+                "Failed to get league page. Waiting before crawling leagues again",
+                retry_after=retry_after,
+            )
+            league_crawl.cancel()
+            region_state.league_crawl = None
+            return retry_after
+        update_from_league_entries(database_writer, region_state, league_entries)
+        if is_league_crawl_done:
+            region_state.league_crawl = None
+            removed_player_count, expired_match_id_count = region_state.finish_league_crawl(now())
+            log_player_registry(region_state.player_registry, removed_player_count)
+            log_match_id_index(region_state.match_id_index, expired_match_id_count)
+            database_writer.write_region_crawl(
+                region_state.region.name, region_state.last_league_crawl_time
+            )
+            return 0
+    player = get_next_player_for_crawl(region_state.player_scheduler)
+    if player is None and league_crawl is not None:
+        league_crawl.wait_for_entries(SCHEDULER_MAXIMUM_WAIT.total_seconds())
+        return 0
+    if player is None:
+        local_logger.warning("There are no players to crawl. Waiting for the next league crawl")
+        return (region_state.get_next_league_crawl_time() - now()).total_seconds()
+    try:
+        new_match_ids = crawl_new_match_ids(
+            league_client, database_handler, region_state, player, incremental_match_ids
+        )
+    except CircuitOpenError as e:
+        local_logger.warning(
+            "Routing host is unhealthy. Waiting before crawling again",
+            host=e.host,
+            retry_after=e.retry_after,
+        )
+        return e.retry_after
+    except requests.HTTPError:
+        local_logger.exception("Failed to get match ids. Skipping player", player=player)
+        player.update_from_match_ids(set())
+        write_player_crawl(database_writer, region_state.region, player)
+        return 0
+    except requests.RequestException:
+        retry_after = MATCH_ID_RETRY_INTERVAL.total_seconds()
+        local_logger.exception(
+            "Failed to get match ids. Waiting before crawling again",
+            player=player,
+            retry_after=retry_after,
+        )
+        return retry_after
+    finally:
+        # The player left the schedule when it was picked, so it is put back whatever happens
+        region_state.player_scheduler.schedule(player)
+    write_player_crawl(database_writer, region_state.region, player)
+    region_state.player_count += 1
+    region_state.match_count += crawl_matches(
+        league_client, database_writer, executor, region_state, new_match_ids, player
+    )
+    return 0
 
 
-def sort_players_by_league(player_by_puuid: dict[str, Player]) -> dict[str, Player]:
-    tier_order = list(Tier)
-    division_order = list(Division)
-    player_by_puuid = sorted(  # ty: ignore[invalid-assignment]
-        player_by_puuid.items(),
-        key=lambda item: (tier_order.index(item[1].tier), division_order.index(item[1].division)),
+def write_player_crawl(database_writer: DatabaseWriter, region: Region, player: Player):
+    last_match_crawl_time = player.last_match_crawl_time
+    last_match_count = player.last_match_count
+    assert last_match_crawl_time is not None and last_match_count is not None, (
+        "Player crawls are written after the match ids of the player are crawled"
+    )
+    database_writer.write_player_crawl(
+        player.puuid, region.name, last_match_crawl_time, last_match_count
     )
-    player_by_puuid = dict(player_by_puuid)
-    return player_by_puuid
 
 
-def clean_crawl_time_by_match_id(
-    crawl_time_by_match_id: dict[str, datetime],
-) -> dict[str, datetime]:
-    crawl_time_by_match_id = {
-        match_id: crawl_time
-        for match_id, crawl_time in crawl_time_by_match_id.items()
-        if now() - crawl_time <= MATCH_TIME_WINDOW
-    }
-    logger.info(f"There are {len(crawl_time_by_match_id)} matches being tracked")
-    return crawl_time_by_match_id
+def update_from_league_entries(
+    database_writer: DatabaseWriter, region_state: RegionState, league_entries: list[dict]
+):
+    if len(league_entries) == 0:
+        return
+    database_writer.write_leagues(league_entries, region_state.region.name)
+    region_state.update_from_league_entries(league_entries, now())
 
 
-def get_next_player_for_crawl(player_by_puuid: dict[str, Player]) -> Player:
-    maximum_player = list(player_by_puuid.values())[0]
-    maximum_estimated_new_match_count = maximum_player.estimate_new_match_count()
-    for player in player_by_puuid.values():
-        if player.is_match_never_crawled():
-            logger.info(
-                f"Player {player.puuid} has never been crawled for matches. Crawling next",
-                player=player,
-            )
-            return player
-        if player.get_period_since_last_match_crawl() >= MATCH_TIME_WINDOW / 2:
-            logger.info(
-                f"Player {player.puuid} has been crawled for too long. Crawling next",
-                player=player,
-                period_since_last_match_crawl=player.get_period_since_last_match_crawl(),
-            )
-            return player
-        estimated_new_match_count = player.estimate_new_match_count()
-        if estimated_new_match_count >= MATCH_COUNT_MAXIMUM / 2:
-            logger.info(
-                f"Player {player.puuid} probably has too many new matches. Crawling next",
-                player=player,
-                estimated_new_match_count=estimated_new_match_count,
-            )
-            return player
-        if estimated_new_match_count >= maximum_estimated_new_match_count:
-            maximum_estimated_new_match_count = estimated_new_match_count
-            maximum_player = player
+def log_player_registry(player_registry: PlayerRegistry, removed_player_count: int):
+    logger.info(
+        f"There are {len(player_registry)} players being tracked",
+        removed_player_count=removed_player_count,
+        byte_count=player_registry.get_byte_count(),
+    )
+
+
+def log_match_id_index(match_id_index: MatchIdIndex, expired_match_id_count: int):
+    statistics = match_id_index.get_statistics()
     logger.info(
-        f"Player {maximum_player.puuid} probably has the most new matches. Crawling next",
-        player=maximum_player,
-        estimated_new_match_count=maximum_estimated_new_match_count,
+        f"There are {statistics.match_id_count} matches being tracked",
+        expired_match_id_count=expired_match_id_count,
+        bucket_count=statistics.bucket_count,
+        byte_count=statistics.byte_count,
     )
-    return maximum_player
+
+
+def get_next_player_for_crawl(player_scheduler: PlayerScheduler) -> Player | None:
+    moment = now()
+    next_player = player_scheduler.pop_next_player(moment)
+    if next_player is None:
+        return None
+    player, reason = next_player
+    if reason == ScheduleReason.NEVER_CRAWLED:
+        logger.info(
+            f"Player {player.puuid} has never been crawled for matches. Crawling next",
+            player=player,
+        )
+    elif reason == ScheduleReason.STALE:
+        logger.info(
+            f"Player {player.puuid} has been crawled for too long. Crawling next",
+            player=player,
+            period_since_last_match_crawl=player.get_period_since_last_match_crawl(moment),
+        )
+    elif reason == ScheduleReason.MANY_NEW_MATCHES:
+        logger.info(
+            f"Player {player.puuid} probably has too many new matches. Crawling next",
+            player=player,
+            estimated_new_match_count=player_scheduler.estimate_new_match_count(player, moment),
+        )
+    else:
+        logger.info(
+            f"Player {player.puuid} probably has the most new matches. Crawling next",
+            player=player,
+            estimated_new_match_count=player_scheduler.estimate_new_match_count(player, moment),
+        )
+    return player
 
 
 def crawl_new_match_ids(
     league_client: LeagueClient,
-    region_group: RegionGroup,
+    database_handler: DatabaseHandler,
+    region_state: RegionState,
     player: Player,
-    crawl_time_by_match_id: dict[str, datetime],
+    incremental_match_ids: bool,
 ) -> set[str]:
-    local_logger = logger.bind(player=player)
-    start_time = now() - MATCH_TIME_WINDOW
-    start_time = int(start_time.timestamp())
-    match_ids = league_client.get_match_ids_by_puuid(
-        region_group, player.puuid, start_time=start_time, queue_id=QueueId.RANKED_SOLO_5x5
+    # Estimated before the crawl resets the matches observed through other players, so that it
+    # can be compared with the share of match ids that turn out to be new
+    estimated_match_coverage = player.estimate_match_coverage()
+    match_ids, new_match_ids = region_state.crawl_new_match_ids(
+        league_client, player, database_handler.read_stored_match_ids, incremental_match_ids
+    )
+    logger.info(
+        f"Got {len(match_ids)} match ids, of which {len(new_match_ids)} are new",
+        player=player,
+        estimated_match_coverage=estimated_match_coverage,
     )
-    match_ids = set(match_ids)
-    player.update_from_match_ids(match_ids)
-    new_match_ids = match_ids - set(crawl_time_by_match_id.keys())
-    local_logger.info(f"Got {len(match_ids)} match ids, of which {len(new_match_ids)} are new")
     return new_match_ids
 
 
 def crawl_matches(
     league_client: LeagueClient,
-    database_handler: DatabaseHandler,
-    region_group: RegionGroup,
+    database_writer: DatabaseWriter,
+    executor: ThreadPoolExecutor,
+    region_state: RegionState,
     new_match_ids: set[str],
-    crawl_time_by_match_id: dict[str, datetime],
     player: Player,
-):
-    for i, new_match_id in enumerate(new_match_ids):
-        match_ = league_client.get_match(region_group, new_match_id)
+) -> int:
+    # Requests run in the executor while writes stay on the calling thread, one at a time
+    match_id_by_future = {
+        executor.submit(
+            league_client.get_raw_match, region_state.region_group, new_match_id
+        ): new_match_id
+        for new_match_id in new_match_ids
+    }
+    match_count = 0
+    for i, future in enumerate(as_completed(match_id_by_future)):
+        new_match_id = match_id_by_future[future]
+        local_logger = logger.bind(match_id=new_match_id, player=player)
+        try:
+            raw_match = future.result()
+        except requests.HTTPError as e:
+            local_logger.warning("Failed to get match data. Skipping match")
+            # Deleted or remade matches stay unavailable, so they are not requested again
+            response = e.response
+            if response is not None and not is_retryable_status_code(response.status_code):
+                region_state.match_id_index.add(new_match_id)
+            continue
+        except CircuitOpenError as e:
+            local_logger.warning("Routing host is unhealthy. Skipping match", host=e.host)
+            continue
+        except requests.RequestException:
+            local_logger.exception("Failed to get match data. Skipping match")
+            continue
+        if raw_match is None:
+            local_logger.warning("Got no match data. Skipping match")
+            continue
+        observed_player_count = region_state.observe_participants(
+            player,
+            convert_epoch_to_datetime(raw_match.game_end_timestamp),
+            raw_match.participant_puuids,
+        )
         logger.info(
             "Got match data",
             index=i + 1,
             max_index=len(new_match_ids),
             match_id=new_match_id,
             player=player,
+            observed_player_count=observed_player_count,
         )
-        database_handler.write_match(match_)
-        crawl_time_by_match_id[new_match_id] = now()
+        database_writer.write_raw_match(raw_match)
+        region_state.match_id_index.add(new_match_id)
+        match_count += 1
+    return match_count
 
 
 if __name__ == "__main__":
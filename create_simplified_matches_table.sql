@@ -1,10 +1,54 @@
 DROP TABLE IF EXISTS simplified_matches;
+DROP TABLE IF EXISTS simplified_matches_watermark;
 
 CREATE TABLE
+    simplified_matches (
+        match_id TEXT NOT NULL,
+        participant_id SMALLINT NOT NULL,
+        ended_at TIMESTAMPTZ NOT NULL,
+        region TEXT NOT NULL,
+        team TEXT,
+        position TEXT,
+        champion TEXT,
+        win BOOLEAN,
+        PRIMARY KEY (match_id, participant_id)
+    );
+
+-- The matches.stored_at up to which refresh_simplified_matches_table.sql has read every match
+CREATE TABLE
+    simplified_matches_watermark (
+        stored_at TIMESTAMPTZ
+    );
+
+-- Matches of transactions open now may commit after the snapshot below. See
+-- refresh_simplified_matches_table.sql
+DROP TABLE IF EXISTS pg_temp.simplified_matches_open_since;
+
+CREATE TEMPORARY TABLE simplified_matches_open_since AS
+SELECT
+    LEAST(now(), min(xact_start)) AS stored_at
+FROM
+    pg_stat_activity
+WHERE
+    datname = current_database()
+    AND xact_start IS NOT NULL
+    AND pid <> pg_backend_pid();
+
+BEGIN ISOLATION LEVEL REPEATABLE READ;
+
+INSERT INTO
+    simplified_matches_watermark
+SELECT
+    LEAST(
+        (SELECT max(stored_at) FROM matches),
+        (SELECT stored_at FROM simplified_matches_open_since)
+    );
+
+INSERT INTO
     simplified_matches
-AS
 SELECT
     matches.match_id AS match_id,
+    (participant.value ->> 'participantId')::smallint AS participant_id,
     matches.ended_at AS ended_at,
     matches.region AS region,
     participant.value ->> 'teamId' AS team,
@@ -13,4 +57,6 @@ SELECT
     (participant.value ->> 'win')::boolean AS win
 FROM
     matches,
-    jsonb_array_elements(dump -> 'info' -> 'participants') AS participant
\ No newline at end of file
+    jsonb_array_elements(dump -> 'info' -> 'participants') AS participant;
+
+COMMIT;
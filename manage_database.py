@@ -0,0 +1,90 @@
+"""
+# Run
+uv run manage_database.py --help
+"""
+
+import logging
+import os
+from datetime import datetime, timezone
+
+import structlog
+import typer
+from dotenv import load_dotenv
+
+from src.database import DatabaseHandler, PartitionedTable, StorageProfile
+
+load_dotenv(override=True)
+POSTGRES_USER = os.environ["POSTGRES_USER"]
+POSTGRES_PASSWORD = os.environ["POSTGRES_PASSWORD"]
+POSTGRES_HOST = os.environ["POSTGRES_HOST"]
+POSTGRES_PORT = os.environ["POSTGRES_PORT"]
+POSTGRES_DATABASE = os.environ["POSTGRES_DATABASE"]
+
+
+structlog.configure(
+    processors=[
+        structlog.contextvars.merge_contextvars,
+        structlog.processors.add_log_level,
+        structlog.processors.StackInfoRenderer(),
+        structlog.dev.set_exc_info,
+        structlog.processors.TimeStamper(fmt="iso", utc=True),
+        structlog.dev.ConsoleRenderer(
+            colors=False, exception_formatter=structlog.dev.plain_traceback, sort_keys=False
+        ),
+    ],
+    wrapper_class=structlog.make_filtering_bound_logger(logging.NOTSET),
+    context_class=dict,
+    logger_factory=structlog.PrintLoggerFactory(),
+    cache_logger_on_first_use=False,
+)
+logger = structlog.get_logger()
+app = typer.Typer()
+
+
+def create_database_handler() -> DatabaseHandler:
+    return DatabaseHandler(
+        POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DATABASE
+    )
+
+
+@app.command()
+def migrate():
+    """Move tables created before partitioning into weekly partitions."""
+    database_handler = create_database_handler()
+    database_handler.migrate_to_partitions()
+
+
+@app.command()
+def drop_partitions(
+    table: PartitionedTable = typer.Option(..., "--table", help="Table to drop partitions from"),
+    before: datetime = typer.Option(
+        ..., "--before", formats=["%Y-%m-%d"], help="Drop partitions that end before this date"
+    ),
+):
+    """Drop the weekly partitions that only hold rows from before a date."""
+    database_handler = create_database_handler()
+    database_handler.drop_partitions_before(table, before.replace(tzinfo=timezone.utc))
+
+
+@app.command()
+def compact_matches(
+    storage_profile: StorageProfile = typer.Option(
+        StorageProfile.PROJECTED,
+        "--storage-profile",
+        help="Profile to convert the full match dumps to",
+        case_sensitive=False,
+    ),
+    batch_size: int = typer.Option(
+        DatabaseHandler.COMPACTION_BATCH_SIZE,
+        "--batch-size",
+        min=1,
+        help="Number of matches converted per transaction",
+    ),
+):
+    """Convert the full match dumps stored so far to a compact storage profile."""
+    database_handler = create_database_handler()
+    database_handler.compact_matches(storage_profile, batch_size)
+
+
+if __name__ == "__main__":
+    app()
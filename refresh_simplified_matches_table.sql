@@ -0,0 +1,61 @@
+-- Adds the matches stored since the last refresh. Run create_simplified_matches_table.sql once
+-- first to create the tables and the watermark
+
+-- Watermarks written before matches.stored_at existed are empty, so every match is read again once
+ALTER TABLE simplified_matches_watermark ADD COLUMN IF NOT EXISTS stored_at TIMESTAMPTZ;
+
+-- A match is stamped with the start of the transaction that stores it, which can still be open
+-- when this refresh reads the matches and commit afterwards. Such a transaction is either open
+-- now or starts later, so the watermark does not move past the start of the oldest transaction
+-- open now, or past now if there is none
+DROP TABLE IF EXISTS pg_temp.simplified_matches_open_since;
+
+CREATE TEMPORARY TABLE simplified_matches_open_since AS
+SELECT
+    LEAST(now(), min(xact_start)) AS stored_at
+FROM
+    pg_stat_activity
+WHERE
+    datname = current_database()
+    AND xact_start IS NOT NULL
+    AND pid <> pg_backend_pid();
+
+BEGIN ISOLATION LEVEL REPEATABLE READ;
+
+-- Concurrent refreshes run one after the other
+LOCK TABLE simplified_matches_watermark IN EXCLUSIVE MODE;
+
+-- The participants of matches stored in the same transaction as the watermark are already there
+-- and skipped
+INSERT INTO
+    simplified_matches
+SELECT
+    matches.match_id AS match_id,
+    (participant.value ->> 'participantId')::smallint AS participant_id,
+    matches.ended_at AS ended_at,
+    matches.region AS region,
+    participant.value ->> 'teamId' AS team,
+    participant.value ->> 'teamPosition' AS position,
+    participant.value ->> 'championName' AS champion,
+    (participant.value ->> 'win')::boolean AS win
+FROM
+    matches,
+    jsonb_array_elements(dump -> 'info' -> 'participants') AS participant
+WHERE
+    matches.stored_at >= (
+        SELECT COALESCE(stored_at, '-infinity') FROM simplified_matches_watermark
+    )
+ON CONFLICT (match_id, participant_id) DO NOTHING;
+
+UPDATE
+    simplified_matches_watermark
+SET
+    stored_at = GREATEST(
+        stored_at,
+        LEAST(
+            (SELECT max(stored_at) FROM matches),
+            (SELECT stored_at FROM simplified_matches_open_since)
+        )
+    );
+
+COMMIT;
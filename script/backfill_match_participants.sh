@@ -0,0 +1 @@
+sudo docker exec -i postgres psql -U postgres -d postgres < backfill_match_participants.sql
\ No newline at end of file
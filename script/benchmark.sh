@@ -0,0 +1,5 @@
+mkdir -p benchmark/
+
+uv run python -m script.simulate_crawl --seed=0 --output=benchmark/simulation.json
+uv run python -m script.benchmark_scheduler --player-count=10000 --player-count=100000
+uv run python -m script.benchmark_registry --player-count=10000 --player-count=100000
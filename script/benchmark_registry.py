@@ -0,0 +1,142 @@
+import random
+import time
+import tracemalloc
+from collections.abc import Callable
+from datetime import timedelta
+
+import typer
+
+from src.client import Division, Tier
+from src.player import MATCH_COUNT_MAXIMUM, MATCH_TIME_WINDOW, Player
+from src.registry import PlayerRegistry
+from src.scheduler import PlayerScheduler
+from src.util import now
+
+PLAYER_COUNTS = [10_000, 100_000, 1_000_000]
+PUUID_LENGTH = 78
+
+
+def generate_league_entries(player_count: int, seed: int) -> list[dict]:
+    random_ = random.Random(seed)
+    tiers = [Tier.DIAMOND, Tier.EMERALD]
+    return [
+        {
+            "puuid": f"puuid-{i}".ljust(PUUID_LENGTH, "x"),
+            "tier": random_.choice(tiers).value,
+            "rank": random_.choice(list(Division)).value,
+        }
+        for i in range(player_count)
+    ]
+
+
+def build_player_by_puuid(league_entries: list[dict]) -> dict[str, Player]:
+    # How the crawler kept players before the registry, one dataclass per player
+    player_by_puuid = {}
+    for entry in league_entries:
+        player_by_puuid[entry["puuid"]] = Player.from_league_entry(entry)
+    return player_by_puuid
+
+
+def clean_player_by_puuid(player_by_puuid: dict[str, Player]) -> dict[str, Player]:
+    player_by_puuid = {
+        puuid: player
+        for puuid, player in player_by_puuid.items()
+        if now() - player.last_league_crawl_time <= MATCH_TIME_WINDOW
+    }
+    tier_order = list(Tier)
+    division_order = list(Division)
+    return dict(
+        sorted(
+            player_by_puuid.items(),
+            key=lambda item: (
+                tier_order.index(item[1].tier),
+                division_order.index(item[1].division),
+            ),
+        )
+    )
+
+
+def build_player_registry(league_entries: list[dict]) -> PlayerRegistry:
+    player_registry = PlayerRegistry()
+    moment = now()
+    for entry in league_entries:
+        player_registry.update_from_league_entry(entry, moment)
+    return player_registry
+
+
+def mark_players_crawled(player_registry: PlayerRegistry, seed: int):
+    # Picks are measured in the steady state, where every player has been crawled before
+    random_ = random.Random(seed)
+    moment = now()
+    for player in player_registry.iterate_players_by_league():
+        player.last_match_crawl_time = (
+            moment - random_.random() * MATCH_TIME_WINDOW / 2 + timedelta(seconds=1)
+        )
+        player.last_match_count = random_.randint(0, MATCH_COUNT_MAXIMUM)
+        player_registry.put(player)
+
+
+def measure_memory[T](
+    build: Callable[[list[dict]], T], league_entries: list[dict]
+) -> tuple[T, int]:
+    # Only counts what the build allocates, not the league entries it reads from
+    tracemalloc.start()
+    result = build(league_entries)
+    byte_count, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, byte_count
+
+
+def benchmark_picks(player_scheduler: PlayerScheduler, pick_count: int, seed: int) -> float:
+    random_ = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(pick_count):
+        next_player = player_scheduler.pop_next_player()
+        assert next_player is not None, "Every pick schedules the player again"
+        player, _ = next_player
+        match_count = random_.randint(0, MATCH_COUNT_MAXIMUM)
+        player.update_from_match_ids({str(index) for index in range(match_count)})
+        player_scheduler.schedule(player)
+    return (time.perf_counter() - start) / pick_count
+
+
+def main(
+    player_counts: list[int] = typer.Option(
+        PLAYER_COUNTS, "--player-count", help="Number(s) of players to benchmark"
+    ),
+    pick_count: int = typer.Option(100_000, "--pick-count", min=1, help="Number of picks"),
+    seed: int = typer.Option(0, "--seed", help="Seed for the synthetic league entries"),
+):
+    for player_count in player_counts:
+        league_entries = generate_league_entries(player_count, seed)
+
+        player_by_puuid, dataclass_byte_count = measure_memory(
+            build_player_by_puuid, league_entries
+        )
+        start = time.perf_counter()
+        clean_player_by_puuid(player_by_puuid)
+        dataclass_clean_time = time.perf_counter() - start
+        del player_by_puuid
+
+        player_registry, registry_byte_count = measure_memory(build_player_registry, league_entries)
+        start = time.perf_counter()
+        player_registry.remove_players_before(now() - MATCH_TIME_WINDOW)
+        registry_clean_time = time.perf_counter() - start
+        mark_players_crawled(player_registry, seed)
+        start = time.perf_counter()
+        player_scheduler = PlayerScheduler(player_registry)
+        build_time = time.perf_counter() - start
+        pick_time = benchmark_picks(player_scheduler, pick_count, seed)
+
+        print(
+            f"{player_count:>9} players: "
+            f"dataclasses {dataclass_byte_count / player_count:>6.0f} B/player, "
+            f"registry {registry_byte_count / player_count:>6.0f} B/player, "
+            f"clean {dataclass_clean_time:.2f} s -> {registry_clean_time:.2f} s, "
+            f"scheduler built in {build_time:.2f} s, "
+            f"{pick_time * 1e6:.1f} us/pick ({pick_count} picks)"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
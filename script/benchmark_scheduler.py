@@ -0,0 +1,109 @@
+import random
+import time
+from datetime import timedelta
+
+import typer
+
+from src.client import Division, Tier
+from src.player import MATCH_COUNT_MAXIMUM, MATCH_TIME_WINDOW, Player
+from src.registry import PlayerRegistry
+from src.scheduler import PlayerScheduler
+from src.util import now
+
+PLAYER_COUNTS = [10_000, 100_000, 1_000_000]
+# The linear scan costs about a second per pick at a million players, so it gets fewer picks
+LINEAR_SCAN_PICK_BUDGET = 20_000_000
+
+
+def generate_players(player_count: int, seed: int) -> list[Player]:
+    random_ = random.Random(seed)
+    moment = now()
+    players = []
+    for i in range(player_count):
+        players.append(
+            Player(
+                puuid=f"puuid-{i}",
+                tier=Tier.CHALLENGER,
+                division=Division.I,
+                last_league_crawl_time=moment,
+                # Recently crawled players, so that no pick takes the never crawled or stale paths
+                last_match_crawl_time=moment
+                - random_.random() * MATCH_TIME_WINDOW / 2
+                + timedelta(seconds=1),
+                last_match_count=random_.randint(0, MATCH_COUNT_MAXIMUM),
+            )
+        )
+    return players
+
+
+def get_next_player_by_linear_scan(players: list[Player]) -> Player:
+    # The selection logic the crawler used before the scheduler, kept as the baseline
+    maximum_player = players[0]
+    maximum_estimated_new_match_count = maximum_player.estimate_new_match_count()
+    for player in players:
+        if player.is_match_never_crawled():
+            return player
+        if player.get_period_since_last_match_crawl() >= MATCH_TIME_WINDOW / 2:
+            return player
+        estimated_new_match_count = player.estimate_new_match_count()
+        if estimated_new_match_count >= MATCH_COUNT_MAXIMUM / 2:
+            return player
+        if estimated_new_match_count >= maximum_estimated_new_match_count:
+            maximum_estimated_new_match_count = estimated_new_match_count
+            maximum_player = player
+    return maximum_player
+
+
+def benchmark_linear_scan(players: list[Player], pick_count: int, seed: int) -> float:
+    random_ = random.Random(seed)
+    start = time.perf_counter()
+    for _ in range(pick_count):
+        player = get_next_player_by_linear_scan(players)
+        match_count = random_.randint(0, MATCH_COUNT_MAXIMUM)
+        player.update_from_match_ids({str(index) for index in range(match_count)})
+    return (time.perf_counter() - start) / pick_count
+
+
+def benchmark_scheduler(players: list[Player], pick_count: int, seed: int) -> tuple[float, float]:
+    random_ = random.Random(seed)
+    player_registry = PlayerRegistry(players)
+    start = time.perf_counter()
+    player_scheduler = PlayerScheduler(player_registry)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(pick_count):
+        next_player = player_scheduler.pop_next_player()
+        assert next_player is not None, "Every pick schedules the player again"
+        player, _ = next_player
+        match_count = random_.randint(0, MATCH_COUNT_MAXIMUM)
+        player.update_from_match_ids({str(index) for index in range(match_count)})
+        player_scheduler.schedule(player)
+    return build_time, (time.perf_counter() - start) / pick_count
+
+
+def main(
+    player_counts: list[int] = typer.Option(
+        PLAYER_COUNTS, "--player-count", help="Number(s) of players to benchmark"
+    ),
+    pick_count: int = typer.Option(1000, "--pick-count", min=1, help="Number of picks"),
+    seed: int = typer.Option(0, "--seed", help="Seed for the synthetic players"),
+):
+    for player_count in player_counts:
+        linear_scan_pick_count = max(1, min(pick_count, LINEAR_SCAN_PICK_BUDGET // player_count))
+        linear_scan_pick_time = benchmark_linear_scan(
+            generate_players(player_count, seed), linear_scan_pick_count, seed
+        )
+        build_time, scheduler_pick_time = benchmark_scheduler(
+            generate_players(player_count, seed), pick_count, seed
+        )
+        print(
+            f"{player_count:>9} players: "
+            f"linear scan {linear_scan_pick_time * 1e6:>12.1f} us/pick ({linear_scan_pick_count} picks), "
+            f"scheduler {scheduler_pick_time * 1e6:>8.1f} us/pick ({pick_count} picks, "
+            f"built in {build_time:.2f} s), "
+            f"speedup {linear_scan_pick_time / scheduler_pick_time:.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
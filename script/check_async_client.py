@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+
+import aiohttp
+import typer
+
+from script.mock_riot_server import LOBBY_COUNT, MockRiotServer
+from src.async_client import AsyncLeagueClient
+from src.client import Division, LeagueClient, Queue, Region, RegionGroup, Tier
+from src.retry import CircuitBreaker, CircuitOpenError
+
+REGIONS = [Region.NA1, Region.EUW1, Region.KR]
+FAILURE_THRESHOLD = 2
+
+
+def start_mock_server(error_rate: float) -> MockRiotServer:
+    # Port 0 lets the system pick a free port, so checks can run next to a crawler
+    server = MockRiotServer(
+        ("127.0.0.1", 0), 100, LOBBY_COUNT, "20:1,100:120", "2000:10", 0.01, error_rate, 0.0, False
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_base_url(server: MockRiotServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+async def crawl_region(
+    league_client: AsyncLeagueClient, region: Region, player_count: int
+) -> tuple[int, int]:
+    region_group = RegionGroup.from_region(region)
+    league = await league_client.get_league(region, Queue.RANKED_SOLO_5x5, Tier.DIAMOND, Division.I)
+    if not league:
+        raise RuntimeError(f"Got no league entries for {region.name}")
+    match_ids = set()
+    for entry in league[:player_count]:
+        match_ids.update(
+            await league_client.get_match_ids_by_puuid(region_group, entry["puuid"], count=5)
+        )
+    raw_matches = await asyncio.gather(
+        *(league_client.get_raw_match(region_group, match_id) for match_id in match_ids)
+    )
+    for match_id, raw_match in zip(match_ids, raw_matches):
+        if raw_match is None or raw_match.match_id != match_id:
+            raise RuntimeError(f"Got the wrong match for {match_id}")
+        if raw_match.platform_id != region.value.upper():
+            raise RuntimeError(f"Got a match of another region for {match_id}")
+    return len(league), len(raw_matches)
+
+
+async def check_regions(base_url: str, player_count: int):
+    # The regions share one event loop and are rate limited per routing host
+    async with AsyncLeagueClient("key", base_url=base_url) as league_client:
+        start = time.perf_counter()
+        counts = await asyncio.gather(
+            *(crawl_region(league_client, region, player_count) for region in REGIONS)
+        )
+        elapsed = time.perf_counter() - start
+        for region, (league_entry_count, match_count) in zip(REGIONS, counts):
+            print(
+                f"{region.name}: {league_entry_count} league entries, {match_count} matches, "
+                f"{league_client.get_request_count(LeagueClient.get_host(region))} platform "
+                "requests"
+            )
+        request_count = league_client.get_request_count()
+        print(f"{request_count} requests in {elapsed:.1f} s")
+        try:
+            await league_client.get_match(RegionGroup.AMERICAS, "NA1_UNKNOWN")
+            raise RuntimeError("Got a match that does not exist")
+        except aiohttp.ClientResponseError as e:
+            if e.status != 404:
+                raise
+        attempt_count = league_client.get_request_count() - request_count
+        if attempt_count != 1:
+            raise RuntimeError(f"Requested a missing match {attempt_count} times")
+        print("Missing match: raised after a single request")
+
+
+async def check_circuit_breaker(base_url: str):
+    circuit_breaker = CircuitBreaker(failure_threshold=FAILURE_THRESHOLD)
+    async with AsyncLeagueClient(
+        "key", circuit_breaker=circuit_breaker, base_url=base_url
+    ) as league_client:
+        host = LeagueClient.get_host(Region.NA1)
+        try:
+            await league_client.get_league(
+                Region.NA1, Queue.RANKED_SOLO_5x5, Tier.DIAMOND, Division.I
+            )
+            raise RuntimeError("Got a league from a failing server")
+        except CircuitOpenError as e:
+            if e.host != host:
+                raise
+        print(
+            f"Failing server: circuit opened after {league_client.get_request_count(host)} "
+            f"requests, retry after {league_client.get_wait_time(host):.1f} s"
+        )
+
+
+def main(
+    player_count: int = typer.Option(5, "--player-count", min=1, help="Players crawled per region"),
+):
+    """Check AsyncLeagueClient against in-process mock Riot API servers."""
+    server = start_mock_server(0.0)
+    failing_server = start_mock_server(1.0)
+    try:
+        asyncio.run(check_regions(get_base_url(server), player_count))
+        asyncio.run(check_circuit_breaker(get_base_url(failing_server)))
+    finally:
+        server.shutdown()
+        failing_server.shutdown()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,96 @@
+import logging
+import math
+import multiprocessing
+import tempfile
+import threading
+
+import structlog
+import typer
+
+from script.mock_riot_server import LOBBY_COUNT, MockRiotServer
+from src.client import LeagueClient, RegionGroup
+from src.rate_limit import parse_rate_limit_header
+
+# Small limits, so that a run spends the whole budget of the long window within seconds
+APP_RATE_LIMIT = "10:1,50:10"
+METHOD_RATE_LIMIT = "2000:10"
+PUUID = "NA1-DIAMOND-I-0"
+
+
+def request_match_ids(base_url: str, rate_limit_directory: str | None, request_count: int):
+    # Each process is one crawler using the API key, as if started separately
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR))
+    league_client = LeagueClient(
+        "key", base_url=base_url, rate_limit_directory=rate_limit_directory
+    )
+    for _ in range(request_count):
+        league_client.get_match_ids_by_puuid(RegionGroup.AMERICAS, PUUID, count=1)
+    league_client.close()
+
+
+def get_allowed_request_count(duration: float) -> int:
+    # The most requests that the app limit lets through from the first to the last one, as every
+    # window can be filled once per period started within that time
+    return min(
+        limit * (math.floor(duration / period) + 1)
+        for period, limit in parse_rate_limit_header(APP_RATE_LIMIT).items()
+    )
+
+
+def run(process_count: int, request_count: int, is_shared: bool) -> dict:
+    server = MockRiotServer(
+        ("127.0.0.1", 0), 10, LOBBY_COUNT, APP_RATE_LIMIT, METHOD_RATE_LIMIT, 0.0, 0.0, 0.0, False
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    # Spawned processes start without the parent's state, like separately started crawlers
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as rate_limit_directory:
+        processes = [
+            context.Process(
+                target=request_match_ids,
+                args=(
+                    f"http://{host}:{port}",
+                    rate_limit_directory if is_shared else None,
+                    request_count,
+                ),
+            )
+            for _ in range(process_count)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    server.shutdown()
+    server.server_close()
+    accepted_request_times = server.accepted_request_times
+    duration = accepted_request_times[-1] - accepted_request_times[0]
+    return {
+        "accepted": len(accepted_request_times),
+        "rejected": server.rejected_request_count,
+        "duration": duration,
+        "allowed": get_allowed_request_count(duration),
+    }
+
+
+def main(
+    process_count: int = typer.Option(2, "--process-count", min=1, help="Crawler processes"),
+    request_count: int = typer.Option(
+        100, "--request-count", min=1, help="Requests sent by each process"
+    ),
+):
+    """Check that crawler processes sharing a rate limit directory stay within the app limit."""
+    print(f"App rate limit {APP_RATE_LIMIT}, {process_count} processes x {request_count} requests")
+    for is_shared in (False, True):
+        result = run(process_count, request_count, is_shared)
+        print(
+            f"{'shared' if is_shared else 'separate'} windows: "
+            f"{result['rejected']} requests rejected with 429, "
+            f"{result['accepted']} accepted in {result['duration']:.1f} s, "
+            f"{result['accepted'] / result['allowed']:.0%} of the "
+            f"{result['allowed']} requests the limit allows in that time"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,7 @@
+while IFS='=' read -r key value; do export "${key?}"="${value?}"; done < .env
+
+uv run python -m script.mock_riot_server --port=8080 &
+trap 'kill $!' EXIT
+sleep 1
+
+uv run crawl_matches.py --region=NA1 --region=KR --tier=CHALLENGER --tier=GRANDMASTER --base-url=http://127.0.0.1:8080
@@ -0,0 +1,451 @@
+import gzip
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import typer
+
+from src.client import Division, LeagueClient, QueueId, Region, RegionGroup, Tier
+from src.rate_limit import RateLimiter, parse_rate_limit_header
+
+LEAGUE_PAGE_SIZE = 205
+PUUID_LENGTH = 78
+# A player may play one match per slot, and the players in the same lobby of a slot play together.
+# Fewer lobbies put more tracked players in each match
+MATCH_SLOT_PERIOD = timedelta(minutes=30)
+LOBBY_COUNT = 20
+LOBBY_COUNT_MAXIMUM = 1000
+LOBBY_CACHE_SIZE = 1000
+# Players play this many matches per week on average, spread log-normally
+MEDIAN_WEEKLY_MATCH_COUNT = 25
+WEEKLY_MATCH_COUNT_SIGMA = 0.8
+# Besides the fields the crawler reads, participants carry about as many stats and challenges as
+# real ones, so that payloads are about as large
+PARTICIPANT_STAT_COUNT = 130
+PARTICIPANT_CHALLENGE_COUNT = 125
+GAME_VERSION = "15.1.650.5225"
+LEAGUE_PATTERN = re.compile(r"^/lol/league-exp/v4/entries/(\w+)/(\w+)/(\w+)$")
+MATCH_IDS_PATTERN = re.compile(r"^/lol/match/v5/matches/by-puuid/([^/]+)/ids$")
+MATCH_PATTERN = re.compile(r"^/lol/match/v5/matches/([^/]+)$")
+
+
+class RateLimitCounter:
+    def __init__(self, limits: dict[int, int]):
+        # Request times of each window, by period in seconds
+        self.limits = limits
+        self._times_by_period = {period: deque() for period in limits}
+
+    def count(self, moment: float) -> tuple[dict[int, int], float]:
+        # Records the request if every window allows it, and returns the counts with it and how
+        # long to retry after if it was refused
+        retry_after = 0.0
+        for period, limit in self.limits.items():
+            times = self._times_by_period[period]
+            while len(times) > 0 and times[0] <= moment - period:
+                times.popleft()
+            if len(times) >= limit:
+                retry_after = max(retry_after, times[0] + period - moment)
+        if retry_after == 0:
+            for times in self._times_by_period.values():
+                times.append(moment)
+        counts = {period: len(times) for period, times in self._times_by_period.items()}
+        return counts, retry_after
+
+
+def format_rate_limit_header(counts: dict[int, int]) -> str:
+    return ",".join(f"{count}:{period}" for period, count in counts.items())
+
+
+def make_puuid(region: Region, tier: Tier, division: Division, index: int) -> str:
+    return f"{region.name}-{tier.value}-{division.value}-{index}-".ljust(PUUID_LENGTH, "x")
+
+
+def get_region(puuid: str) -> Region | None:
+    region_name = puuid.split("-", 1)[0]
+    return Region[region_name] if region_name in Region.__members__ else None
+
+
+class MockRiotServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        players_per_division: int,
+        lobby_count: int,
+        app_rate_limit: str,
+        method_rate_limit: str,
+        latency: float,
+        error_rate: float,
+        not_found_rate: float,
+        verbose: bool,
+    ):
+        super().__init__(address, MockRiotRequestHandler)
+        self.players_per_division = players_per_division
+        self.lobby_count = lobby_count
+        self.latency = latency
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.verbose = verbose
+        self._app_limits = parse_rate_limit_header(app_rate_limit)
+        self._method_limits = parse_rate_limit_header(method_rate_limit)
+        # Limits are counted per routing value and per method, like the real API does
+        self._counter_by_key: dict[tuple[str, str | None], RateLimitCounter] = {}
+        self.accepted_request_times: list[float] = []
+        self.rejected_request_count = 0
+        # Matches are made of the players the crawler knows of, i.e. those of the leagues served
+        self._puuids_by_region: dict[Region, dict[str, None]] = {}
+        self._play_chance_by_puuid: dict[str, float] = {}
+        self._lobbies_by_key: dict[tuple[Region, int, int], dict[int, list[str]]] = {}
+        self._lock = threading.Lock()
+
+    def count_request(self, routing: str, method: str) -> tuple[dict[str, str], float, str | None]:
+        # Returns the rate limit headers, how long to retry after and which limit was exceeded
+        moment = time.time()
+        with self._lock:
+            app_counter = self._get_counter((routing, None), self._app_limits)
+            method_counter = self._get_counter((routing, method), self._method_limits)
+            app_counts, app_retry_after = app_counter.count(moment)
+            method_counts, method_retry_after = (
+                method_counter.count(moment) if app_retry_after == 0 else ({}, 0.0)
+            )
+            if app_retry_after > 0 or method_retry_after > 0:
+                self.rejected_request_count += 1
+            else:
+                self.accepted_request_times.append(moment)
+        headers = {
+            RateLimiter.HEADER_APP_LIMIT: format_rate_limit_header(self._app_limits),
+            RateLimiter.HEADER_APP_COUNT: format_rate_limit_header(app_counts),
+            RateLimiter.HEADER_METHOD_LIMIT: format_rate_limit_header(self._method_limits),
+        }
+        if method_counts:
+            headers[RateLimiter.HEADER_METHOD_COUNT] = format_rate_limit_header(method_counts)
+        if app_retry_after > 0:
+            return headers, app_retry_after, "application"
+        if method_retry_after > 0:
+            return headers, method_retry_after, "method"
+        return headers, 0.0, None
+
+    def handle_error(self, request, client_address):
+        # Crawlers that stop mid request reset their connections, which is not worth a traceback
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def get_league(self, region: Region, queue: str, tier: Tier, division: Division, page: int):
+        if tier.is_apex_tier() and division != Division.I:
+            return []
+        start = (page - 1) * LEAGUE_PAGE_SIZE
+        end = min(page * LEAGUE_PAGE_SIZE, self.players_per_division)
+        # League points move every day, so that consecutive snapshots are not all unchanged
+        day = int(time.time() // timedelta(days=1).total_seconds())
+        entries = []
+        for index in range(start, end):
+            puuid = make_puuid(region, tier, division, index)
+            with self._lock:
+                self._puuids_by_region.setdefault(region, {})[puuid] = None
+            random_ = random.Random(f"{puuid}:{day}")
+            wins = random_.randint(50, 500)
+            entries.append(
+                {
+                    "leagueId": f"{region.value}-{tier.value}-{division.value}",
+                    "queueType": queue,
+                    "tier": tier.value,
+                    "rank": division.value,
+                    "puuid": puuid,
+                    "leaguePoints": random_.randint(0, 1500 if tier.is_apex_tier() else 99),
+                    "wins": wins,
+                    "losses": wins + random_.randint(-50, 50),
+                    "veteran": random_.random() < 0.1,
+                    "inactive": False,
+                    "freshBlood": random_.random() < 0.1,
+                    "hotStreak": random_.random() < 0.1,
+                }
+            )
+        return entries
+
+    def get_match_ids(self, puuid: str, start_time: int, end_time: int, start: int, count: int):
+        region = get_region(puuid)
+        if region is None:
+            return []
+        slot_seconds = MATCH_SLOT_PERIOD.total_seconds()
+        # Slots are listed from the last one that ended, most recent first like the real API
+        match_ids = []
+        last_slot = int(min(end_time, time.time()) // slot_seconds) - 1
+        first_slot = max(int(math.ceil(start_time / slot_seconds)) - 1, 0)
+        for slot in range(last_slot, first_slot - 1, -1):
+            lobby = self._get_lobby(puuid, slot)
+            if lobby is None:
+                continue
+            match_ids.append(f"{region.name}_{slot * LOBBY_COUNT_MAXIMUM + lobby}")
+            if len(match_ids) >= start + count:
+                break
+        return match_ids[start : start + count]
+
+    def get_match(self, match_id: str) -> dict | None:
+        platform, _, number = match_id.partition("_")
+        if platform not in Region.__members__ or not number.isdigit():
+            return None
+        slot, lobby = divmod(int(number), LOBBY_COUNT_MAXIMUM)
+        slot_seconds = MATCH_SLOT_PERIOD.total_seconds()
+        if (slot + 1) * slot_seconds > time.time():
+            return None
+        random_ = random.Random(match_id)
+        puuids = self._get_lobbies(Region[platform], slot).get(lobby, [])[:10]
+        while len(puuids) < 10:
+            puuids.append(
+                f"{platform}-UNTRACKED-{random_.getrandbits(64):x}-".ljust(PUUID_LENGTH, "x")
+            )
+        random_.shuffle(puuids)
+        game_duration = random_.randint(900, 2400)
+        game_end_timestamp = int(((slot + 1) * slot_seconds - random_.uniform(0, 60)) * 1000)
+        game_start_timestamp = game_end_timestamp - game_duration * 1000
+        winning_team_id = random_.choice([100, 200])
+        participants = []
+        for i, puuid in enumerate(puuids):
+            team_id = 100 if i < 5 else 200
+            participant = {
+                "participantId": i + 1,
+                "puuid": puuid,
+                "riotIdGameName": f"player{random_.getrandbits(32):x}",
+                "riotIdTagline": platform,
+                "teamId": team_id,
+                "teamPosition": ["TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY"][i % 5],
+                "individualPosition": ["TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY"][i % 5],
+                "championId": random_.randint(1, 950),
+                "championName": f"Champion{random_.randint(1, 170)}",
+                "win": team_id == winning_team_id,
+                "kills": random_.randint(0, 20),
+                "deaths": random_.randint(0, 15),
+                "assists": random_.randint(0, 25),
+                "champLevel": random_.randint(8, 18),
+                "goldEarned": random_.randint(5000, 20000),
+                "totalMinionsKilled": random_.randint(0, 350),
+                "neutralMinionsKilled": random_.randint(0, 200),
+                "totalDamageDealtToChampions": random_.randint(2000, 60000),
+                "visionScore": random_.randint(5, 120),
+            }
+            for j in range(PARTICIPANT_STAT_COUNT):
+                participant[f"stat{j}"] = random_.randint(0, 100_000)
+            participant["challenges"] = {
+                f"challenge{j}": round(random_.random() * 100, 6)
+                for j in range(PARTICIPANT_CHALLENGE_COUNT)
+            }
+            participants.append(participant)
+        return {
+            "metadata": {"dataVersion": "2", "matchId": match_id, "participants": puuids},
+            "info": {
+                "endOfGameResult": "GameComplete",
+                "gameCreation": game_start_timestamp - 60_000,
+                "gameDuration": game_duration,
+                "gameEndTimestamp": game_end_timestamp,
+                "gameId": int(number),
+                "gameMode": "CLASSIC",
+                "gameStartTimestamp": game_start_timestamp,
+                "gameType": "MATCHED_GAME",
+                "gameVersion": GAME_VERSION,
+                "mapId": 11,
+                "participants": participants,
+                "platformId": platform,
+                "queueId": QueueId.RANKED_SOLO_5x5.value,
+                "teams": [
+                    {"teamId": team_id, "win": team_id == winning_team_id, "bans": []}
+                    for team_id in (100, 200)
+                ],
+            },
+        }
+
+    def _get_lobby(self, puuid: str, slot: int) -> int | None:
+        # Which lobby the player plays in during the slot, if any, from a hash of both
+        play_chance = self._play_chance_by_puuid.get(puuid)
+        if play_chance is None:
+            weekly_match_count = random.Random(puuid).lognormvariate(
+                math.log(MEDIAN_WEEKLY_MATCH_COUNT), WEEKLY_MATCH_COUNT_SIGMA
+            )
+            play_chance = min(weekly_match_count * MATCH_SLOT_PERIOD / timedelta(weeks=1), 1.0)
+            self._play_chance_by_puuid[puuid] = play_chance
+        digest = hashlib.blake2b(f"{puuid}:{slot}".encode(), digest_size=8).digest()
+        value = int.from_bytes(digest)
+        if (value & 0xFFFFFFFF) / 2**32 >= play_chance:
+            return None
+        return (value >> 32) % self.lobby_count
+
+    def _get_lobbies(self, region: Region, slot: int) -> dict[int, list[str]]:
+        # Kept until more players are known, since every match of the slot needs them
+        with self._lock:
+            puuids = list(self._puuids_by_region.get(region, {}))
+        key = (region, slot, len(puuids))
+        lobbies = self._lobbies_by_key.get(key)
+        if lobbies is None:
+            lobbies = {}
+            for puuid in puuids:
+                lobby = self._get_lobby(puuid, slot)
+                if lobby is not None:
+                    lobbies.setdefault(lobby, []).append(puuid)
+            with self._lock:
+                if len(self._lobbies_by_key) >= LOBBY_CACHE_SIZE:
+                    del self._lobbies_by_key[next(iter(self._lobbies_by_key))]
+                self._lobbies_by_key[key] = lobbies
+        return lobbies
+
+    def _get_counter(self, key: tuple[str, str | None], limits: dict[int, int]):
+        if key not in self._counter_by_key:
+            self._counter_by_key[key] = RateLimitCounter(limits)
+        return self._counter_by_key[key]
+
+
+class MockRiotRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive like the real API, which the client's sessions rely on
+    protocol_version = "HTTP/1.1"
+    server: MockRiotServer
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        # The routing value comes first, followed by the path of the real API
+        _, routing, path = f"{url.path}//".split("/", 2)
+        path = f"/{path.rstrip('/')}"
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.headers.get(LeagueClient.HEADER_API_KEY) is None:
+            self._send_json(401, {"status": {"message": "Unauthorized", "status_code": 401}})
+            return
+        method, handle = self._route(routing, path, params)
+        if handle is None:
+            self._send_json(404, {"status": {"message": "Not found", "status_code": 404}})
+            return
+        headers, retry_after, limit_type = self.server.count_request(routing, method)
+        if limit_type is not None:
+            headers[LeagueClient.HEADER_RETRY_AFTER] = str(math.ceil(retry_after))
+            headers[RateLimiter.HEADER_LIMIT_TYPE] = limit_type
+            self._send_json(
+                429, {"status": {"message": "Rate limit exceeded", "status_code": 429}}, headers
+            )
+            return
+        time.sleep(random.uniform(0.5, 1.5) * self.server.latency)
+        if random.random() < self.server.error_rate:
+            self._send_json(
+                503, {"status": {"message": "Service unavailable", "status_code": 503}}, headers
+            )
+            return
+        body = handle()
+        if body is None:
+            self._send_json(
+                404, {"status": {"message": "Data not found", "status_code": 404}}, headers
+            )
+            return
+        self._send_json(200, body, headers)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _route(self, routing: str, path: str, params: dict[str, str]):
+        # Returns the method the request counts against and how to answer it
+        if match_ := LEAGUE_PATTERN.match(path):
+            if routing not in (region.value for region in Region):
+                return None, None
+            queue, tier, division = match_.groups()
+            if tier not in Tier.__members__ or division not in Division.__members__:
+                return None, None
+            return LeagueClient.METHOD_GET_LEAGUE, partial(
+                self.server.get_league,
+                Region(routing),
+                queue,
+                Tier[tier],
+                Division[division],
+                int(params.get("page", 1)),
+            )
+        if routing not in (region_group.value for region_group in RegionGroup):
+            return None, None
+        if match_ := MATCH_IDS_PATTERN.match(path):
+            return LeagueClient.METHOD_GET_MATCH_IDS_BY_PUUID, partial(
+                self.server.get_match_ids,
+                match_.group(1),
+                int(params.get("startTime", 0)),
+                int(params.get("endTime", time.time())),
+                int(params.get("start", 0)),
+                min(int(params.get("count", 20)), 100),
+            )
+        if match_ := MATCH_PATTERN.match(path):
+            return LeagueClient.METHOD_GET_MATCH, partial(self._get_match, match_.group(1))
+        return None, None
+
+    def _get_match(self, match_id: str):
+        if random.random() < self.server.not_found_rate:
+            return None
+        return self.server.get_match(match_id)
+
+    def _send_json(self, status_code: int, body, headers: dict[str, str] | None = None):
+        content = json.dumps(body).encode()
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content, compresslevel=1)
+            headers = {**(headers or {}), "Content-Encoding": "gzip"}
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main(
+    host: str = typer.Option("127.0.0.1", "--host", help="Address to listen on"),
+    port: int = typer.Option(8080, "--port", help="Port to listen on"),
+    players_per_division: int = typer.Option(
+        1000, "--players-per-division", min=0, help="League entries of each tier and division"
+    ),
+    lobby_count: int = typer.Option(
+        LOBBY_COUNT,
+        "--lobby-count",
+        min=1,
+        max=LOBBY_COUNT_MAXIMUM,
+        help="Matches played by the players of a region at a time",
+    ),
+    app_rate_limit: str = typer.Option(
+        "20:1,100:120", "--app-rate-limit", help="Application rate limit, as in the header"
+    ),
+    method_rate_limit: str = typer.Option(
+        "2000:10", "--method-rate-limit", help="Rate limit of every method, as in the header"
+    ),
+    latency: float = typer.Option(0.05, "--latency", min=0, help="Mean response time in seconds"),
+    error_rate: float = typer.Option(
+        0.0, "--error-rate", min=0, max=1, help="Share of requests answered with a 503"
+    ),
+    not_found_rate: float = typer.Option(
+        0.0, "--not-found-rate", min=0, max=1, help="Share of match requests answered with a 404"
+    ),
+    verbose: bool = typer.Option(False, "--verbose", help="Log every request"),
+):
+    """Serve the Riot API endpoints used by the crawler with synthetic data."""
+    server = MockRiotServer(
+        (host, port),
+        players_per_division,
+        lobby_count,
+        app_rate_limit,
+        method_rate_limit,
+        latency,
+        error_rate,
+        not_found_rate,
+        verbose,
+    )
+    print(f"Serving a mock Riot API on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1 @@
+sudo docker exec -i postgres psql -U postgres -d postgres < refresh_simplified_matches_table.sql
\ No newline at end of file
@@ -0,0 +1,420 @@
+import csv
+import json
+import math
+import random
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+import typer
+
+from src.client import Division, MatchType, QueueId, Region, RegionGroup, Tier
+from src.crawl import LEAGUE_CRAWL_INTERVAL, LEAGUE_PAGE_LOOKAHEAD, CrawlState
+from src.estimator import MatchCountEstimatorKind, create_match_count_estimator
+from src.player import MATCH_TIME_WINDOW
+from src.scheduler import PlayerScheduler
+
+LEAGUE_PAGE_SIZE = 205
+# A fixed Monday, so that synthetic runs do not depend on when they are run
+SIMULATION_START = datetime(2025, 1, 6, tzinfo=timezone.utc)
+REGION = Region.NA1
+PUUID_LENGTH = 78
+# Synthetic players play this many matches per week on average, spread log-normally
+MEDIAN_WEEKLY_MATCH_COUNT = 25
+WEEKLY_MATCH_COUNT_SIGMA = 0.8
+WEEKLY_MATCH_COUNT_MAXIMUM = 300
+# Synthetic matches are played the most at this hour in UTC, and this much less at the opposite
+PEAK_HOUR = 2
+ACTIVITY_AMPLITUDE = 0.8
+
+
+@dataclass
+class SimulationPolicy:
+    name: str
+    match_count_estimator_kind: MatchCountEstimatorKind = MatchCountEstimatorKind.LINEAR
+    incremental_match_ids: bool = False
+    stale_period: timedelta = PlayerScheduler.STALE_PERIOD
+    league_crawl_interval: timedelta = LEAGUE_CRAWL_INTERVAL
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in [
+        SimulationPolicy("linear"),
+        SimulationPolicy("adaptive", MatchCountEstimatorKind.ADAPTIVE),
+        SimulationPolicy("linear-incremental", incremental_match_ids=True),
+        SimulationPolicy(
+            "adaptive-incremental", MatchCountEstimatorKind.ADAPTIVE, incremental_match_ids=True
+        ),
+        SimulationPolicy(
+            "adaptive-incremental-unstale",
+            MatchCountEstimatorKind.ADAPTIVE,
+            incremental_match_ids=True,
+            stale_period=MATCH_TIME_WINDOW,
+        ),
+        SimulationPolicy(
+            "adaptive-incremental-weekly-leagues",
+            MatchCountEstimatorKind.ADAPTIVE,
+            incremental_match_ids=True,
+            league_crawl_interval=timedelta(days=7),
+        ),
+    ]
+}
+
+
+@dataclass
+class Activity:
+    start: datetime
+    end: datetime
+    league_entries: list[dict]
+    match_ids: list[str] = field(default_factory=list)
+    ended_ats: list[datetime] = field(default_factory=list)
+    participant_puuids: list[tuple[str, ...]] = field(default_factory=list)
+    index_by_match_id: dict[str, int] = field(default_factory=dict)
+    # Indices of the matches of each player, by end time
+    match_indices_by_puuid: dict[str, list[int]] = field(default_factory=dict)
+    timestamps_by_puuid: dict[str, list[float]] = field(default_factory=dict)
+
+    def add_match(self, match_id: str, ended_at: datetime, participant_puuids: tuple[str, ...]):
+        # Matches have to be added by end time
+        index = len(self.match_ids)
+        self.match_ids.append(match_id)
+        self.ended_ats.append(ended_at)
+        self.participant_puuids.append(participant_puuids)
+        self.index_by_match_id[match_id] = index
+        for puuid in participant_puuids:
+            self.match_indices_by_puuid.setdefault(puuid, []).append(index)
+            self.timestamps_by_puuid.setdefault(puuid, []).append(ended_at.timestamp())
+
+    def get_match_indices(self, puuid: str, since: datetime, moment: datetime) -> list[int]:
+        # Most recent first, like the match ids endpoint
+        timestamps = self.timestamps_by_puuid.get(puuid, [])
+        start = bisect_left(timestamps, since.timestamp())
+        end = bisect_right(timestamps, moment.timestamp())
+        return self.match_indices_by_puuid.get(puuid, [])[start:end][::-1]
+
+
+@dataclass
+class SimulationResult:
+    policy: str
+    request_count: int
+    match_count: int
+    matches_per_request: float
+    coverage: float
+    mean_staleness_hours: float
+    p95_staleness_hours: float
+    byte_count: int
+    seconds: float
+
+
+def generate_activity(
+    player_count: int, period: timedelta, tracked_participant_share: float, seed: int
+) -> Activity:
+    random_ = random.Random(seed)
+    tiers = [Tier.CHALLENGER, Tier.GRANDMASTER, Tier.MASTER]
+    league_entries = [
+        {
+            "puuid": f"puuid-{i}".ljust(PUUID_LENGTH, "x"),
+            "tier": random_.choice(tiers).value,
+            "rank": Division.I.value,
+        }
+        for i in range(player_count)
+    ]
+    puuids = [entry["puuid"] for entry in league_entries]
+    weekly_match_counts = [
+        min(
+            random_.lognormvariate(math.log(MEDIAN_WEEKLY_MATCH_COUNT), WEEKLY_MATCH_COUNT_SIGMA),
+            WEEKLY_MATCH_COUNT_MAXIMUM,
+        )
+        for _ in puuids
+    ]
+    cumulative_weights = list(accumulate(weekly_match_counts))
+    # Each match holds one tracked player plus a share of the other nine, so that matches are
+    # shared the way they are between players of the same leagues
+    tracked_participant_count = 1 + 9 * tracked_participant_share
+    matches_per_second = (
+        sum(weekly_match_counts) / tracked_participant_count / timedelta(days=7).total_seconds()
+    )
+    # Matches arrive as a Poisson process thinned by the hour of the day
+    maximum_matches_per_second = matches_per_second * (1 + ACTIVITY_AMPLITUDE)
+    activity = Activity(SIMULATION_START, SIMULATION_START + period, league_entries)
+    # Players already have a window of matches when the crawl starts
+    moment = (SIMULATION_START - MATCH_TIME_WINDOW).timestamp()
+    while True:
+        moment += random_.expovariate(maximum_matches_per_second)
+        if moment >= activity.end.timestamp():
+            break
+        hour_of_day = moment / 3600 % 24
+        weight = 1 + ACTIVITY_AMPLITUDE * math.cos(2 * math.pi * (hour_of_day - PEAK_HOUR) / 24)
+        if random_.random() * (1 + ACTIVITY_AMPLITUDE) > weight:
+            continue
+        participant_count = 1 + sum(random_.random() < tracked_participant_share for _ in range(9))
+        participant_puuids = random_.choices(
+            puuids, cum_weights=cumulative_weights, k=participant_count
+        )
+        activity.add_match(
+            f"{REGION.name}_{len(activity.match_ids) + 1}",
+            datetime.fromtimestamp(moment, timezone.utc),
+            tuple(dict.fromkeys(participant_puuids)),
+        )
+    return activity
+
+
+def load_activity(path: str) -> Activity:
+    # Rows of match_id, puuid and ended_at, such as exported from match_participants
+    participant_puuids_by_match_id: dict[str, list[str]] = {}
+    ended_at_by_match_id: dict[str, datetime] = {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            participant_puuids_by_match_id.setdefault(row["match_id"], []).append(row["puuid"])
+            ended_at_by_match_id[row["match_id"]] = datetime.fromisoformat(row["ended_at"])
+    match_ids = sorted(ended_at_by_match_id, key=ended_at_by_match_id.__getitem__)
+    puuids = dict.fromkeys(
+        puuid for match_id in match_ids for puuid in participant_puuids_by_match_id[match_id]
+    )
+    league_entries = [
+        {"puuid": puuid, "tier": Tier.CHALLENGER.value, "rank": Division.I.value}
+        for puuid in puuids
+    ]
+    activity = Activity(
+        ended_at_by_match_id[match_ids[0]], ended_at_by_match_id[match_ids[-1]], league_entries
+    )
+    for match_id in match_ids:
+        activity.add_match(
+            match_id,
+            ended_at_by_match_id[match_id],
+            tuple(dict.fromkeys(participant_puuids_by_match_id[match_id])),
+        )
+    return activity
+
+
+class SimulatedClient:
+    # Answers the match requests of a crawl from the activity on a virtual clock, where every
+    # request takes the time the rate limit of the region group host allows for it
+    def __init__(self, activity: Activity, request_period: timedelta, measurement_start: datetime):
+        self.moment = activity.start
+        self.request_count = 0
+        self._activity = activity
+        self._request_period = request_period
+        self._measurement_start = measurement_start
+
+    def get_time(self) -> datetime:
+        return self.moment
+
+    def get_match_ids_by_puuid(
+        self,
+        region_group: RegionGroup,
+        puuid: str,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        queue_id: QueueId | None = None,
+        match_type: MatchType | None = None,
+        start: int = 0,
+        count: int = 100,
+    ) -> list[str]:
+        self._count_request()
+        since = datetime.fromtimestamp(start_time or 0, timezone.utc)
+        match_indices = self._activity.get_match_indices(puuid, since, self.moment)
+        return [self._activity.match_ids[index] for index in match_indices[start : start + count]]
+
+    def get_match(self, match_id: str) -> int:
+        # Returns the index of the match in the activity
+        self._count_request()
+        return self._activity.index_by_match_id[match_id]
+
+    def _count_request(self):
+        self.moment += self._request_period
+        if self.moment >= self._measurement_start:
+            self.request_count += 1
+
+
+class SimulatedLeagueCrawl:
+    # League pages go to the platform host, whose rate limit is separate from that of the region
+    # group host, so they arrive while matches are crawled, as with LeagueCrawl. The pages past
+    # the last full one are fetched too, since the crawler only learns where a division ends
+    # from an empty page
+    def __init__(self, league_entries: list[dict], start: datetime, request_period: timedelta):
+        self._pages = [
+            league_entries[index : index + LEAGUE_PAGE_SIZE]
+            for index in range(0, len(league_entries), LEAGUE_PAGE_SIZE)
+        ]
+        self._request_times = [
+            start + (page + 1) * request_period
+            for page in range(len(self._pages) + LEAGUE_PAGE_LOOKAHEAD)
+        ]
+        self._next_page = 0
+
+    def collect(self, moment: datetime) -> tuple[list[dict], bool]:
+        # Returns the entries of the pages fetched by the moment and whether every page has been
+        league_entries = []
+        while self._next_page < len(self._pages) and self._request_times[self._next_page] <= moment:
+            league_entries.extend(self._pages[self._next_page])
+            self._next_page += 1
+        return league_entries, self._request_times[-1] <= moment
+
+    def get_next_time(self) -> datetime:
+        if self._next_page < len(self._pages):
+            return self._request_times[self._next_page]
+        return self._request_times[-1]
+
+    def count_requests_since(self, moment: datetime) -> int:
+        return sum(request_time >= moment for request_time in self._request_times)
+
+
+def simulate(
+    activity: Activity,
+    policy: SimulationPolicy,
+    warmup_period: timedelta,
+    requests_per_second: float,
+) -> SimulationResult:
+    # Runs the crawl steps of a single region with the crawler's own state on virtual clocks, one
+    # per routing host, each allowing the same number of requests per second
+    started_at = time.perf_counter()
+    request_period = timedelta(seconds=1 / requests_per_second)
+    measurement_start = activity.start + warmup_period
+    client = SimulatedClient(activity, request_period, measurement_start)
+    crawl_state = CrawlState(
+        REGION,
+        match_count_estimator=create_match_count_estimator(policy.match_count_estimator_kind),
+        league_crawl_interval=policy.league_crawl_interval,
+        stale_period=policy.stale_period,
+    )
+    # Stands in for the database, which the crawler asks about ids that may have expired
+    fetched_at_by_match_id: dict[str, datetime] = {}
+
+    def read_stored_match_ids(match_ids: list[str], since: datetime) -> set[str]:
+        return {match_id for match_id in match_ids if match_id in fetched_at_by_match_id}
+
+    league_crawl = None
+    league_request_count = 0
+    while client.moment < activity.end:
+        moment = client.moment
+        if league_crawl is None and crawl_state.is_league_outdated(moment):
+            league_crawl = SimulatedLeagueCrawl(activity.league_entries, moment, request_period)
+            league_request_count += league_crawl.count_requests_since(measurement_start)
+        if league_crawl is not None:
+            league_entries, is_league_crawl_done = league_crawl.collect(moment)
+            crawl_state.update_from_league_entries(league_entries, moment)
+            if is_league_crawl_done:
+                league_crawl = None
+                crawl_state.finish_league_crawl(moment)
+                continue
+        next_player = crawl_state.player_scheduler.pop_next_player(moment)
+        if next_player is None:
+            if league_crawl is not None:
+                client.moment = league_crawl.get_next_time()
+            else:
+                client.moment = crawl_state.get_next_league_crawl_time()
+            continue
+        player, _ = next_player
+        _, new_match_ids = crawl_state.crawl_new_match_ids(
+            client, player, read_stored_match_ids, policy.incremental_match_ids, client.get_time
+        )
+        crawl_state.player_scheduler.schedule(player)
+        # Most recent first, like the match ids endpoint
+        for match_id in sorted(
+            new_match_ids, key=activity.index_by_match_id.__getitem__, reverse=True
+        ):
+            index = client.get_match(match_id)
+            crawl_state.match_id_index.add(match_id, client.moment)
+            fetched_at_by_match_id[match_id] = client.moment
+            crawl_state.observe_participants(
+                player, activity.ended_ats[index], activity.participant_puuids[index]
+            )
+
+    # Matches are measured by when they ended, so that the warmup only fills the state
+    measured_match_indices = range(
+        bisect_left(activity.ended_ats, measurement_start), len(activity.match_ids)
+    )
+    staleness_hours = sorted(
+        (fetched_at_by_match_id[activity.match_ids[index]] - activity.ended_ats[index])
+        / timedelta(hours=1)
+        for index in measured_match_indices
+        if activity.match_ids[index] in fetched_at_by_match_id
+    )
+    match_count = len(staleness_hours)
+    request_count = client.request_count + league_request_count
+    return SimulationResult(
+        policy=policy.name,
+        request_count=request_count,
+        match_count=match_count,
+        matches_per_request=match_count / request_count if request_count else 0.0,
+        coverage=match_count / len(measured_match_indices) if measured_match_indices else 0.0,
+        mean_staleness_hours=sum(staleness_hours) / match_count if match_count else 0.0,
+        p95_staleness_hours=staleness_hours[int(0.95 * (match_count - 1))] if match_count else 0.0,
+        byte_count=(
+            crawl_state.player_registry.get_byte_count()
+            + crawl_state.match_id_index.get_statistics().byte_count
+        ),
+        seconds=time.perf_counter() - started_at,
+    )
+
+
+def main(
+    policy_names: list[str] = typer.Option(
+        list(POLICIES), "--policy", help=f"Policies to simulate, among {', '.join(POLICIES)}"
+    ),
+    activity_path: str | None = typer.Option(
+        None,
+        "--activity",
+        help="CSV of match_id, puuid and ended_at to replay instead of synthetic activity",
+    ),
+    player_count: int = typer.Option(2000, "--player-count", min=1, help="Synthetic players"),
+    days: float = typer.Option(14, "--days", min=1, help="Synthetic days, warmup included"),
+    tracked_participant_share: float = typer.Option(
+        0.3,
+        "--tracked-participant-share",
+        min=0,
+        max=1,
+        help="Chance for each other participant of a synthetic match to be tracked",
+    ),
+    warmup_days: float = typer.Option(
+        MATCH_TIME_WINDOW.days, "--warmup-days", min=0, help="Days left out of the results"
+    ),
+    requests_per_second: float = typer.Option(
+        0.05, "--requests-per-second", min=0.001, help="Rate limit shared by every request"
+    ),
+    seed: int = typer.Option(0, "--seed", help="Seed for the synthetic activity"),
+    output_path: str | None = typer.Option(
+        None, "--output", help="JSON file to write the results to"
+    ),
+):
+    """Replay player activity against the crawl scheduler and compare policies."""
+    unknown_policy_names = set(policy_names) - set(POLICIES)
+    if unknown_policy_names:
+        raise typer.BadParameter(f"Unknown policies: {', '.join(sorted(unknown_policy_names))}")
+    if activity_path is None:
+        activity = generate_activity(
+            player_count, timedelta(days=days), tracked_participant_share, seed
+        )
+    else:
+        activity = load_activity(activity_path)
+    print(
+        f"{len(activity.league_entries)} players, {len(activity.match_ids)} matches "
+        f"from {activity.start.isoformat()} to {activity.end.isoformat()}"
+    )
+    results = []
+    for policy_name in policy_names:
+        result = simulate(
+            activity, POLICIES[policy_name], timedelta(days=warmup_days), requests_per_second
+        )
+        results.append(result)
+        print(
+            f"{result.policy:>36}: "
+            f"{result.matches_per_request:.3f} matches/request "
+            f"({result.match_count} in {result.request_count} requests), "
+            f"coverage {result.coverage:.1%}, "
+            f"staleness {result.mean_staleness_hours:.1f} h mean "
+            f"{result.p95_staleness_hours:.1f} h p95, "
+            f"{result.byte_count / 1e6:.1f} MB, "
+            f"{result.seconds:.1f} s"
+        )
+    if output_path is not None:
+        with open(output_path, "w") as file:
+            json.dump([asdict(result) for result in results], file, indent=2)
+
+
+if __name__ == "__main__":
+    typer.run(main)
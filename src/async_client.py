@@ -0,0 +1,253 @@
+import asyncio
+
+import aiohttp
+import structlog
+from urllib3.util import make_headers
+
+from src.client import (
+    Division,
+    LeagueClient,
+    MatchType,
+    Queue,
+    QueueId,
+    RawMatch,
+    Region,
+    RegionGroup,
+    Tier,
+)
+from src.rate_limit import RateLimiter
+from src.retry import (
+    TOO_MANY_REQUESTS_STATUS_CODE,
+    CircuitBreaker,
+    get_backoff,
+    get_retry_after,
+    is_retryable_status_code,
+    is_server_error_status_code,
+)
+
+logger = structlog.get_logger()
+
+
+# The asyncio counterpart of LeagueClient for callers that run an event loop. crawl_matches.py
+# runs on threads and uses LeagueClient, so changes to either client are made to both
+class AsyncLeagueClient:
+    MAX_RETRIES = LeagueClient.MAX_RETRIES
+    HEADER_API_KEY = LeagueClient.HEADER_API_KEY
+    HEADER_RETRY_AFTER = LeagueClient.HEADER_RETRY_AFTER
+    DEFAULT_POOL_SIZE = LeagueClient.DEFAULT_POOL_SIZE
+    DEFAULT_TIMEOUT = LeagueClient.DEFAULT_TIMEOUT
+
+    def __init__(
+        self,
+        api_key: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: float = DEFAULT_TIMEOUT,
+        circuit_breaker: CircuitBreaker | None = None,
+        rate_limit_directory: str | None = None,
+        base_url: str | None = None,
+    ):
+        self._api_key = api_key
+        # As in LeagueClient, rate limits are kept per Riot host when a base URL replaces it
+        self._base_url = base_url.rstrip("/") if base_url is not None else None
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._session: aiohttp.ClientSession | None = None
+        # Riot enforces rate limits per routing host, so each host gets its own windows and one
+        # event loop can keep requests to every host in flight at the same time
+        self._rate_limiter = RateLimiter(rate_limit_directory)
+
+    async def __aenter__(self) -> "AsyncLeagueClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_league(
+        self, region: Region, queue: Queue, tier: Tier, division: Division, page: int = 1
+    ):
+        url = self._get_url(
+            region, f"/lol/league-exp/v4/entries/{queue.value}/{tier.value}/{division.value}"
+        )
+        params = {"page": page}
+        league = await self.get(
+            url,
+            params=params,
+            method=LeagueClient.METHOD_GET_LEAGUE,
+            host=LeagueClient.get_host(region),
+        )
+        return league
+
+    async def get_match_ids_by_puuid(
+        self,
+        region_group: RegionGroup,
+        puuid: str,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        queue_id: QueueId | None = None,
+        match_type: MatchType | None = None,
+        start: int = 0,
+        count: int = 100,
+    ):
+        assert 0 <= start, "Start must be greater than or equal to 0"
+        assert 0 <= count <= 100, "Count must be between 0 and 100"
+        url = self._get_url(region_group, f"/lol/match/v5/matches/by-puuid/{puuid}/ids")
+        params = {
+            "startTime": start_time,
+            "endTime": end_time,
+            "queue": queue_id.value if queue_id else None,
+            "type": match_type.value if match_type else None,
+            "start": start,
+            "count": count,
+        }
+        match_ids = await self.get(
+            url,
+            params=params,
+            method=LeagueClient.METHOD_GET_MATCH_IDS_BY_PUUID,
+            host=LeagueClient.get_host(region_group),
+        )
+        return match_ids
+
+    async def get_match(self, region_group: RegionGroup, match_id: str):
+        url = self._get_url(region_group, f"/lol/match/v5/matches/{match_id}")
+        match_ = await self.get(
+            url, method=LeagueClient.METHOD_GET_MATCH, host=LeagueClient.get_host(region_group)
+        )
+        return match_
+
+    async def get_raw_match(self, region_group: RegionGroup, match_id: str) -> RawMatch | None:
+        url = self._get_url(region_group, f"/lol/match/v5/matches/{match_id}")
+        content = await self.get(
+            url,
+            method=LeagueClient.METHOD_GET_MATCH,
+            raw=True,
+            host=LeagueClient.get_host(region_group),
+        )
+        return RawMatch.from_content(content) if content is not None else None
+
+    def get_wait_time(self, host: str, method: str | None = None) -> float:
+        wait_for = self._rate_limiter.get_wait_time(host, method)
+        return max(wait_for, self._circuit_breaker.get_retry_after(host))
+
+    def get_hosts(self) -> list[str]:
+        return self._rate_limiter.get_hosts()
+
+    def get_request_count(self, host: str | None = None) -> int:
+        return self._rate_limiter.get_request_count(host)
+
+    def get_allowed_requests_per_second(self, host: str) -> float | None:
+        return self._rate_limiter.get_allowed_requests_per_second(host)
+
+    async def get(
+        self,
+        url: str,
+        host: str,
+        params: dict | None = None,
+        method: str | None = None,
+        raw: bool = False,
+    ):
+        # Unlike requests, aiohttp refuses None query parameters instead of dropping them
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        for attempt in range(AsyncLeagueClient.MAX_RETRIES + 1):
+            self._circuit_breaker.check(host)
+            await self._wait_if_needed(host, method)
+            local_logger = logger.bind(
+                attempt=attempt + 1, max_attempt=AsyncLeagueClient.MAX_RETRIES, url=url
+            )
+            try:
+                async with self._get_session().get(url, params=params) as response:
+                    self._rate_limiter.update(host, method, response.headers)
+                    response.raise_for_status()
+                    body = await response.read() if raw else await response.json(content_type=None)
+                    self._circuit_breaker.record_success(host)
+                    return body
+            except aiohttp.ClientResponseError as e:
+                status_code = e.status
+                headers = e.headers or {}
+                local_logger.warning(
+                    "HTTP error occurred",
+                    error_type=e.__class__.__name__,
+                    error_message=str(e),
+                    status_code=status_code,
+                )
+                if not is_retryable_status_code(status_code):
+                    self._circuit_breaker.record_success(host)
+                    local_logger.warning("Non-retryable HTTP error. Raising exception")
+                    raise
+                if is_server_error_status_code(status_code):
+                    self._circuit_breaker.record_failure(host)
+                if attempt >= AsyncLeagueClient.MAX_RETRIES:
+                    local_logger.exception("Max retries exceeded. Raising exception")
+                    raise
+                if status_code == TOO_MANY_REQUESTS_STATUS_CODE:
+                    retry_after = get_retry_after(
+                        headers.get(AsyncLeagueClient.HEADER_RETRY_AFTER), attempt
+                    )
+                    self._rate_limiter.block(host, method, headers, retry_after)
+                else:
+                    retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
+                await asyncio.sleep(retry_after)
+            except (TimeoutError, aiohttp.ClientConnectionError) as e:
+                local_logger.warning(
+                    "Request timed out or failed to connect",
+                    error_type=e.__class__.__name__,
+                    error_message=str(e),
+                )
+                self._circuit_breaker.record_failure(host)
+                if attempt >= AsyncLeagueClient.MAX_RETRIES:
+                    local_logger.exception("Max retries exceeded. Raising exception")
+                    raise
+                retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
+                await asyncio.sleep(retry_after)
+            except Exception as e:
+                local_logger.exception(
+                    "An unexpected error occurred",
+                    error_type=e.__class__.__name__,
+                    error_message=str(e),
+                )
+                if attempt >= AsyncLeagueClient.MAX_RETRIES:
+                    local_logger.exception("Max retries exceeded. Raising exception")
+                    raise
+                retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
+                await asyncio.sleep(retry_after)
+        return None
+
+    def _get_url(self, routing: Region | RegionGroup, path: str) -> str:
+        if self._base_url is None:
+            return f"https://{LeagueClient.get_host(routing)}{path}"
+        return f"{self._base_url}/{routing.value}{path}"
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session is created lazily because it must be bound to the running event loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self._pool_size)
+            headers = make_headers(keep_alive=True, accept_encoding=True)
+            headers[AsyncLeagueClient.HEADER_API_KEY] = self._api_key
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=headers, timeout=timeout
+            )
+        return self._session
+
+    async def _wait_if_needed(self, host: str, method: str | None):
+        while True:
+            wait_for, period, limit = self._rate_limiter.reserve(host, method)
+            if wait_for <= 0:
+                return
+            logger.info(
+                f"Rate limit reached. Waiting preventatively for {wait_for} seconds before sending request",
+                wait_time=wait_for,
+                host=host,
+                method=method,
+                period=period,
+                limit=limit,
+            )
+            await asyncio.sleep(wait_for)
@@ -1,15 +1,39 @@
+import json
+import re
+import threading
 import time
-from datetime import datetime, timedelta
+from dataclasses import dataclass
 from enum import Enum
 from typing import Self
 
 import requests
 import structlog
-
-from src.util import now
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from src.rate_limit import RateLimiter
+from src.retry import (
+    TOO_MANY_REQUESTS_STATUS_CODE,
+    CircuitBreaker,
+    get_backoff,
+    get_retry_after,
+    is_retryable_status_code,
+    is_server_error_status_code,
+)
 
 logger = structlog.get_logger()
 
+# Each field occurs once in a match and none of the values contain escaped characters
+RAW_MATCH_ID_PATTERN = re.compile(rb'"matchId"\s*:\s*"([^"]*)"')
+RAW_GAME_END_TIMESTAMP_PATTERN = re.compile(rb'"gameEndTimestamp"\s*:\s*(\d+)')
+RAW_PLATFORM_ID_PATTERN = re.compile(rb'"platformId"\s*:\s*"([^"]*)"')
+RAW_GAME_VERSION_PATTERN = re.compile(rb'"gameVersion"\s*:\s*"([^"]*)"')
+RAW_QUEUE_ID_PATTERN = re.compile(rb'"queueId"\s*:\s*(\d+)')
+# The metadata lists the participants as strings, while the info lists them as objects, so only
+# the puuids of the metadata match
+RAW_PARTICIPANT_PUUIDS_PATTERN = re.compile(rb'"participants"\s*:\s*\[((?:\s*"[^"]*"\s*,?)*)\]')
+RAW_STRING_PATTERN = re.compile(rb'"([^"]*)"')
+
 
 class Region(Enum):
     BR1 = "br1"
@@ -114,24 +138,102 @@ class Division(Enum):
     IV = "IV"
 
 
+@dataclass
+class RawMatch:
+    # A match as sent by the API, with only the fields stored in their own columns parsed out
+    content: bytes
+    match_id: str
+    game_end_timestamp: int
+    platform_id: str
+    game_version: str
+    queue_id: int
+    participant_puuids: tuple[str, ...] = ()
+
+    @classmethod
+    def from_content(cls, content: bytes) -> Self:
+        match_id = RAW_MATCH_ID_PATTERN.search(content)
+        game_end_timestamp = RAW_GAME_END_TIMESTAMP_PATTERN.search(content)
+        platform_id = RAW_PLATFORM_ID_PATTERN.search(content)
+        game_version = RAW_GAME_VERSION_PATTERN.search(content)
+        queue_id = RAW_QUEUE_ID_PATTERN.search(content)
+        participant_puuids = RAW_PARTICIPANT_PUUIDS_PATTERN.search(content)
+        if (
+            match_id is None
+            or game_end_timestamp is None
+            or platform_id is None
+            or game_version is None
+            or queue_id is None
+            or participant_puuids is None
+        ):
+            return cls.from_match(content, json.loads(content))
+        return cls(
+            content=content,
+            match_id=match_id.group(1).decode(),
+            game_end_timestamp=int(game_end_timestamp.group(1)),
+            platform_id=platform_id.group(1).decode(),
+            game_version=game_version.group(1).decode(),
+            queue_id=int(queue_id.group(1)),
+            participant_puuids=tuple(
+                puuid.decode() for puuid in RAW_STRING_PATTERN.findall(participant_puuids.group(1))
+            ),
+        )
+
+    @classmethod
+    def from_match(cls, content: bytes, match_: dict) -> Self:
+        return cls(
+            content=content,
+            match_id=match_["metadata"]["matchId"],
+            game_end_timestamp=match_["info"]["gameEndTimestamp"],
+            platform_id=match_["info"]["platformId"],
+            game_version=match_["info"]["gameVersion"],
+            queue_id=match_["info"]["queueId"],
+            participant_puuids=tuple(match_["metadata"].get("participants", ())),
+        )
+
+
 class LeagueClient:
     MAX_RETRIES = 5
     HEADER_API_KEY = "X-Riot-Token"
-    HEADER_COUNT = "X-App-Rate-Limit-Count"
-    HEADER_LIMIT = "X-App-Rate-Limit"
     HEADER_RETRY_AFTER = "Retry-After"
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_TIMEOUT = 10.0
+    METHOD_GET_LEAGUE = "league-exp-v4.getLeagueEntries"
+    METHOD_GET_MATCH_IDS_BY_PUUID = "match-v5.getMatchIdsByPUUID"
+    METHOD_GET_MATCH = "match-v5.getMatch"
 
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: float = DEFAULT_TIMEOUT,
+        circuit_breaker: CircuitBreaker | None = None,
+        rate_limit_directory: str | None = None,
+        base_url: str | None = None,
+    ):
         self._api_key = api_key
-        self._rate_limits: dict[int, int] = {}
-        self._request_timestamps: dict[int, list[datetime]] = {}
+        # Requests go to the base URL followed by the routing value instead of the Riot host, e.g.
+        # to a local stand-in server. Rate limits are still kept per Riot host
+        self._base_url = base_url.rstrip("/") if base_url is not None else None
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._session_by_host: dict[str, requests.Session] = {}
+        self._rate_limiter = RateLimiter(rate_limit_directory)
+        self._lock = threading.Lock()
 
     def get_league(
         self, region: Region, queue: Queue, tier: Tier, division: Division, page: int = 1
     ):
-        url = f"https://{region.value}.api.riotgames.com/lol/league-exp/v4/entries/{queue.value}/{tier.value}/{division.value}"
+        url = self._get_url(
+            region, f"/lol/league-exp/v4/entries/{queue.value}/{tier.value}/{division.value}"
+        )
         params = {"page": page}
-        league = self.get(url, params=params)
+        league = self.get(
+            url,
+            params=params,
+            method=LeagueClient.METHOD_GET_LEAGUE,
+            host=LeagueClient.get_host(region),
+        )
         return league
 
     def get_match_ids_by_puuid(
@@ -147,7 +249,7 @@ class LeagueClient:
     ):
         assert 0 <= start, "Start must be greater than or equal to 0"
         assert 0 <= count <= 100, "Count must be between 0 and 100"
-        url = f"https://{region_group.value}.api.riotgames.com/lol/match/v5/matches/by-puuid/{puuid}/ids"
+        url = self._get_url(region_group, f"/lol/match/v5/matches/by-puuid/{puuid}/ids")
         params = {
             "startTime": start_time,
             "endTime": end_time,
@@ -156,42 +258,117 @@ class LeagueClient:
             "start": start,
             "count": count,
         }
-        match_ids = self.get(url, params=params)
+        match_ids = self.get(
+            url,
+            params=params,
+            method=LeagueClient.METHOD_GET_MATCH_IDS_BY_PUUID,
+            host=LeagueClient.get_host(region_group),
+        )
         return match_ids
 
     def get_match(self, region_group: RegionGroup, match_id: str):
-        url = f"https://{region_group.value}.api.riotgames.com/lol/match/v5/matches/{match_id}"
-        match_ = self.get(url)
+        url = self._get_url(region_group, f"/lol/match/v5/matches/{match_id}")
+        match_ = self.get(
+            url, method=LeagueClient.METHOD_GET_MATCH, host=LeagueClient.get_host(region_group)
+        )
         return match_
 
-    def get(self, url: str, params: dict | None = None):
+    def get_raw_match(self, region_group: RegionGroup, match_id: str) -> RawMatch | None:
+        # Skips parsing the whole match, which is mostly per participant challenges
+        url = self._get_url(region_group, f"/lol/match/v5/matches/{match_id}")
+        content = self.get(
+            url,
+            method=LeagueClient.METHOD_GET_MATCH,
+            raw=True,
+            host=LeagueClient.get_host(region_group),
+        )
+        return RawMatch.from_content(content) if content is not None else None
+
+    @staticmethod
+    def get_host(routing: Region | RegionGroup) -> str:
+        return f"{routing.value}.api.riotgames.com"
+
+    def get_wait_time(self, host: str, method: str | None = None) -> float:
+        # How long a request to this host would currently have to wait, without reserving a slot
+        wait_for = self._rate_limiter.get_wait_time(host, method)
+        return max(wait_for, self._circuit_breaker.get_retry_after(host))
+
+    def close(self):
+        with self._lock:
+            for session in self._session_by_host.values():
+                session.close()
+            self._session_by_host.clear()
+
+    def get_hosts(self) -> list[str]:
+        return self._rate_limiter.get_hosts()
+
+    def get_request_count(self, host: str | None = None) -> int:
+        return self._rate_limiter.get_request_count(host)
+
+    def get_allowed_requests_per_second(self, host: str) -> float | None:
+        return self._rate_limiter.get_allowed_requests_per_second(host)
+
+    def get(
+        self,
+        url: str,
+        host: str,
+        params: dict | None = None,
+        method: str | None = None,
+        raw: bool = False,
+    ):
+        # The host keys the rate limits and the circuit breaker, as the URL may point to a mock
         for attempt in range(LeagueClient.MAX_RETRIES + 1):
-            self._wait_if_needed()
+            self._circuit_breaker.check(host)
+            self._wait_if_needed(host, method)
             local_logger = logger.bind(
                 attempt=attempt + 1, max_attempt=LeagueClient.MAX_RETRIES, url=url
             )
             try:
-                headers = {LeagueClient.HEADER_API_KEY: self._api_key}
-                response = requests.get(url, params=params, headers=headers)
-                self._update_limits(response.headers)
-                self._record_request()
+                response = self._get_session(host).get(url, params=params, timeout=self._timeout)
+                self._rate_limiter.update(host, method, response.headers)
                 response.raise_for_status()
-                body = response.json()
+                body = response.content if raw else response.json()
+                self._circuit_breaker.record_success(host)
                 return body
             except requests.HTTPError as e:
+                status_code = response.status_code
                 local_logger.warning(
                     "HTTP error occurred",
                     error_type=e.__class__.__name__,
                     error_message=str(e),
-                    status_code=response.status_code,
+                    status_code=status_code,
                 )
+                if not is_retryable_status_code(status_code):
+                    # The host answered, so it is healthy even if the resource is gone
+                    self._circuit_breaker.record_success(host)
+                    local_logger.warning("Non-retryable HTTP error. Raising exception")
+                    raise
+                if is_server_error_status_code(status_code):
+                    self._circuit_breaker.record_failure(host)
                 if attempt >= LeagueClient.MAX_RETRIES:
                     local_logger.exception("Max retries exceeded. Raising exception")
                     raise
-                retry_after = response.headers.get(LeagueClient.HEADER_RETRY_AFTER, 2 * attempt)
-                retry_after = int(retry_after)
-                retry_after = max(0, retry_after)
-                local_logger.warning(f"Retrying after {retry_after} seconds")
+                if status_code == TOO_MANY_REQUESTS_STATUS_CODE:
+                    retry_after = get_retry_after(
+                        response.headers.get(LeagueClient.HEADER_RETRY_AFTER), attempt
+                    )
+                    self._rate_limiter.block(host, method, response.headers, retry_after)
+                else:
+                    retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
+                time.sleep(retry_after)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                local_logger.warning(
+                    "Request timed out or failed to connect",
+                    error_type=e.__class__.__name__,
+                    error_message=str(e),
+                )
+                self._circuit_breaker.record_failure(host)
+                if attempt >= LeagueClient.MAX_RETRIES:
+                    local_logger.exception("Max retries exceeded. Raising exception")
+                    raise
+                retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
                 time.sleep(retry_after)
             except Exception as e:
                 local_logger.exception(
@@ -202,47 +379,44 @@ class LeagueClient:
                 if attempt >= LeagueClient.MAX_RETRIES:
                     local_logger.exception("Max retries exceeded. Raising exception")
                     raise
-                retry_after = 2**attempt
-                retry_after = max(0, retry_after)
-                local_logger.warning(f"Retrying after {retry_after} seconds")
+                retry_after = get_backoff(attempt)
+                local_logger.warning(f"Retrying after {retry_after:.2f} seconds")
                 time.sleep(retry_after)
         return None
 
-    def _wait_if_needed(self):
-        for period, limit in self._rate_limits.items():
-            timestamps = self._request_timestamps[period]
-            while len(timestamps) > 0 and timestamps[0] <= now() - timedelta(seconds=period):
-                timestamps.pop(0)
-
-            if len(timestamps) >= limit:
-                wait_for = timestamps[0] + timedelta(seconds=period) - now()
-                wait_for = wait_for.total_seconds()
-                wait_for = max(0, wait_for)
-                logger.info(
-                    f"Rate limit reached. Waiting preventatively for {wait_for} seconds before sending request",
-                    wait_time=wait_for,
-                    period=period,
-                    limit=limit,
-                )
-                time.sleep(wait_for)
-
-    def _update_limits(self, headers: dict[str, str]):
-        limit_header = headers.get(LeagueClient.HEADER_LIMIT)
-        if limit_header is not None:
-            new_limits = self._parse_limit_header(limit_header)
-            if new_limits != self._rate_limits:
-                self._rate_limits = new_limits
-                for period in self._rate_limits:
-                    if period not in self._request_timestamps:
-                        self._request_timestamps[period] = []
-
-    def _record_request(self):
-        for period in self._request_timestamps:
-            self._request_timestamps[period].append(now())
-
-    def _parse_limit_header(self, limit_header: str) -> dict[int, int]:
-        limits = {}
-        for limit in limit_header.split(","):
-            count, period = limit.split(":")
-            limits[int(period)] = int(count)
-        return limits
+    def _get_url(self, routing: Region | RegionGroup, path: str) -> str:
+        if self._base_url is None:
+            return f"https://{LeagueClient.get_host(routing)}{path}"
+        return f"{self._base_url}/{routing.value}{path}"
+
+    def _get_session(self, host: str) -> requests.Session:
+        # One keep-alive pool per routing host (e.g. na1 or americas) so that consecutive requests
+        # reuse the TCP and TLS connection instead of paying a new handshake every time
+        with self._lock:
+            session = self._session_by_host.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+                session.headers[LeagueClient.HEADER_API_KEY] = self._api_key
+                self._session_by_host[host] = session
+            return session
+
+    def _wait_if_needed(self, host: str, method: str | None):
+        # The slot is reserved before the request is sent so that concurrent callers sharing this
+        # client never have more requests in flight than the rate limits allow
+        while True:
+            wait_for, period, limit = self._rate_limiter.reserve(host, method)
+            if wait_for <= 0:
+                return
+            logger.info(
+                f"Rate limit reached. Waiting preventatively for {wait_for} seconds before sending request",
+                wait_time=wait_for,
+                host=host,
+                method=method,
+                period=period,
+                limit=limit,
+            )
+            time.sleep(wait_for)
@@ -0,0 +1,153 @@
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Protocol
+
+from src.client import MatchType, QueueId, Region, RegionGroup
+from src.estimator import MatchCountEstimator
+from src.match_index import MatchIdIndex
+from src.player import MATCH_TIME_WINDOW, Player
+from src.registry import PlayerRegistry
+from src.scheduler import PlayerScheduler
+from src.util import now
+
+LEAGUE_CRAWL_INTERVAL = timedelta(days=1)
+# The number of pages of a division is only known once an empty page is returned, so pages are
+# fetched this many past the last non-empty one
+LEAGUE_PAGE_LOOKAHEAD = 3
+# Games that were in progress or not yet listed at the last crawl are still fetched
+MATCH_ID_SAFETY_MARGIN = timedelta(hours=1)
+MATCH_ID_PAGE_SIZE = 100
+MATCH_ID_PAGE_MAXIMUM = 10
+
+
+class MatchIdClient(Protocol):
+    def get_match_ids_by_puuid(
+        self,
+        region_group: RegionGroup,
+        puuid: str,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        queue_id: QueueId | None = None,
+        match_type: MatchType | None = None,
+        start: int = 0,
+        count: int = 100,
+    ) -> list[str]: ...
+
+
+@dataclass(eq=False)
+class CrawlState:
+    # What the crawler knows of a region and how each step changes it. crawl_matches.py runs it
+    # against the API and the database, script/simulate_crawl.py against replayed activity on a
+    # virtual clock, so that simulated policies are those of the crawler
+    region: Region
+    region_group: RegionGroup = field(init=False)
+    player_registry: PlayerRegistry = field(default_factory=PlayerRegistry)
+    match_count_estimator: MatchCountEstimator = field(default_factory=MatchCountEstimator)
+    player_scheduler: PlayerScheduler = field(init=False)
+    match_id_index: MatchIdIndex = field(init=False)
+    last_league_crawl_time: datetime = field(
+        default_factory=lambda: datetime.min.replace(tzinfo=timezone.utc)
+    )
+    league_crawl_interval: timedelta = LEAGUE_CRAWL_INTERVAL
+    stale_period: timedelta = PlayerScheduler.STALE_PERIOD
+
+    def __post_init__(self):
+        self.region_group = RegionGroup.from_region(self.region)
+        self.rebuild_player_scheduler()
+        self.match_id_index = MatchIdIndex(self.region.name)
+
+    def is_league_outdated(self, moment: datetime) -> bool:
+        return moment - self.last_league_crawl_time >= self.league_crawl_interval
+
+    def get_next_league_crawl_time(self) -> datetime:
+        return self.last_league_crawl_time + self.league_crawl_interval
+
+    def rebuild_player_scheduler(self):
+        # Players are ordered by league when the scheduler is built
+        self.player_scheduler = PlayerScheduler(
+            self.player_registry, self.match_count_estimator, stale_period=self.stale_period
+        )
+
+    def update_from_league_entries(self, league_entries: Iterable[dict], moment: datetime):
+        # New players are scheduled right away, so that a cold start crawls them before the
+        # leagues are done
+        for puuid in self.player_registry.update_from_league_entries(league_entries, moment):
+            player = self.player_registry.get(puuid)
+            if player is not None:
+                self.player_scheduler.schedule(player)
+
+    def finish_league_crawl(self, moment: datetime) -> tuple[int, int]:
+        # Returns how many players left the leagues and how many match ids expired
+        removed_player_count = self.remove_players_before(moment - MATCH_TIME_WINDOW)
+        expired_match_id_count = self.match_id_index.expire(moment)
+        self.last_league_crawl_time = moment
+        return removed_player_count, expired_match_id_count
+
+    def remove_players_before(self, moment: datetime) -> int:
+        removed_player_count = self.player_registry.remove_players_before(moment)
+        self.rebuild_player_scheduler()
+        return removed_player_count
+
+    def crawl_new_match_ids(
+        self,
+        match_id_client: MatchIdClient,
+        player: Player,
+        read_stored_match_ids: Callable[[list[str], datetime], set[str]],
+        incremental_match_ids: bool,
+        clock: Callable[[], datetime] = now,
+    ) -> tuple[set[str], set[str]]:
+        # Returns the match ids of the player and those that are neither indexed nor stored
+        since = clock() - MATCH_TIME_WINDOW
+        last_match_crawl_time = player.last_match_crawl_time
+        is_incremental = False
+        if incremental_match_ids and last_match_crawl_time is not None:
+            is_incremental = True
+            since = max(since, last_match_crawl_time - MATCH_ID_SAFETY_MARGIN)
+        match_ids = get_match_ids_since(match_id_client, self.region_group, player.puuid, since)
+        new_match_ids = {match_id for match_id in match_ids if match_id not in self.match_id_index}
+        # Only ids that may have been dropped from the index are looked up in the database
+        expired_match_ids = [
+            match_id for match_id in new_match_ids if self.match_id_index.may_have_expired(match_id)
+        ]
+        if len(expired_match_ids) > 0:
+            new_match_ids -= read_stored_match_ids(expired_match_ids, since)
+        new_match_count = None
+        if is_incremental:
+            # Ids of the safety margin were already counted at the last crawl, unlike those that
+            # were only fetched through other players since then
+            new_match_count = len(new_match_ids) + player.observed_match_count
+        player.update_from_match_ids(match_ids, new_match_count, clock())
+        return match_ids, new_match_ids
+
+    def observe_participants(
+        self, player: Player, ended_at: datetime, participant_puuids: Iterable[str]
+    ) -> int:
+        # The other tracked participants already have this match, so their next crawl is worth
+        # less. Returns how many of them are tracked
+        self.player_scheduler.observe_match_activity(ended_at)
+        observed_player_count = 0
+        for puuid in participant_puuids:
+            if puuid != player.puuid and self.player_scheduler.observe_match(puuid, ended_at):
+                observed_player_count += 1
+        return observed_player_count
+
+
+def get_match_ids_since(
+    match_id_client: MatchIdClient, region_group: RegionGroup, puuid: str, since: datetime
+) -> set[str]:
+    # A full page means there may be more, so the next one is fetched
+    match_ids = set()
+    for page in range(MATCH_ID_PAGE_MAXIMUM):
+        page_match_ids = match_id_client.get_match_ids_by_puuid(
+            region_group,
+            puuid,
+            start_time=int(since.timestamp()),
+            queue_id=QueueId.RANKED_SOLO_5x5,
+            start=page * MATCH_ID_PAGE_SIZE,
+            count=MATCH_ID_PAGE_SIZE,
+        )
+        match_ids.update(page_match_ids)
+        if len(page_match_ids) < MATCH_ID_PAGE_SIZE:
+            break
+    return match_ids
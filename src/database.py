@@ -1,17 +1,162 @@
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
 import psycopg
 import structlog
+from psycopg import sql
 from psycopg.types.json import Jsonb
 
-from src.client import Queue, QueueId
+from src.client import Queue, QueueId, RawMatch
 from src.util import convert_epoch_to_datetime, now
 
 logger = structlog.get_logger()
 
+# Errors caused by the rows themselves, which fail the same way however often they are retried
+INVALID_ROW_ERRORS = (psycopg.DataError, psycopg.IntegrityError)
+PARTITION_INTERVAL = timedelta(weeks=1)
+
+LEAGUE_COLUMNS = ("crawled_at", "region", "puuid", "queue", "tier", "rank", "dump")
+LEAGUE_COLUMN_TYPES = ("timestamptz", "text", "text", "text", "text", "text", "jsonb")
+LEAGUE_HEARTBEAT_COLUMNS = ("crawled_at", "region", "puuids")
+LEAGUE_HEARTBEAT_COLUMN_TYPES = ("timestamptz", "text", "text[]")
+MATCH_COLUMNS = ("crawled_at", "ended_at", "match_id", "region", "version", "queue", "dump")
+MATCH_COLUMN_TYPES = ("timestamptz", "timestamptz", "text", "text", "text", "text", "jsonb")
+PLAYER_CRAWL_COLUMNS = ("puuid", "region", "crawled_at", "match_count")
+PLAYER_CRAWL_COLUMN_TYPES = ("text", "text", "timestamptz", "int4")
+MATCH_ARCHIVE_COLUMNS = ("match_id", "ended_at", "content")
+MATCH_ARCHIVE_COLUMN_TYPES = ("text", "timestamptz", "bytea")
+# Drops the challenge maps of the participants, which take up most of a dump and are never read
+PROJECTED_MATCH_DUMP_SELECT = """
+CASE
+    WHEN jsonb_typeof(dump -> 'info' -> 'participants') = 'array' THEN jsonb_set(
+        dump,
+        '{info,participants}',
+        (
+            SELECT COALESCE(jsonb_agg(participant - 'challenges' ORDER BY ordinality), '[]')
+            FROM jsonb_array_elements(dump -> 'info' -> 'participants')
+            WITH ORDINALITY AS participants (participant, ordinality)
+        )
+    )
+    ELSE dump
+END
+"""
+FULL_MATCH_DUMP_CONDITION = "jsonb_path_exists(dump, '$.info.participants[*].challenges')"
+
+
+class StorageProfile(Enum):
+    # Full stores the payload as is in matches.dump. Projected stores only what is read, and
+    # archived also keeps the full payload compressed in the match_archives table
+    FULL = "full"
+    PROJECTED = "projected"
+    ARCHIVED = "archived"
+
+
+class LeagueSnapshotMode(Enum):
+    # Full writes every entry of every league crawl. Delta only writes an entry when it changed
+    # since the last crawl, and lists the unchanged players in a heartbeat instead
+    FULL = "full"
+    DELTA = "delta"
+
+
+class PartitionedTable(Enum):
+    LEAGUES = "leagues"
+    LEAGUE_HEARTBEATS = "league_heartbeats"
+    MATCHES = "matches"
+    MATCH_ARCHIVES = "match_archives"
+
+    def get_partition_key(self) -> str:
+        if self in (PartitionedTable.LEAGUES, PartitionedTable.LEAGUE_HEARTBEATS):
+            return "crawled_at"
+        return "ended_at"
+
+    def get_columns(self) -> tuple[str, ...]:
+        if self == PartitionedTable.LEAGUES:
+            return LEAGUE_COLUMNS
+        if self == PartitionedTable.LEAGUE_HEARTBEATS:
+            return LEAGUE_HEARTBEAT_COLUMNS
+        if self == PartitionedTable.MATCHES:
+            return MATCH_COLUMNS
+        return MATCH_ARCHIVE_COLUMNS
+
+
+def get_partition_start(moment: datetime) -> datetime:
+    # Partitions cover weeks from Monday to Monday in UTC
+    day = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday())
+
+
+def get_partition_name(table: PartitionedTable, start: datetime) -> str:
+    return f"{table.value}_{start:%Y%m%d}"
+
+
+def pass_through(content: bytes) -> bytes:
+    return content
+
+
+class InvalidRowError(Exception):
+    pass
+
 
 class DatabaseHandler:
-    def __init__(self, user: str, password: str, host: str, port: str, database: str):
-        self._connection = self._create_connection(user, password, host, port, database)
+    MAXIMUM_BUFFERED_MATCH_COUNT = 100
+    MAXIMUM_BUFFERED_LEAGUE_ENTRY_COUNT = 5000
+    FLUSH_INTERVAL = 5.0
+    STORAGE_PROFILE = StorageProfile.FULL
+    LEAGUE_SNAPSHOT_MODE = LeagueSnapshotMode.FULL
+    COMPACTION_BATCH_SIZE = 500
+
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        host: str,
+        port: str,
+        database: str,
+        maximum_buffered_match_count: int = MAXIMUM_BUFFERED_MATCH_COUNT,
+        maximum_buffered_league_entry_count: int = MAXIMUM_BUFFERED_LEAGUE_ENTRY_COUNT,
+        flush_interval: float = FLUSH_INTERVAL,
+        storage_profile: StorageProfile = STORAGE_PROFILE,
+        league_snapshot_mode: LeagueSnapshotMode = LEAGUE_SNAPSHOT_MODE,
+    ):
+        self._connection_arguments = (user, password, host, port, database)
+        self._connection = self._create_connection(*self._connection_arguments)
+        # Crawlers for several regions share this handler, and a commit or rollback applies to
+        # whatever the connection has pending, so each write runs as one critical section
+        self._lock = threading.Lock()
+        # Writes are buffered and flushed in batches by size or age, so a crawl step pays for a
+        # commit once per batch instead of once per row
+        self._maximum_buffered_match_count = maximum_buffered_match_count
+        self._maximum_buffered_league_entry_count = maximum_buffered_league_entry_count
+        self._flush_interval = flush_interval
+        self._storage_profile = storage_profile
+        self._league_snapshot_mode = league_snapshot_mode
+        # The fingerprint of the last entry written in full for each player, and the week it was
+        # written in. Starts empty, so the first crawl after a restart writes every entry in full
+        self._league_fingerprint_and_week_by_puuid: dict[str, tuple[int, datetime]] = {}
+        self._league_fingerprint_week: datetime | None = None
+        self._league_rows: list[tuple] = []
+        self._league_heartbeat_rows: list[tuple] = []
+        self._match_rows: list[tuple] = []
+        self._match_archive_rows: list[tuple] = []
+        self._player_crawl_row_by_puuid: dict[str, tuple] = {}
+        self._region_crawl_row_by_region: dict[str, tuple] = {}
+        self._last_flush_time = time.monotonic()
         self._create_tables()
+        self._create_staging_tables()
+        # Weeks that already have a partition, so that each is only created once per process
+        self._partition_starts_by_table: dict[PartitionedTable, set[datetime]] = {
+            table: set() for table in PartitionedTable
+        }
+        self._partitioned_tables = self._get_partitioned_tables()
+        if len(self._partitioned_tables) < len(PartitionedTable):
+            logger.warning(
+                "Some tables are not partitioned. Run 'manage_database.py migrate' to partition them",
+                partitioned_tables=[table.value for table in self._partitioned_tables],
+            )
 
     def _create_connection(self, user: str, password: str, host: str, port: str, database: str):
         local_logger = logger.bind(user=user, host=host, port=port, database=database)
@@ -29,89 +174,892 @@ class DatabaseHandler:
         local_logger = logger
         try:
             cursor = self._connection.cursor()
-            sql_create_leagues_table = """
-            CREATE TABLE IF NOT EXISTS leagues (
-                crawled_at TIMESTAMPTZ NOT NULL,
-                puuid TEXT NOT NULL,
-                queue TEXT NOT NULL,
-                tier TEXT NOT NULL,
-                rank TEXT NOT NULL,
-                dump JSONB NOT NULL,
-                PRIMARY KEY (puuid, crawled_at)
-            );
-            """
-            sql_create_matches_table = """
-            CREATE TABLE IF NOT EXISTS matches (
-                crawled_at TIMESTAMPTZ NOT NULL,
-                ended_at TIMESTAMPTZ NOT NULL,
-                match_id TEXT NOT NULL,
-                region TEXT NOT NULL,
-                version TEXT NOT NULL,
-                queue TEXT NOT NULL,
-                dump JSONB NOT NULL,
-                PRIMARY KEY (match_id)
-            );
-            """
-            cursor.execute(sql_create_leagues_table)
-            cursor.execute(sql_create_matches_table)
+            self._execute_create_tables(cursor)
             self._connection.commit()
             local_logger.info("Created tables")
         except:
             local_logger.exception("Failed to create tables")
             raise
 
-    def write_leagues(self, leagues: list[dict]):
+    def _execute_create_tables(self, cursor: psycopg.Cursor):
+        # Leagues and matches are partitioned by week, so time ranges only scan the weeks they
+        # cover and old weeks can be dropped whole. Partitions are created as rows arrive
+        sql_create_leagues_table = """
+        CREATE TABLE IF NOT EXISTS leagues (
+            crawled_at TIMESTAMPTZ NOT NULL,
+            region TEXT,
+            puuid TEXT NOT NULL,
+            queue TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            rank TEXT NOT NULL,
+            dump JSONB NOT NULL,
+            PRIMARY KEY (puuid, crawled_at)
+        ) PARTITION BY RANGE (crawled_at);
+        """
+        sql_create_matches_table = """
+        CREATE TABLE IF NOT EXISTS matches (
+            crawled_at TIMESTAMPTZ NOT NULL,
+            ended_at TIMESTAMPTZ NOT NULL,
+            match_id TEXT NOT NULL,
+            region TEXT NOT NULL,
+            version TEXT NOT NULL,
+            queue TEXT NOT NULL,
+            dump JSONB NOT NULL,
+            stored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (match_id, ended_at)
+        ) PARTITION BY RANGE (ended_at);
+        """
+        # The start of the transaction that stored a match, which
+        # refresh_simplified_matches_table.sql follows. Matches stored before the column existed
+        # get the time it was added
+        sql_add_matches_stored_at_column = """
+        ALTER TABLE matches ADD COLUMN IF NOT EXISTS stored_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        """
+        # Lists the players whose entries did not change since they were last written in full
+        sql_create_league_heartbeats_table = """
+        CREATE TABLE IF NOT EXISTS league_heartbeats (
+            crawled_at TIMESTAMPTZ NOT NULL,
+            region TEXT NOT NULL,
+            puuids TEXT[] NOT NULL,
+            PRIMARY KEY (region, crawled_at)
+        ) PARTITION BY RANGE (crawled_at);
+        """
+        # The content is compressed before it is written, so Postgres is told not to compress it
+        # again
+        sql_create_match_archives_table = """
+        CREATE TABLE IF NOT EXISTS match_archives (
+            match_id TEXT NOT NULL,
+            ended_at TIMESTAMPTZ NOT NULL,
+            content BYTEA NOT NULL,
+            PRIMARY KEY (match_id, ended_at)
+        ) PARTITION BY RANGE (ended_at);
+        ALTER TABLE match_archives ALTER COLUMN content SET STORAGE EXTERNAL;
+        """
+        # The region lets a restarted crawler load the players of its own regions. Rows
+        # written before the column existed have no region and are never loaded
+        sql_add_leagues_region_column = """
+        ALTER TABLE leagues ADD COLUMN IF NOT EXISTS region TEXT;
+        """
+        sql_create_player_crawls_table = """
+        CREATE TABLE IF NOT EXISTS player_crawls (
+            puuid TEXT NOT NULL,
+            region TEXT NOT NULL,
+            crawled_at TIMESTAMPTZ NOT NULL,
+            match_count INTEGER NOT NULL,
+            PRIMARY KEY (puuid)
+        );
+        """
+        sql_create_region_crawls_table = """
+        CREATE TABLE IF NOT EXISTS region_crawls (
+            region TEXT NOT NULL,
+            league_crawled_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (region)
+        );
+        """
+        sql_create_match_participants_table = """
+        CREATE TABLE IF NOT EXISTS match_participants (
+            match_id TEXT NOT NULL,
+            participant_id SMALLINT NOT NULL,
+            ended_at TIMESTAMPTZ NOT NULL,
+            region TEXT NOT NULL,
+            puuid TEXT NOT NULL,
+            team SMALLINT,
+            position TEXT,
+            champion TEXT,
+            win BOOLEAN,
+            kills SMALLINT,
+            deaths SMALLINT,
+            assists SMALLINT,
+            champion_level SMALLINT,
+            gold_earned INTEGER,
+            total_minions_killed INTEGER,
+            neutral_minions_killed INTEGER,
+            damage_to_champions INTEGER,
+            vision_score INTEGER,
+            PRIMARY KEY (match_id, participant_id)
+        );
+        ALTER TABLE match_participants
+        ALTER COLUMN team DROP NOT NULL,
+        ALTER COLUMN position DROP NOT NULL,
+        ALTER COLUMN champion DROP NOT NULL,
+        ALTER COLUMN win DROP NOT NULL;
+        """
+        # The rows of match_participants for a match, used both when matches are stored and by
+        # backfill_match_participants.sql. Participants without an id or a puuid, which cannot be
+        # told apart, are left out, and so are dumps without a participant list
+        sql_create_get_match_participants_function = """
+        CREATE OR REPLACE FUNCTION get_match_participants(
+            match_id TEXT, ended_at TIMESTAMPTZ, region TEXT, dump JSONB
+        )
+        RETURNS SETOF match_participants
+        LANGUAGE sql IMMUTABLE AS $$
+        SELECT
+            match_id,
+            (participant ->> 'participantId')::smallint,
+            ended_at,
+            region,
+            participant ->> 'puuid',
+            (participant ->> 'teamId')::smallint,
+            participant ->> 'teamPosition',
+            participant ->> 'championName',
+            (participant ->> 'win')::boolean,
+            (participant ->> 'kills')::smallint,
+            (participant ->> 'deaths')::smallint,
+            (participant ->> 'assists')::smallint,
+            (participant ->> 'champLevel')::smallint,
+            (participant ->> 'goldEarned')::integer,
+            (participant ->> 'totalMinionsKilled')::integer,
+            (participant ->> 'neutralMinionsKilled')::integer,
+            (participant ->> 'totalDamageDealtToChampions')::integer,
+            (participant ->> 'visionScore')::integer
+        FROM jsonb_array_elements(
+            CASE
+                WHEN jsonb_typeof(dump -> 'info' -> 'participants') = 'array'
+                THEN dump -> 'info' -> 'participants'
+                ELSE '[]'
+            END
+        ) AS participant
+        WHERE participant ->> 'participantId' IS NOT NULL
+        AND participant ->> 'puuid' IS NOT NULL
+        $$;
+        """
+        sql_create_indexes = """
+        CREATE INDEX IF NOT EXISTS leagues_region_crawled_at_index
+        ON leagues (region, crawled_at);
+        CREATE INDEX IF NOT EXISTS matches_region_crawled_at_index
+        ON matches (region, crawled_at);
+        DROP INDEX IF EXISTS matches_crawled_at_index;
+        CREATE INDEX IF NOT EXISTS matches_stored_at_index
+        ON matches (stored_at);
+        CREATE INDEX IF NOT EXISTS player_crawls_region_index
+        ON player_crawls (region);
+        CREATE INDEX IF NOT EXISTS match_participants_region_ended_at_index
+        ON match_participants (region, ended_at);
+        CREATE INDEX IF NOT EXISTS match_participants_position_champion_index
+        ON match_participants (position, champion);
+        CREATE INDEX IF NOT EXISTS match_participants_puuid_ended_at_index
+        ON match_participants (puuid, ended_at);
+        CREATE INDEX IF NOT EXISTS leagues_crawled_at_brin_index
+        ON leagues USING brin (crawled_at);
+        CREATE INDEX IF NOT EXISTS matches_ended_at_brin_index
+        ON matches USING brin (ended_at);
+        """
+        # Every league observation, with the heartbeats resolved to the last entry written in full.
+        # Delta snapshots write every player in full at least once a week, so that entry is always
+        # in the same weekly partition as the heartbeat. The ladder at a moment is the latest
+        # observation of each player before it
+        sql_create_league_entries_view = """
+        CREATE OR REPLACE VIEW league_entries AS
+        SELECT crawled_at, region, puuid, queue, tier, rank, dump
+        FROM leagues
+        UNION ALL
+        SELECT
+            heartbeats.crawled_at,
+            heartbeats.region,
+            heartbeat_puuids.puuid,
+            last_leagues.queue,
+            last_leagues.tier,
+            last_leagues.rank,
+            last_leagues.dump
+        FROM league_heartbeats AS heartbeats
+        CROSS JOIN unnest(heartbeats.puuids) AS heartbeat_puuids (puuid)
+        CROSS JOIN LATERAL (
+            SELECT queue, tier, rank, dump
+            FROM leagues
+            WHERE leagues.puuid = heartbeat_puuids.puuid
+            AND leagues.crawled_at <= heartbeats.crawled_at
+            AND leagues.crawled_at >= date_trunc('week', heartbeats.crawled_at, 'UTC')
+            ORDER BY leagues.crawled_at DESC
+            LIMIT 1
+        ) AS last_leagues;
+        """
+        cursor.execute(sql_create_leagues_table)
+        cursor.execute(sql_create_league_heartbeats_table)
+        cursor.execute(sql_create_matches_table)
+        cursor.execute(sql_add_matches_stored_at_column)
+        cursor.execute(sql_create_match_archives_table)
+        cursor.execute(sql_add_leagues_region_column)
+        cursor.execute(sql_create_player_crawls_table)
+        cursor.execute(sql_create_region_crawls_table)
+        cursor.execute(sql_create_match_participants_table)
+        cursor.execute(sql_create_get_match_participants_function)
+        cursor.execute(sql_create_indexes)
+        cursor.execute(sql_create_league_entries_view)
+
+    def _create_staging_tables(self):
         local_logger = logger
         try:
             cursor = self._connection.cursor()
-            sql = """
-            INSERT INTO leagues
-            (crawled_at, puuid, queue, tier, rank, dump)
-            VALUES
-            (%s, %s, %s, %s, %s, %s)
+            # Temporary tables belong to this connection and are emptied by every commit
+            sql_create_staging_tables = """
+            CREATE TEMPORARY TABLE IF NOT EXISTS leagues_staging
+            (LIKE leagues) ON COMMIT DELETE ROWS;
+            CREATE TEMPORARY TABLE IF NOT EXISTS league_heartbeats_staging
+            (LIKE league_heartbeats) ON COMMIT DELETE ROWS;
+            CREATE TEMPORARY TABLE IF NOT EXISTS matches_staging
+            (LIKE matches INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;
+            CREATE TEMPORARY TABLE IF NOT EXISTS match_archives_staging
+            (LIKE match_archives) ON COMMIT DELETE ROWS;
+            CREATE TEMPORARY TABLE IF NOT EXISTS player_crawls_staging
+            (LIKE player_crawls) ON COMMIT DELETE ROWS;
             """
-            crawled_at = now()
-            values = (
-                (
-                    crawled_at,
-                    league["puuid"],
-                    league["queueType"],
-                    league["tier"],
-                    league["rank"],
-                    Jsonb(league),
+            cursor.execute(sql_create_staging_tables)
+            self._connection.commit()
+            local_logger.info("Created staging tables")
+        except:
+            local_logger.exception("Failed to create staging tables")
+            raise
+
+    def write_leagues(self, leagues: list[dict], region: str, crawled_at: datetime | None = None):
+        crawled_at = crawled_at or now()
+        with self._lock:
+            self._expire_league_fingerprints(crawled_at)
+            unchanged_puuids = []
+            for league in leagues:
+                if self._is_league_unchanged(league, crawled_at):
+                    unchanged_puuids.append(league["puuid"])
+                    continue
+                self._league_rows.append(
+                    (
+                        crawled_at,
+                        region,
+                        league["puuid"],
+                        league["queueType"],
+                        league["tier"],
+                        league["rank"],
+                        Jsonb(league),
+                    )
                 )
-                for league in leagues
+            if len(unchanged_puuids) > 0:
+                self._league_heartbeat_rows.append((crawled_at, region, unchanged_puuids))
+            self._flush_if_needed()
+
+    def write_match(self, match_: dict, crawled_at: datetime | None = None):
+        row = (
+            crawled_at or now(),
+            convert_epoch_to_datetime(match_["info"]["gameEndTimestamp"]),
+            match_["metadata"]["matchId"],
+            match_["info"]["platformId"],
+            match_["info"]["gameVersion"],
+            Queue.from_id(match_["info"]["queueId"]).value,
+            Jsonb(match_),
+        )
+        archive_row = None
+        if self._storage_profile == StorageProfile.ARCHIVED:
+            archive_row = (row[2], row[1], zlib.compress(json.dumps(match_).encode()))
+        self._buffer_match(row, archive_row)
+
+    def write_raw_match(self, raw_match: RawMatch, crawled_at: datetime | None = None):
+        row = (
+            crawled_at or now(),
+            convert_epoch_to_datetime(raw_match.game_end_timestamp),
+            raw_match.match_id,
+            raw_match.platform_id,
+            raw_match.game_version,
+            Queue.from_id(raw_match.queue_id).value,
+            # The content is already JSON, so it is sent as is instead of being serialized again
+            Jsonb(raw_match.content, dumps=pass_through),
+        )
+        archive_row = None
+        if self._storage_profile == StorageProfile.ARCHIVED:
+            archive_row = (row[2], row[1], zlib.compress(raw_match.content))
+        self._buffer_match(row, archive_row)
+
+    def write_player_crawl(self, puuid: str, region: str, crawled_at: datetime, match_count: int):
+        with self._lock:
+            # Only the latest crawl of a player matters, and an upsert cannot touch a row twice
+            self._player_crawl_row_by_puuid[puuid] = (puuid, region, crawled_at, match_count)
+            self._flush_if_needed()
+
+    def write_region_crawl(self, region: str, league_crawled_at: datetime):
+        with self._lock:
+            # Flushed in the same transaction as the league entries buffered before it, so a
+            # region is never marked as crawled without its entries
+            self._region_crawl_row_by_region[region] = (region, league_crawled_at)
+            self._flush_if_needed()
+
+    def flush(self) -> bool:
+        # Returns False if the rows could not be stored for now, e.g. while the database is down,
+        # and raises InvalidRowError if some of them can never be stored. The rows stay buffered
+        # either way, until they are flushed or discarded
+        with self._lock:
+            try:
+                return self._flush()
+            except INVALID_ROW_ERRORS as e:
+                raise InvalidRowError(str(e)) from e
+
+    def discard(self):
+        # Fingerprints of the discarded entries are forgotten too, so that they are written in
+        # full when they are written again
+        with self._lock:
+            self._league_fingerprint_and_week_by_puuid = {}
+            self._clear()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush()
+            except INVALID_ROW_ERRORS:
+                pass
+            self._connection.close()
+
+    def migrate_to_partitions(self):
+        # Moves the rows of tables created before partitioning into partitioned tables, in one
+        # transaction
+        with self._lock:
+            tables = [table for table in PartitionedTable if table not in self._partitioned_tables]
+            local_logger = logger.bind(tables=[table.value for table in tables])
+            try:
+                cursor = self._connection.cursor()
+                for table in tables:
+                    self._rename_unpartitioned_table(cursor, table)
+                self._execute_create_tables(cursor)
+                self._partitioned_tables = set(PartitionedTable)
+                for table in tables:
+                    self._move_unpartitioned_rows(cursor, table)
+                self._connection.commit()
+                local_logger.info("Migrated tables to partitions")
+            except:
+                local_logger.exception("Failed to migrate tables to partitions")
+                self._connection.rollback()
+                self._partitioned_tables = self._get_partitioned_tables()
+                self._partition_starts_by_table = {table: set() for table in PartitionedTable}
+                raise
+
+    def drop_partitions_before(self, table: PartitionedTable, moment: datetime) -> list[str]:
+        # Drops the partitions that only hold rows from before the moment
+        with self._lock:
+            local_logger = logger.bind(table=table.value, moment=moment.isoformat())
+            try:
+                cursor = self._connection.cursor()
+                rows = cursor.execute(
+                    """
+                    SELECT child.relname
+                    FROM pg_inherits
+                    JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+                    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                    WHERE parent.relname = %s AND pg_table_is_visible(parent.oid)
+                    ORDER BY child.relname
+                    """,
+                    (table.value,),
+                ).fetchall()
+                dropped_partition_names = []
+                for (partition_name,) in rows:
+                    start = datetime.strptime(
+                        partition_name.removeprefix(f"{table.value}_"), "%Y%m%d"
+                    ).replace(tzinfo=timezone.utc)
+                    if start + PARTITION_INTERVAL > moment:
+                        continue
+                    cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition_name)))
+                    self._partition_starts_by_table[table].discard(start)
+                    dropped_partition_names.append(partition_name)
+                self._connection.commit()
+                local_logger.info(
+                    f"Dropped {len(dropped_partition_names)} partitions",
+                    partition_names=dropped_partition_names,
+                )
+                return dropped_partition_names
+            except:
+                local_logger.exception("Failed to drop partitions")
+                self._connection.rollback()
+                raise
+
+    def compact_matches(
+        self, storage_profile: StorageProfile, batch_size: int = COMPACTION_BATCH_SIZE
+    ) -> int:
+        # Converts the full dumps written before the storage profile changed. Each batch commits
+        # on its own, so the crawler keeps writing while this runs and an interrupted run resumes
+        # where it stopped
+        local_logger = logger.bind(storage_profile=storage_profile.value, batch_size=batch_size)
+        if storage_profile == StorageProfile.FULL:
+            local_logger.warning("Full dumps cannot be restored by compaction")
+            return 0
+        compacted_match_count = 0
+        last_key = ("", datetime.min.replace(tzinfo=timezone.utc))
+        while True:
+            with self._lock:
+                try:
+                    keys = self._compact_match_batch(storage_profile, last_key, batch_size)
+                except:
+                    local_logger.exception("Failed to compact matches")
+                    self._connection.rollback()
+                    raise
+            if len(keys) == 0:
+                break
+            compacted_match_count += len(keys)
+            last_key = keys[-1]
+            local_logger.info(
+                f"Compacted {compacted_match_count} matches", last_match_id=last_key[0]
+            )
+        local_logger.info(f"Finished compacting {compacted_match_count} matches")
+        return compacted_match_count
+
+    def read_latest_leagues(
+        self, region: str, tiers: list[str], since: datetime
+    ) -> list[tuple[str, str, str, datetime]]:
+        with self._lock:
+            return self._read(
+                "league_entries",
+                """
+                SELECT DISTINCT ON (puuid) puuid, tier, rank, crawled_at
+                FROM league_entries
+                WHERE region = %s AND crawled_at >= %s AND tier = ANY(%s)
+                ORDER BY puuid, crawled_at DESC
+                """,
+                (region, since, tiers),
+            )
+
+    def read_player_crawls(self, region: str) -> list[tuple[str, datetime, int]]:
+        with self._lock:
+            return self._read(
+                "player_crawls",
+                """
+                SELECT puuid, crawled_at, match_count
+                FROM player_crawls
+                WHERE region = %s
+                """,
+                (region,),
+            )
+
+    def read_match_crawl_times(self, region: str, since: datetime) -> list[tuple[str, datetime]]:
+        with self._lock:
+            return self._read(
+                "matches",
+                """
+                SELECT match_id, crawled_at
+                FROM matches
+                WHERE region = %s AND crawled_at >= %s
+                """,
+                (region, since),
+            )
+
+    def read_stored_match_ids(self, match_ids: list[str], since: datetime) -> set[str]:
+        with self._lock:
+            rows = self._read(
+                "matches",
+                """
+                SELECT match_id
+                FROM matches
+                WHERE match_id = ANY(%s) AND ended_at >= %s
+                """,
+                (match_ids, since),
             )
-            cursor.executemany(sql, values)
+        return {match_id for (match_id,) in rows}
+
+    def read_league_crawl_time(self, region: str) -> datetime | None:
+        with self._lock:
+            rows = self._read(
+                "region_crawls",
+                """
+                SELECT league_crawled_at
+                FROM region_crawls
+                WHERE region = %s
+                """,
+                (region,),
+            )
+        return rows[0][0] if len(rows) > 0 else None
+
+    def _read(self, table: str, query: str, params: tuple) -> list[tuple]:
+        # A failed read returns nothing, so the crawler starts from scratch for that state
+        local_logger = logger.bind(table=table)
+        try:
+            cursor = self._connection.cursor()
+            rows = cursor.execute(query, params).fetchall()
             self._connection.commit()
-            local_logger.info("Inserted entries into 'leagues' table")
+            local_logger.info(f"Read {len(rows)} rows from '{table}' table")
+            return rows
         except psycopg.Error:
-            local_logger.exception("Failed to insert entries into 'leagues' table")
+            local_logger.exception(f"Failed to read from '{table}' table")
             self._connection.rollback()
+            return []
+
+    def _expire_league_fingerprints(self, crawled_at: datetime):
+        # Fingerprints of past weeks never match again, so they are dropped once a week starts,
+        # along with the players who left the crawled leagues
+        week = get_partition_start(crawled_at)
+        if self._league_fingerprint_week is not None and week <= self._league_fingerprint_week:
+            return
+        self._league_fingerprint_week = week
+        self._league_fingerprint_and_week_by_puuid = {
+            puuid: fingerprint_and_week
+            for puuid, fingerprint_and_week in self._league_fingerprint_and_week_by_puuid.items()
+            if fingerprint_and_week[1] >= week
+        }
 
-    def write_match(self, match_: dict):
-        local_logger = logger.bind(match_id=match_["metadata"]["matchId"])
+    def _is_league_unchanged(self, league: dict, crawled_at: datetime) -> bool:
+        # An entry is written in full again in a new week even when unchanged, so that dropping
+        # old partitions never leaves a heartbeat without the entry it refers to
+        if self._league_snapshot_mode == LeagueSnapshotMode.FULL:
+            return False
+        fingerprint_and_week = (
+            hash(json.dumps(league, sort_keys=True)),
+            get_partition_start(crawled_at),
+        )
+        puuid = league["puuid"]
+        if self._league_fingerprint_and_week_by_puuid.get(puuid) == fingerprint_and_week:
+            return True
+        self._league_fingerprint_and_week_by_puuid[puuid] = fingerprint_and_week
+        return False
+
+    def _buffer_match(self, row: tuple, archive_row: tuple | None):
+        # Dumps are projected by Postgres when they are moved out of the staging table, so the
+        # payload is never parsed here. Only the archived copy is compressed here, as Postgres
+        # has no compression function of its own
+        with self._lock:
+            self._match_rows.append(row)
+            if archive_row is not None:
+                self._match_archive_rows.append(archive_row)
+            self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if (
+            len(self._match_rows) >= self._maximum_buffered_match_count
+            or len(self._league_rows) >= self._maximum_buffered_league_entry_count
+            or time.monotonic() - self._last_flush_time >= self._flush_interval
+        ):
+            # Invalid rows are left for an explicit flush, whose caller can tell which they are
+            try:
+                self._flush()
+            except INVALID_ROW_ERRORS:
+                pass
+
+    def _flush(self) -> bool:
+        self._last_flush_time = time.monotonic()
+        league_rows = self._league_rows
+        league_heartbeat_rows = self._league_heartbeat_rows
+        match_rows = self._match_rows
+        match_archive_rows = self._match_archive_rows
+        player_crawl_rows = list(self._player_crawl_row_by_puuid.values())
+        region_crawl_rows = list(self._region_crawl_row_by_region.values())
+        if (
+            len(league_rows) == 0
+            and len(league_heartbeat_rows) == 0
+            and len(match_rows) == 0
+            and len(player_crawl_rows) == 0
+            and len(region_crawl_rows) == 0
+        ):
+            return True
+        local_logger = logger.bind(
+            league_entry_count=len(league_rows),
+            league_heartbeat_count=len(league_heartbeat_rows),
+            match_count=len(match_rows),
+            player_crawl_count=len(player_crawl_rows),
+            region_crawl_count=len(region_crawl_rows),
+        )
+        # Rows are copied into session-local staging tables and moved from there in one
+        # transaction, so a duplicate match id skips that match instead of failing the batch
         try:
+            self._reconnect_if_needed()
             cursor = self._connection.cursor()
-            sql = """
-            INSERT INTO matches
-            (crawled_at, ended_at, match_id, region, version, queue, dump)
-            VALUES
-            (%s, %s, %s, %s, %s, %s, %s)
-            """
-            crawled_at = now()
-            value = (
-                crawled_at,
-                convert_epoch_to_datetime(match_["info"]["gameEndTimestamp"]),
-                match_["metadata"]["matchId"],
-                match_["info"]["platformId"],
-                match_["info"]["gameVersion"],
-                Queue.from_id(match_["info"]["queueId"]).value,
-                Jsonb(match_),
-            )
-            cursor.execute(sql, value)
+            created_partition_starts_by_table = {
+                PartitionedTable.LEAGUES: self._create_missing_partitions(
+                    cursor, PartitionedTable.LEAGUES, {row[0] for row in league_rows}
+                ),
+                PartitionedTable.LEAGUE_HEARTBEATS: self._create_missing_partitions(
+                    cursor,
+                    PartitionedTable.LEAGUE_HEARTBEATS,
+                    {row[0] for row in league_heartbeat_rows},
+                ),
+                PartitionedTable.MATCHES: self._create_missing_partitions(
+                    cursor, PartitionedTable.MATCHES, {row[1] for row in match_rows}
+                ),
+                PartitionedTable.MATCH_ARCHIVES: self._create_missing_partitions(
+                    cursor, PartitionedTable.MATCH_ARCHIVES, {row[1] for row in match_archive_rows}
+                ),
+            }
+            self._copy(cursor, "leagues_staging", LEAGUE_COLUMNS, LEAGUE_COLUMN_TYPES, league_rows)
+            self._copy(
+                cursor,
+                "league_heartbeats_staging",
+                LEAGUE_HEARTBEAT_COLUMNS,
+                LEAGUE_HEARTBEAT_COLUMN_TYPES,
+                league_heartbeat_rows,
+            )
+            self._copy(cursor, "matches_staging", MATCH_COLUMNS, MATCH_COLUMN_TYPES, match_rows)
+            self._copy(
+                cursor,
+                "match_archives_staging",
+                MATCH_ARCHIVE_COLUMNS,
+                MATCH_ARCHIVE_COLUMN_TYPES,
+                match_archive_rows,
+            )
+            self._copy(
+                cursor,
+                "player_crawls_staging",
+                PLAYER_CRAWL_COLUMNS,
+                PLAYER_CRAWL_COLUMN_TYPES,
+                player_crawl_rows,
+            )
+            league_columns = ", ".join(LEAGUE_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO leagues ({league_columns})
+                SELECT {league_columns} FROM leagues_staging
+                ON CONFLICT DO NOTHING
+                """
+            )
+            league_heartbeat_columns = ", ".join(LEAGUE_HEARTBEAT_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO league_heartbeats ({league_heartbeat_columns})
+                SELECT crawled_at, region, array_agg(DISTINCT puuid)
+                FROM league_heartbeats_staging, unnest(puuids) AS puuid
+                GROUP BY crawled_at, region
+                ON CONFLICT (region, crawled_at) DO UPDATE SET
+                puuids = ARRAY(
+                    SELECT DISTINCT unnest(league_heartbeats.puuids || EXCLUDED.puuids)
+                )
+                """
+            )
+            # Participants are unnested by Postgres from the matches that were actually inserted,
+            # so the dumps are never parsed here and duplicates add no participants or archives
+            match_columns = ", ".join(MATCH_COLUMNS)
+            match_select = match_columns
+            if self._storage_profile != StorageProfile.FULL:
+                match_select = ", ".join(
+                    PROJECTED_MATCH_DUMP_SELECT if column == "dump" else column
+                    for column in MATCH_COLUMNS
+                )
+            match_archive_columns = ", ".join(MATCH_ARCHIVE_COLUMNS)
+            cursor.execute(
+                f"""
+                WITH inserted_matches AS (
+                    INSERT INTO matches ({match_columns})
+                    SELECT {match_select} FROM matches_staging
+                    ON CONFLICT DO NOTHING
+                    RETURNING match_id, ended_at, region, dump
+                ),
+                inserted_match_participants AS (
+                    INSERT INTO match_participants
+                    SELECT participants.*
+                    FROM inserted_matches AS matches,
+                    get_match_participants(match_id, ended_at, region, dump) AS participants
+                    ON CONFLICT DO NOTHING
+                ),
+                inserted_match_archives AS (
+                    INSERT INTO match_archives ({match_archive_columns})
+                    SELECT {match_archive_columns}
+                    FROM match_archives_staging
+                    JOIN inserted_matches USING (match_id, ended_at)
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT count(*) FROM inserted_matches
+                """
+            )
+            (inserted_match_count,) = cursor.fetchone()
+            player_crawl_columns = ", ".join(PLAYER_CRAWL_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO player_crawls ({player_crawl_columns})
+                SELECT {player_crawl_columns} FROM player_crawls_staging
+                ON CONFLICT (puuid) DO UPDATE SET
+                region = EXCLUDED.region,
+                crawled_at = EXCLUDED.crawled_at,
+                match_count = EXCLUDED.match_count
+                """
+            )
+            cursor.executemany(
+                """
+                INSERT INTO region_crawls
+                (region, league_crawled_at)
+                VALUES
+                (%s, %s)
+                ON CONFLICT (region) DO UPDATE SET
+                league_crawled_at = EXCLUDED.league_crawled_at
+                """,
+                region_crawl_rows,
+            )
             self._connection.commit()
-            local_logger.info("Inserted entry into 'matches' table")
-        except psycopg.Error:
-            local_logger.exception("Failed to insert entry into 'matches' table")
-            self._connection.rollback()
+            local_logger.info(
+                "Flushed buffered entries",
+                duplicate_match_count=len(match_rows) - inserted_match_count,
+            )
+        except psycopg.Error as e:
+            # The rows stay buffered and are retried with the next flush
+            local_logger.exception("Failed to flush buffered entries")
+            if not self._connection.broken:
+                self._connection.rollback()
+            if isinstance(e, INVALID_ROW_ERRORS):
+                raise
+            return False
+        self._clear()
+        for table, starts in created_partition_starts_by_table.items():
+            self._partition_starts_by_table[table] |= starts
+        return True
+
+    def _clear(self):
+        self._league_rows = []
+        self._league_heartbeat_rows = []
+        self._match_rows = []
+        self._match_archive_rows = []
+        self._player_crawl_row_by_puuid = {}
+        self._region_crawl_row_by_region = {}
+
+    def _compact_match_batch(
+        self, storage_profile: StorageProfile, last_key: tuple[str, datetime], batch_size: int
+    ) -> list[tuple[str, datetime]]:
+        # Walks the matches in primary key order and only touches the dumps that are still full
+        self._reconnect_if_needed()
+        cursor = self._connection.cursor()
+        content_select = "dump::text" if storage_profile == StorageProfile.ARCHIVED else "NULL"
+        rows = cursor.execute(
+            f"""
+            SELECT match_id, ended_at, {content_select}
+            FROM matches
+            WHERE (match_id, ended_at) > (%s, %s) AND {FULL_MATCH_DUMP_CONDITION}
+            ORDER BY match_id, ended_at
+            LIMIT %s
+            """,
+            (*last_key, batch_size),
+        ).fetchall()
+        if len(rows) == 0:
+            self._connection.commit()
+            return []
+        created_partition_starts = set()
+        if storage_profile == StorageProfile.ARCHIVED:
+            archive_rows = [
+                (match_id, ended_at, zlib.compress(content.encode()))
+                for match_id, ended_at, content in rows
+            ]
+            created_partition_starts = self._create_missing_partitions(
+                cursor, PartitionedTable.MATCH_ARCHIVES, {row[1] for row in archive_rows}
+            )
+            self._copy(
+                cursor,
+                "match_archives_staging",
+                MATCH_ARCHIVE_COLUMNS,
+                MATCH_ARCHIVE_COLUMN_TYPES,
+                archive_rows,
+            )
+            match_archive_columns = ", ".join(MATCH_ARCHIVE_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO match_archives ({match_archive_columns})
+                SELECT {match_archive_columns} FROM match_archives_staging
+                ON CONFLICT DO NOTHING
+                """
+            )
+        keys = [(match_id, ended_at) for match_id, ended_at, _ in rows]
+        cursor.execute(
+            f"""
+            UPDATE matches
+            SET dump = {PROJECTED_MATCH_DUMP_SELECT}
+            WHERE (match_id, ended_at) IN (
+                SELECT * FROM unnest(%s::text[], %s::timestamptz[])
+            )
+            """,
+            ([key[0] for key in keys], [key[1] for key in keys]),
+        )
+        self._connection.commit()
+        self._partition_starts_by_table[PartitionedTable.MATCH_ARCHIVES] |= created_partition_starts
+        return keys
+
+    def _get_partitioned_tables(self) -> set[PartitionedTable]:
+        cursor = self._connection.cursor()
+        rows = cursor.execute(
+            """
+            SELECT relname
+            FROM pg_class
+            WHERE relkind = 'p' AND relname = ANY(%s) AND pg_table_is_visible(oid)
+            """,
+            ([table.value for table in PartitionedTable],),
+        ).fetchall()
+        self._connection.commit()
+        return {PartitionedTable(relname) for (relname,) in rows}
+
+    def _create_missing_partitions(
+        self, cursor: psycopg.Cursor, table: PartitionedTable, moments: set[datetime]
+    ) -> set[datetime]:
+        # Returns the starts of the partitions created, which only count as existing once the
+        # transaction that created them is committed
+        if table not in self._partitioned_tables:
+            return set()
+        known_starts = self._partition_starts_by_table[table]
+        starts = {get_partition_start(moment) for moment in moments} - known_starts
+        for start in sorted(starts):
+            self._create_partition(cursor, table, start)
+        return starts
+
+    def _create_partition(self, cursor: psycopg.Cursor, table: PartitionedTable, start: datetime):
+        cursor.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})"
+            ).format(
+                sql.Identifier(get_partition_name(table, start)),
+                sql.Identifier(table.value),
+                sql.Literal(start),
+                sql.Literal(start + PARTITION_INTERVAL),
+            )
+        )
+
+    def _rename_unpartitioned_table(self, cursor: psycopg.Cursor, table: PartitionedTable):
+        # Indexes are renamed too, so that the partitioned table can take their names
+        index_names = cursor.execute(
+            """
+            SELECT indexname
+            FROM pg_indexes
+            WHERE tablename = %s AND schemaname = current_schema()
+            """,
+            (table.value,),
+        ).fetchall()
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(table.value), sql.Identifier(f"{table.value}_unpartitioned")
+            )
+        )
+        for (index_name,) in index_names:
+            cursor.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    sql.Identifier(index_name), sql.Identifier(f"{index_name}_unpartitioned")
+                )
+            )
+
+    def _move_unpartitioned_rows(self, cursor: psycopg.Cursor, table: PartitionedTable):
+        unpartitioned_table = sql.Identifier(f"{table.value}_unpartitioned")
+        partition_key = sql.Identifier(table.get_partition_key())
+        row = cursor.execute(
+            sql.SQL("SELECT min({}), max({}) FROM {}").format(
+                partition_key, partition_key, unpartitioned_table
+            )
+        ).fetchone()
+        # Aggregates return a row even for an empty table, with nulls
+        assert row is not None, f"Got no bounds for {table.value}_unpartitioned"
+        minimum_moment, maximum_moment = row
+        if minimum_moment is not None:
+            start = get_partition_start(minimum_moment)
+            while start <= maximum_moment:
+                self._create_partition(cursor, table, start)
+                start += PARTITION_INTERVAL
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in table.get_columns())
+        cursor.execute(
+            sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                sql.Identifier(table.value), columns, columns, unpartitioned_table
+            )
+        )
+        logger.info(f"Moved {cursor.rowcount} rows into partitions", table=table.value)
+        cursor.execute(sql.SQL("DROP TABLE {}").format(unpartitioned_table))
+
+    def _reconnect_if_needed(self):
+        if not self._connection.broken:
+            return
+        logger.warning("Database connection is broken. Reconnecting")
+        self._connection = self._create_connection(*self._connection_arguments)
+        self._create_staging_tables()
+
+    def _copy(
+        self,
+        cursor: psycopg.Cursor,
+        table: str,
+        columns: tuple[str, ...],
+        column_types: tuple[str, ...],
+        rows: list[tuple],
+    ):
+        if len(rows) == 0:
+            return
+        statement = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))
+        )
+        with cursor.copy(statement) as copy:
+            copy.set_types(column_types)
+            for row in rows:
+                copy.write_row(row)
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from enum import Enum
+
+from src.player import MATCH_TIME_WINDOW
+
+HOUR = timedelta(hours=1)
+HOURS_PER_DAY = 24
+SECONDS_PER_HOUR = HOUR.total_seconds()
+WINDOW_HOURS = MATCH_TIME_WINDOW / HOUR
+# Every hour of the day starts with this many matches, so that the profile is flat until enough
+# matches are observed
+ACTIVITY_PRIOR_MATCH_COUNT = 10.0
+# Past this many matches the counts are halved, so that the profile follows changes in activity
+ACTIVITY_MATCH_COUNT_MAXIMUM = 100_000
+
+
+class MatchCountEstimatorKind(Enum):
+    LINEAR = "linear"
+    ADAPTIVE = "adaptive"
+
+
+class MatchCountEstimator:
+    # Players play at the rate of their last match count per window, at any time of day
+
+    def get_match_rate(self, last_match_count: int | None, match_rate: float | None) -> float:
+        return last_match_count or 0
+
+    def get_activity(self, start: datetime, end: datetime) -> float:
+        # Expected share of the matches of a window played between the two moments
+        return (end - start) / MATCH_TIME_WINDOW
+
+    def observe_match(self, ended_at: datetime):
+        pass
+
+    def estimate_new_match_count(
+        self, match_rate: float, last_match_crawl_time: datetime, moment: datetime
+    ) -> float:
+        return match_rate * self.get_activity(last_match_crawl_time, moment)
+
+
+class AdaptiveMatchCountEstimator(MatchCountEstimator):
+    # Players play at the smoothed rate of all their match crawls, more so at the hours of the day
+    # when the matches of the region were played
+
+    def __init__(self):
+        self._match_counts_by_hour = [0.0] * HOURS_PER_DAY
+        self._cumulative_weights: list[float] | None = None
+        # The scheduler estimates every queue head at the same moment, so the last one is kept
+        self._last_moment: datetime | None = None
+        self._last_weighted_hours = 0.0
+
+    def get_match_rate(self, last_match_count: int | None, match_rate: float | None) -> float:
+        if match_rate is None:
+            return last_match_count or 0
+        return match_rate
+
+    def get_activity(self, start: datetime, end: datetime) -> float:
+        if end != self._last_moment:
+            self._last_moment = end
+            self._last_weighted_hours = self._get_weighted_hours(end)
+        return (self._last_weighted_hours - self._get_weighted_hours(start)) / WINDOW_HOURS
+
+    def observe_match(self, ended_at: datetime):
+        self._match_counts_by_hour[ended_at.hour] += 1
+        if sum(self._match_counts_by_hour) > ACTIVITY_MATCH_COUNT_MAXIMUM:
+            self._match_counts_by_hour = [count / 2 for count in self._match_counts_by_hour]
+        self._cumulative_weights = None
+        self._last_moment = None
+
+    def estimate_new_match_count(
+        self, match_rate: float, last_match_crawl_time: datetime, moment: datetime
+    ) -> float:
+        # Matches older than the window can no longer be fetched, so they are not counted
+        start = max(last_match_crawl_time, moment - MATCH_TIME_WINDOW)
+        return match_rate * self.get_activity(start, moment)
+
+    def get_hourly_weights(self) -> list[float]:
+        # Activity of each hour of the day relative to the average hour
+        match_counts = [count + ACTIVITY_PRIOR_MATCH_COUNT for count in self._match_counts_by_hour]
+        average_match_count = sum(match_counts) / HOURS_PER_DAY
+        return [match_count / average_match_count for match_count in match_counts]
+
+    def _get_weighted_hours(self, moment: datetime) -> float:
+        # Hours since the epoch, each weighted by its activity. Days weigh the same, so only the
+        # hours of the last day are summed
+        if self._cumulative_weights is None:
+            self._cumulative_weights = [0.0]
+            for weight in self.get_hourly_weights():
+                self._cumulative_weights.append(self._cumulative_weights[-1] + weight)
+        day, hour_of_day = divmod(moment.timestamp() / SECONDS_PER_HOUR, HOURS_PER_DAY)
+        hour = int(hour_of_day)
+        hour_weight = self._cumulative_weights[hour + 1] - self._cumulative_weights[hour]
+        return (
+            day * HOURS_PER_DAY
+            + self._cumulative_weights[hour]
+            + hour_weight * (hour_of_day - hour)
+        )
+
+
+def create_match_count_estimator(kind: MatchCountEstimatorKind) -> MatchCountEstimator:
+    if kind == MatchCountEstimatorKind.ADAPTIVE:
+        return AdaptiveMatchCountEstimator()
+    return MatchCountEstimator()
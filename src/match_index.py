@@ -0,0 +1,84 @@
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from src.player import MATCH_TIME_WINDOW
+from src.util import now
+
+BUCKET_PERIOD = timedelta(days=1)
+
+
+@dataclass
+class MatchIdIndexStatistics:
+    match_id_count: int
+    bucket_count: int
+    byte_count: int
+
+
+class MatchIdIndex:
+    def __init__(
+        self,
+        platform: str,
+        retention_period: timedelta = MATCH_TIME_WINDOW,
+        bucket_period: timedelta = BUCKET_PERIOD,
+    ):
+        # Match ids of the platform are kept as the integer after the prefix, which takes about
+        # half the memory of the string. Ids of other platforms are kept as they are
+        self._prefix = f"{platform.upper()}_"
+        self._retention_period = retention_period
+        self._bucket_seconds = bucket_period.total_seconds()
+        # Ids are grouped by the period they were added in, so that expiring a period drops its
+        # whole bucket instead of checking every id
+        self._bucket_by_number: dict[int, set[int | str]] = {}
+        # Ids only increase over time, so an id above every expired one was never expired
+        self._maximum_expired_key = -1
+        self._has_expired_foreign_keys = False
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._bucket_by_number.values())
+
+    def __contains__(self, match_id: str) -> bool:
+        key = self._get_key(match_id)
+        return any(key in bucket for bucket in self._bucket_by_number.values())
+
+    def add(self, match_id: str, moment: datetime | None = None):
+        number = int((moment or now()).timestamp() // self._bucket_seconds)
+        self._bucket_by_number.setdefault(number, set()).add(self._get_key(match_id))
+
+    def may_have_expired(self, match_id: str) -> bool:
+        key = self._get_key(match_id)
+        if isinstance(key, int):
+            return key <= self._maximum_expired_key
+        return self._has_expired_foreign_keys
+
+    def expire(self, moment: datetime | None = None) -> int:
+        # Drops the buckets whose ids were all added before the retention period
+        cutoff = ((moment or now()) - self._retention_period).timestamp()
+        expired_match_id_count = 0
+        for number in sorted(self._bucket_by_number):
+            if (number + 1) * self._bucket_seconds > cutoff:
+                break
+            bucket = self._bucket_by_number.pop(number)
+            expired_match_id_count += len(bucket)
+            for key in bucket:
+                if isinstance(key, int):
+                    self._maximum_expired_key = max(self._maximum_expired_key, key)
+                else:
+                    self._has_expired_foreign_keys = True
+        return expired_match_id_count
+
+    def get_statistics(self) -> MatchIdIndexStatistics:
+        byte_count = sys.getsizeof(self._bucket_by_number)
+        for bucket in self._bucket_by_number.values():
+            byte_count += sys.getsizeof(bucket) + sum(sys.getsizeof(key) for key in bucket)
+        return MatchIdIndexStatistics(
+            match_id_count=len(self),
+            bucket_count=len(self._bucket_by_number),
+            byte_count=byte_count,
+        )
+
+    def _get_key(self, match_id: str) -> int | str:
+        number = match_id.removeprefix(self._prefix)
+        if len(number) < len(match_id) and number.isdigit():
+            return int(number)
+        return match_id
@@ -0,0 +1,163 @@
+import math
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from src.client import Division, Tier
+from src.util import now
+
+MATCH_TIME_WINDOW = timedelta(days=7)
+MATCH_COUNT_MAXIMUM = 100
+# A match crawl covering this period weighs about two thirds of the smoothed match rate
+MATCH_RATE_TIME_CONSTANT = MATCH_TIME_WINDOW
+
+
+def get_effective_match_crawl_time(
+    last_match_crawl_time: datetime,
+    match_rate: float | None,
+    observed_match_count: int,
+    last_seen_time: datetime | None,
+) -> datetime:
+    # A player plays a match every window divided by its rate, so each of its matches already
+    # held moves the crawl time forward by that period. The estimated new match count then drops
+    # by one per observed match while growing at the same rate as before. Only the matches up to
+    # the last one seen are known to be held, so the crawl time moves no further, or a player
+    # whose rate is underestimated would never be crawled again
+    if not match_rate or observed_match_count == 0 or last_seen_time is None:
+        return last_match_crawl_time
+    return min(
+        last_match_crawl_time + observed_match_count * MATCH_TIME_WINDOW / match_rate,
+        max(last_match_crawl_time, last_seen_time),
+    )
+
+
+@dataclass(slots=True)
+class Player:
+    puuid: str
+    tier: Tier
+    division: Division
+    last_league_crawl_time: datetime
+    last_match_crawl_time: datetime | None = None
+    last_match_count: int | None = None
+    # Exponentially weighted average of the match counts of every match crawl, per window
+    match_rate: float | None = None
+    # Matches of the player fetched through other players since its last match crawl
+    observed_match_count: int = 0
+    last_seen_time: datetime | None = None
+
+    def __str__(self):
+        puuid = self.puuid
+        tier = self.tier.value
+        division = self.division.value
+        last_league_crawl_time = self.last_league_crawl_time.isoformat().replace("+00:00", "Z")
+        last_match_crawl_time = (
+            self.last_match_crawl_time.isoformat().replace("+00:00", "Z")
+            if self.last_match_crawl_time
+            else None
+        )
+        last_match_count = self.last_match_count if self.last_match_count else None
+        match_rate = f"{self.match_rate:.2f}" if self.match_rate is not None else None
+        observed_match_count = self.observed_match_count
+        return f"Player(puuid={puuid}, tier={tier}, division={division}, last_league_crawl_time={last_league_crawl_time}, last_match_crawl_time={last_match_crawl_time}, last_match_count={last_match_count}, match_rate={match_rate}, observed_match_count={observed_match_count})"
+
+    def __repr__(self):
+        return str(self)
+
+    def from_league_entry(league_entry: dict):
+        player = Player(
+            puuid=league_entry["puuid"],
+            tier=Tier[league_entry["tier"]],
+            division=Division[league_entry["rank"]],
+            last_league_crawl_time=now(),
+        )
+        return player
+
+    def update_from_league_entry(self, league_entry: dict):
+        self.tier = Tier[league_entry["tier"]]
+        self.division = Division[league_entry["rank"]]
+        self.last_league_crawl_time = now()
+
+    def update_from_match_ids(
+        self,
+        match_ids: set[str],
+        new_match_count: int | None = None,
+        moment: datetime | None = None,
+    ):
+        # The count is kept per match time window, capped like a single page of a full window.
+        # Without a count of the matches played since the last crawl, the ids are taken to cover
+        # the whole window. With one, the matches of the last count that are still in the window,
+        # assumed evenly spread, are kept and the new ones added, since a few hours of ids scaled
+        # up to a window would mostly measure noise
+        moment = moment or now()
+        match_count = len(match_ids)
+        period = MATCH_TIME_WINDOW
+        if (
+            new_match_count is not None
+            and self.last_match_crawl_time is not None
+            and self.last_match_count is not None
+            and moment - self.last_match_crawl_time < MATCH_TIME_WINDOW
+        ):
+            period = moment - self.last_match_crawl_time
+            kept_match_count = self.last_match_count * (1 - period / MATCH_TIME_WINDOW)
+            match_count = round(kept_match_count + new_match_count)
+        self.last_match_crawl_time = moment
+        self.last_match_count = min(match_count, MATCH_COUNT_MAXIMUM)
+        self.observed_match_count = 0
+        # Crawls covering a short period say less about the rate, so they weigh less
+        if self.match_rate is None:
+            self.match_rate = float(self.last_match_count)
+        else:
+            weight = 1 - math.exp(-(period / MATCH_RATE_TIME_CONSTANT))
+            self.match_rate += weight * (self.last_match_count - self.match_rate)
+
+    def observe_match(self, ended_at: datetime) -> bool:
+        # Only matches played since the last match crawl are new to the player's estimate
+        if self.last_seen_time is None or ended_at > self.last_seen_time:
+            self.last_seen_time = ended_at
+        if self.last_match_crawl_time is None or ended_at <= self.last_match_crawl_time:
+            return False
+        self.observed_match_count += 1
+        return True
+
+    def is_match_never_crawled(self) -> bool:
+        return self.last_match_crawl_time is None
+
+    def get_period_since_last_match_crawl(self, moment: datetime | None = None) -> timedelta:
+        if self.last_match_crawl_time is None:
+            return timedelta.max
+        period_since_last_match_crawl = (moment or now()) - self.last_match_crawl_time
+        return period_since_last_match_crawl
+
+    def get_effective_match_crawl_time(self) -> datetime | None:
+        if self.last_match_crawl_time is None:
+            return None
+        return get_effective_match_crawl_time(
+            self.last_match_crawl_time,
+            self.last_match_count,
+            self.observed_match_count,
+            self.last_seen_time,
+        )
+
+    def estimate_new_match_count(self, moment: datetime | None = None) -> float:
+        # Matches already held through other players are not new, so they are left out
+        effective_match_crawl_time = self.get_effective_match_crawl_time()
+        last_match_count = self.last_match_count
+        if effective_match_crawl_time is None or last_match_count is None:
+            return float("inf")
+        period_since_effective_match_crawl = (moment or now()) - effective_match_crawl_time
+        estimated_new_match_count = (
+            last_match_count * period_since_effective_match_crawl / MATCH_TIME_WINDOW
+        )
+        return max(estimated_new_match_count, 0.0)
+
+    def estimate_match_coverage(self, moment: datetime | None = None) -> float:
+        # Share of the matches estimated since the last match crawl that are already held
+        if self.last_match_crawl_time is None or not self.last_match_count:
+            return 0.0
+        estimated_match_count = (
+            self.last_match_count
+            * self.get_period_since_last_match_crawl(moment)
+            / MATCH_TIME_WINDOW
+        )
+        if estimated_match_count <= 0:
+            return 1.0 if self.observed_match_count > 0 else 0.0
+        return min(self.observed_match_count / estimated_match_count, 1.0)
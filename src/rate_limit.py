@@ -0,0 +1,399 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from contextlib import AbstractContextManager, ExitStack, contextmanager, nullcontext
+
+
+def parse_rate_limit_header(header: str) -> dict[int, int]:
+    # Both limit and count headers look like "20:1,100:120", i.e. "count:period" pairs
+    counts = {}
+    for pair in header.split(","):
+        count, period = pair.split(":")
+        counts[int(period)] = int(count)
+    return counts
+
+
+class RateLimitWindows:
+    PROBE_TIMEOUT = 1.0
+    PROBE_POLL_INTERVAL = 0.05
+    # Requests are timed when they are reserved but counted by the server when they arrive. A
+    # request that arrives faster than the one whose slot it takes would land in a window that
+    # still holds that one, so slots are held this much longer than the period
+    WINDOW_MARGIN = 0.2
+
+    def __init__(self):
+        self.limits: dict[int, int] = {}
+        self.timestamps: dict[int, deque[float]] = {}
+        # Until a first response tells us the limits, only one probe request at a time is let
+        # through so that concurrent callers do not burst past limits we have not seen yet
+        self.is_known = False
+        self.probe_started_at: float | None = None
+        self.untracked_timestamps: list[float] = []
+        self.blocked_until = 0.0
+
+    def lock(self) -> AbstractContextManager:
+        # Only needed when the windows are shared with other processes
+        return nullcontext()
+
+    def update_limits(self, limits: dict[int, int]):
+        if limits == self.limits:
+            return
+        self.limits = limits
+        for period in limits:
+            if period not in self.timestamps:
+                self.timestamps[period] = deque(self.untracked_timestamps)
+        self.untracked_timestamps.clear()
+        for period in list(self.timestamps):
+            if period not in limits:
+                del self.timestamps[period]
+
+    def block(self, blocked_until: float):
+        self.blocked_until = max(self.blocked_until, blocked_until)
+
+    def get_wait_time(self, moment: float) -> tuple[float, int | None, int | None]:
+        if not self.is_known and self.probe_started_at is not None:
+            probe_ends_at = self.probe_started_at + RateLimitWindows.PROBE_TIMEOUT
+            if moment < probe_ends_at:
+                return min(probe_ends_at - moment, RateLimitWindows.PROBE_POLL_INTERVAL), None, None
+        maximum_wait_for, maximum_period, maximum_limit = self.blocked_until - moment, None, None
+        for period, limit in self.limits.items():
+            wait_for = self._get_window_wait_time(period, limit, moment)
+            if wait_for > maximum_wait_for:
+                maximum_wait_for, maximum_period, maximum_limit = wait_for, period, limit
+        return maximum_wait_for, maximum_period, maximum_limit
+
+    def record(self, moment: float):
+        if not self.is_known:
+            self.probe_started_at = moment
+            self.untracked_timestamps.append(moment)
+        for period in self.limits:
+            self._record_window(period, moment)
+
+    def reconcile(self, counts: dict[int, int], moment: float):
+        # The server may have seen requests this process did not count, e.g. the ones sent before
+        # the limits were known. Local counts that are higher are left alone since they include
+        # requests still in flight
+        for period, count in counts.items():
+            if period not in self.limits:
+                continue
+            missing_count = count - self._count_window(period, moment)
+            for _ in range(min(missing_count, self.limits[period])):
+                self._record_window(period, moment)
+
+    def get_allowed_requests_per_second(self) -> float | None:
+        if len(self.limits) == 0:
+            return None
+        return min(limit / period for period, limit in self.limits.items())
+
+    def _get_window_wait_time(self, period: int, limit: int, moment: float) -> float:
+        timestamps = self._trim(period, moment)
+        if len(timestamps) < limit:
+            return 0.0
+        # Timestamps are appended in order, so the slot frees up when the request `limit` places
+        # from the end leaves the window. This is timestamps[0] in the common case
+        return (
+            timestamps[len(timestamps) - limit] + period + RateLimitWindows.WINDOW_MARGIN - moment
+        )
+
+    def _record_window(self, period: int, moment: float):
+        self.timestamps[period].append(moment)
+
+    def _count_window(self, period: int, moment: float) -> int:
+        return len(self._trim(period, moment))
+
+    def _trim(self, period: int, moment: float) -> deque[float]:
+        timestamps = self.timestamps[period]
+        expired_before = moment - period - RateLimitWindows.WINDOW_MARGIN
+        while len(timestamps) > 0 and timestamps[0] <= expired_before:
+            timestamps.popleft()
+        return timestamps
+
+
+class SharedRateLimitWindows(RateLimitWindows):
+    # Windows kept in a memory-mapped file so that every process using the same API key reserves
+    # slots from the same budget. The layout is a header (blocked_until, window count) followed
+    # by, per window, (period, limit, position) and a ring of `limit` timestamps. The slot at the
+    # position holds the request sent `limit` requests ago, which is all a sliding window needs to
+    # know whether the next request fits, so reserving is O(1) whatever the limit
+    HEADER = struct.Struct("<dq")
+    WINDOW_HEADER = struct.Struct("<qqq")
+    TIMESTAMP = struct.Struct("<d")
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._file = open(path, "a+b")
+        self._mmap: mmap.mmap | None = None
+        self._offset_by_period: dict[int, int] = {}
+
+    @contextmanager
+    def lock(self):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._load()
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def update_limits(self, limits: dict[int, int]):
+        if limits == self.limits:
+            return
+        timestamps_by_period = {
+            period: self._read_window(period) if period in self.limits else [] for period in limits
+        }
+        for timestamps in timestamps_by_period.values():
+            timestamps.extend(self.untracked_timestamps)
+        self.untracked_timestamps.clear()
+        self._write(limits, timestamps_by_period, self._read_blocked_until())
+
+    def block(self, blocked_until: float):
+        if self._mmap is None:
+            self._write({}, {}, blocked_until)
+        elif blocked_until > self._read_blocked_until():
+            SharedRateLimitWindows.HEADER.pack_into(self._mmap, 0, blocked_until, len(self.limits))
+
+    def _load(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._unmap()
+            self.limits, self._offset_by_period, self.blocked_until = {}, {}, 0.0
+            return
+        if self._mmap is None or len(self._mmap) != size:
+            self._unmap()
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+        self.blocked_until, window_count = SharedRateLimitWindows.HEADER.unpack_from(self._mmap, 0)
+        limits, offset_by_period = {}, {}
+        offset = SharedRateLimitWindows.HEADER.size
+        for _ in range(window_count):
+            period, limit, _ = SharedRateLimitWindows.WINDOW_HEADER.unpack_from(self._mmap, offset)
+            limits[period], offset_by_period[period] = limit, offset
+            offset += SharedRateLimitWindows.WINDOW_HEADER.size
+            offset += limit * SharedRateLimitWindows.TIMESTAMP.size
+        self.limits, self._offset_by_period = limits, offset_by_period
+        if len(limits) > 0:
+            self.is_known = True
+
+    def _unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _write(
+        self,
+        limits: dict[int, int],
+        timestamps_by_period: dict[int, list[float]],
+        blocked_until: float,
+    ):
+        data = bytearray(SharedRateLimitWindows.HEADER.pack(blocked_until, len(limits)))
+        for period, limit in limits.items():
+            # Keep the newest timestamps, oldest first, and pad the ring with zeros which never
+            # fall inside a window
+            timestamps = sorted(timestamps_by_period.get(period, []))[-limit:]
+            ring = [0.0] * (limit - len(timestamps)) + timestamps
+            data += SharedRateLimitWindows.WINDOW_HEADER.pack(period, limit, 0)
+            data += struct.pack(f"<{limit}d", *ring)
+        self._unmap()
+        os.ftruncate(self._file.fileno(), len(data))
+        self._mmap = mmap.mmap(self._file.fileno(), len(data))
+        self._mmap[:] = data
+        self._load()
+
+    def _read_blocked_until(self) -> float:
+        if self._mmap is None:
+            return 0.0
+        blocked_until, _ = SharedRateLimitWindows.HEADER.unpack_from(self._mmap, 0)
+        return blocked_until
+
+    def _get_mmap(self) -> mmap.mmap:
+        # Windows are only read once known, which requires the file to be mapped
+        assert self._mmap is not None, "Shared rate limit windows are not mapped"
+        return self._mmap
+
+    def _read_window(self, period: int) -> list[float]:
+        buffer = self._get_mmap()
+        offset = self._offset_by_period[period]
+        _, limit, position = SharedRateLimitWindows.WINDOW_HEADER.unpack_from(buffer, offset)
+        ring = struct.unpack_from(
+            f"<{limit}d", buffer, offset + SharedRateLimitWindows.WINDOW_HEADER.size
+        )
+        return [timestamp for timestamp in ring[position:] + ring[:position] if timestamp > 0]
+
+    def _get_slot_offset(self, period: int, index: int) -> int:
+        return (
+            self._offset_by_period[period]
+            + SharedRateLimitWindows.WINDOW_HEADER.size
+            + index * SharedRateLimitWindows.TIMESTAMP.size
+        )
+
+    def _get_window_wait_time(self, period: int, limit: int, moment: float) -> float:
+        buffer = self._get_mmap()
+        _, _, position = SharedRateLimitWindows.WINDOW_HEADER.unpack_from(
+            buffer, self._offset_by_period[period]
+        )
+        (oldest,) = SharedRateLimitWindows.TIMESTAMP.unpack_from(
+            buffer, self._get_slot_offset(period, position)
+        )
+        return oldest + period + RateLimitWindows.WINDOW_MARGIN - moment
+
+    def _record_window(self, period: int, moment: float):
+        buffer = self._get_mmap()
+        offset = self._offset_by_period[period]
+        _, limit, position = SharedRateLimitWindows.WINDOW_HEADER.unpack_from(buffer, offset)
+        SharedRateLimitWindows.TIMESTAMP.pack_into(
+            buffer, self._get_slot_offset(period, position), moment
+        )
+        SharedRateLimitWindows.WINDOW_HEADER.pack_into(
+            buffer, offset, period, limit, (position + 1) % limit
+        )
+
+    def _count_window(self, period: int, moment: float) -> int:
+        # The ring is sorted oldest first starting at the position, so a binary search finds the
+        # first timestamp still inside the window
+        buffer = self._get_mmap()
+        _, limit, position = SharedRateLimitWindows.WINDOW_HEADER.unpack_from(
+            buffer, self._offset_by_period[period]
+        )
+        expired_before = moment - period - RateLimitWindows.WINDOW_MARGIN
+        low, high = 0, limit
+        while low < high:
+            middle = (low + high) // 2
+            (timestamp,) = SharedRateLimitWindows.TIMESTAMP.unpack_from(
+                buffer, self._get_slot_offset(period, (position + middle) % limit)
+            )
+            if timestamp <= expired_before:
+                low = middle + 1
+            else:
+                high = middle
+        return limit - low
+
+
+class RateLimiter:
+    HEADER_APP_COUNT = "X-App-Rate-Limit-Count"
+    HEADER_APP_LIMIT = "X-App-Rate-Limit"
+    HEADER_METHOD_COUNT = "X-Method-Rate-Limit-Count"
+    HEADER_METHOD_LIMIT = "X-Method-Rate-Limit"
+    HEADER_LIMIT_TYPE = "X-Rate-Limit-Type"
+
+    def __init__(self, shared_directory: str | None = None):
+        # App limits apply per routing host, method limits per routing host and endpoint. A method
+        # of None stands for the app bucket
+        self._windows_by_key: dict[tuple[str, str | None], RateLimitWindows] = {}
+        self._request_count_by_host: dict[str, int] = {}
+        self._lock = threading.Lock()
+        # Shared windows are compared across processes, which only the wall clock allows
+        self._shared_directory = shared_directory
+        self._clock = time.monotonic if shared_directory is None else time.time
+        if shared_directory is not None:
+            os.makedirs(shared_directory, exist_ok=True)
+
+    def reserve(self, host: str, method: str | None = None) -> tuple[float, int | None, int | None]:
+        # Records the request if every bucket has room, otherwise returns how long to wait
+        with self._lock, self._lock_windows(host, method) as windows:
+            moment = self._clock()
+            wait_for, period, limit = self._get_wait_time(windows, moment)
+            if wait_for <= 0:
+                for window in windows:
+                    window.record(moment)
+                self._request_count_by_host[host] = self._request_count_by_host.get(host, 0) + 1
+            return wait_for, period, limit
+
+    def get_wait_time(self, host: str, method: str | None = None) -> float:
+        with self._lock, self._lock_windows(host, method) as windows:
+            moment = self._clock()
+            wait_for, _, _ = self._get_wait_time(windows, moment)
+            return max(0.0, wait_for)
+
+    def update(self, host: str, method: str | None, headers):
+        with self._lock, self._lock_windows(host, method) as windows:
+            moment = self._clock()
+            app_windows, *method_windows = windows
+            self._update_windows(
+                app_windows,
+                headers.get(RateLimiter.HEADER_APP_LIMIT),
+                headers.get(RateLimiter.HEADER_APP_COUNT),
+                moment,
+            )
+            for windows in method_windows:
+                self._update_windows(
+                    windows,
+                    headers.get(RateLimiter.HEADER_METHOD_LIMIT),
+                    headers.get(RateLimiter.HEADER_METHOD_COUNT),
+                    moment,
+                )
+
+    def block(self, host: str, method: str | None, headers, retry_after: float):
+        # A 429 names the bucket that overflowed. Blocking that bucket makes every caller sharing
+        # it back off, not only the one that got the 429. Service limits are not ours to track
+        limit_type = headers.get(RateLimiter.HEADER_LIMIT_TYPE)
+        if limit_type == "application":
+            key = (host, None)
+        elif limit_type == "method" and method is not None:
+            key = (host, method)
+        else:
+            return
+        with self._lock, self._lock_windows(*key) as windows:
+            windows[-1].block(self._clock() + retry_after)
+
+    def get_hosts(self) -> list[str]:
+        with self._lock:
+            return list(self._request_count_by_host)
+
+    def get_request_count(self, host: str | None = None) -> int:
+        with self._lock:
+            if host is None:
+                return sum(self._request_count_by_host.values())
+            return self._request_count_by_host.get(host, 0)
+
+    def get_allowed_requests_per_second(self, host: str) -> float | None:
+        # Limits are refreshed from every response, so the cached value is accurate enough here
+        with self._lock:
+            windows = self._windows_by_key.get((host, None))
+            if windows is None:
+                return None
+            return windows.get_allowed_requests_per_second()
+
+    def _get_wait_time(
+        self, windows: list[RateLimitWindows], moment: float
+    ) -> tuple[float, int | None, int | None]:
+        maximum_wait_for, maximum_period, maximum_limit = 0.0, None, None
+        for window in windows:
+            wait_for, period, limit = window.get_wait_time(moment)
+            if wait_for > maximum_wait_for:
+                maximum_wait_for, maximum_period, maximum_limit = wait_for, period, limit
+        return maximum_wait_for, maximum_period, maximum_limit
+
+    @contextmanager
+    def _lock_windows(self, host: str, method: str | None):
+        # Windows are always locked app bucket first, so processes cannot deadlock on each other
+        keys = [(host, None)] if method is None else [(host, None), (host, method)]
+        windows = [self._get_windows(key) for key in keys]
+        with ExitStack() as stack:
+            for window in windows:
+                stack.enter_context(window.lock())
+            yield windows
+
+    def _get_windows(self, key: tuple[str, str | None]) -> RateLimitWindows:
+        if key not in self._windows_by_key:
+            if self._shared_directory is None:
+                self._windows_by_key[key] = RateLimitWindows()
+            else:
+                host, method = key
+                path = os.path.join(self._shared_directory, f"{host}.{method or 'app'}")
+                self._windows_by_key[key] = SharedRateLimitWindows(path)
+        return self._windows_by_key[key]
+
+    def _update_windows(
+        self,
+        windows: RateLimitWindows,
+        limit_header: str | None,
+        count_header: str | None,
+        moment: float,
+    ):
+        windows.is_known = True
+        if limit_header is not None:
+            windows.update_limits(parse_rate_limit_header(limit_header))
+        if count_header is not None:
+            windows.reconcile(parse_rate_limit_header(count_header), moment)
@@ -0,0 +1,250 @@
+import sys
+from array import array
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+
+from src.client import Division, Tier
+from src.player import Player
+
+TIERS = list(Tier)
+DIVISIONS = list(Division)
+TIER_CODE_BY_TIER = {tier: code for code, tier in enumerate(TIERS)}
+DIVISION_CODE_BY_DIVISION = {division: code for code, division in enumerate(DIVISIONS)}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+MISSING = -1
+
+
+def encode_time(moment: datetime | None) -> int:
+    if moment is None:
+        return MISSING
+    return (moment - EPOCH) // MICROSECOND
+
+
+def decode_time(microseconds: int) -> datetime | None:
+    if microseconds == MISSING:
+        return None
+    return EPOCH + microseconds * MICROSECOND
+
+
+class PlayerRegistry:
+    def __init__(self, players: Iterable[Player] = ()):
+        # Players are stored as rows of typed arrays, with tiers and divisions coded as their
+        # position in the enum and times as microseconds since the epoch, so that a player costs
+        # a few dozen bytes besides its puuid instead of a dataclass with its own datetimes.
+        # Players are materialized when they are read, and written back with put
+        self._index_by_puuid: dict[str, int] = {}
+        self._puuids: list[str] = []
+        self._tier_codes = array("b")
+        self._division_codes = array("b")
+        self._last_league_crawl_times = array("q")
+        self._last_match_crawl_times = array("q")
+        self._last_match_counts = array("h")
+        self._match_rates = array("f")
+        self._observed_match_counts = array("h")
+        self._last_seen_times = array("q")
+        for player in players:
+            self.put(player)
+
+    def __len__(self) -> int:
+        return len(self._puuids)
+
+    def __contains__(self, puuid: str) -> bool:
+        return puuid in self._index_by_puuid
+
+    def get(self, puuid: str) -> Player | None:
+        index = self._index_by_puuid.get(puuid)
+        if index is None:
+            return None
+        return self._get_player(index)
+
+    def put(self, player: Player):
+        last_match_count = MISSING if player.last_match_count is None else player.last_match_count
+        row = (
+            TIER_CODE_BY_TIER[player.tier],
+            DIVISION_CODE_BY_DIVISION[player.division],
+            encode_time(player.last_league_crawl_time),
+            encode_time(player.last_match_crawl_time),
+            last_match_count,
+            MISSING if player.match_rate is None else player.match_rate,
+            player.observed_match_count,
+            encode_time(player.last_seen_time),
+        )
+        index = self._index_by_puuid.get(player.puuid)
+        if index is None:
+            self._append(player.puuid, *row)
+            return
+        self._set(index, *row)
+
+    def update_from_league_entry(self, league_entry: dict, moment: datetime) -> bool:
+        # Returns whether the player was not tracked before
+        return self._update_from_league_entry(league_entry, encode_time(moment))
+
+    def update_from_league_entries(
+        self, league_entries: Iterable[dict], moment: datetime
+    ) -> list[str]:
+        # Returns the puuids of the players that were not tracked before
+        last_league_crawl_time = encode_time(moment)
+        return [
+            league_entry["puuid"]
+            for league_entry in league_entries
+            if self._update_from_league_entry(league_entry, last_league_crawl_time)
+        ]
+
+    def remove_players_before(self, moment: datetime) -> int:
+        # Drops the players whose league entry was last seen before the moment, compacting the
+        # arrays in one pass
+        cutoff = encode_time(moment)
+        kept_indices = [
+            index
+            for index, last_league_crawl_time in enumerate(self._last_league_crawl_times)
+            if last_league_crawl_time >= cutoff
+        ]
+        removed_player_count = len(self) - len(kept_indices)
+        if removed_player_count == 0:
+            return 0
+        self._puuids = [self._puuids[index] for index in kept_indices]
+        self._index_by_puuid = {puuid: index for index, puuid in enumerate(self._puuids)}
+        for name in (
+            "_tier_codes",
+            "_division_codes",
+            "_last_league_crawl_times",
+            "_last_match_crawl_times",
+            "_last_match_counts",
+            "_match_rates",
+            "_observed_match_counts",
+            "_last_seen_times",
+        ):
+            column = getattr(self, name)
+            # An empty slice keeps the typecode of the column
+            kept_column = column[:0]
+            kept_column.extend(column[index] for index in kept_indices)
+            setattr(self, name, kept_column)
+        return removed_player_count
+
+    def iterate_players_by_league(self) -> Iterator[Player]:
+        for index in self._get_indices_by_league():
+            yield self._get_player(index)
+
+    def iterate_match_crawls_by_league(
+        self,
+    ) -> Iterator[tuple[str, datetime | None, int | None, float | None, int, datetime | None]]:
+        # Only what the scheduler orders players by, without materializing the players
+        for index in self._get_indices_by_league():
+            last_match_count = self._last_match_counts[index]
+            match_rate = self._match_rates[index]
+            yield (
+                self._puuids[index],
+                decode_time(self._last_match_crawl_times[index]),
+                None if last_match_count == MISSING else last_match_count,
+                None if match_rate == MISSING else match_rate,
+                self._observed_match_counts[index],
+                decode_time(self._last_seen_times[index]),
+            )
+
+    def get_byte_count(self) -> int:
+        byte_count = sys.getsizeof(self._index_by_puuid) + sys.getsizeof(self._puuids)
+        byte_count += sum(sys.getsizeof(puuid) for puuid in self._puuids)
+        for column in (
+            self._tier_codes,
+            self._division_codes,
+            self._last_league_crawl_times,
+            self._last_match_crawl_times,
+            self._last_match_counts,
+            self._match_rates,
+            self._observed_match_counts,
+            self._last_seen_times,
+        ):
+            byte_count += sys.getsizeof(column)
+        return byte_count
+
+    def _update_from_league_entry(self, league_entry: dict, last_league_crawl_time: int) -> bool:
+        puuid = league_entry["puuid"]
+        tier_code = TIER_CODE_BY_TIER[Tier[league_entry["tier"]]]
+        division_code = DIVISION_CODE_BY_DIVISION[Division[league_entry["rank"]]]
+        index = self._index_by_puuid.get(puuid)
+        if index is None:
+            self._append(
+                puuid,
+                tier_code,
+                division_code,
+                last_league_crawl_time,
+                MISSING,
+                MISSING,
+                MISSING,
+                0,
+                MISSING,
+            )
+            return True
+        self._tier_codes[index] = tier_code
+        self._division_codes[index] = division_code
+        self._last_league_crawl_times[index] = last_league_crawl_time
+        return False
+
+    def _get_indices_by_league(self) -> list[int]:
+        # Highest tier and division first, sorting the integer codes instead of the players
+        return sorted(
+            range(len(self)),
+            key=lambda index: (self._tier_codes[index], self._division_codes[index]),
+        )
+
+    def _get_player(self, index: int) -> Player:
+        last_match_count = self._last_match_counts[index]
+        match_rate = self._match_rates[index]
+        # Players only enter the registry from league entries, so this time is never missing
+        last_league_crawl_time = EPOCH + self._last_league_crawl_times[index] * MICROSECOND
+        return Player(
+            puuid=self._puuids[index],
+            tier=TIERS[self._tier_codes[index]],
+            division=DIVISIONS[self._division_codes[index]],
+            last_league_crawl_time=last_league_crawl_time,
+            last_match_crawl_time=decode_time(self._last_match_crawl_times[index]),
+            last_match_count=None if last_match_count == MISSING else last_match_count,
+            match_rate=None if match_rate == MISSING else match_rate,
+            observed_match_count=self._observed_match_counts[index],
+            last_seen_time=decode_time(self._last_seen_times[index]),
+        )
+
+    def _append(
+        self,
+        puuid: str,
+        tier_code: int,
+        division_code: int,
+        last_league_crawl_time: int,
+        last_match_crawl_time: int,
+        last_match_count: int,
+        match_rate: float,
+        observed_match_count: int,
+        last_seen_time: int,
+    ):
+        self._index_by_puuid[puuid] = len(self._puuids)
+        self._puuids.append(puuid)
+        self._tier_codes.append(tier_code)
+        self._division_codes.append(division_code)
+        self._last_league_crawl_times.append(last_league_crawl_time)
+        self._last_match_crawl_times.append(last_match_crawl_time)
+        self._last_match_counts.append(last_match_count)
+        self._match_rates.append(match_rate)
+        self._observed_match_counts.append(observed_match_count)
+        self._last_seen_times.append(last_seen_time)
+
+    def _set(
+        self,
+        index: int,
+        tier_code: int,
+        division_code: int,
+        last_league_crawl_time: int,
+        last_match_crawl_time: int,
+        last_match_count: int,
+        match_rate: float,
+        observed_match_count: int,
+        last_seen_time: int,
+    ):
+        self._tier_codes[index] = tier_code
+        self._division_codes[index] = division_code
+        self._last_league_crawl_times[index] = last_league_crawl_time
+        self._last_match_crawl_times[index] = last_match_crawl_time
+        self._last_match_counts[index] = last_match_count
+        self._match_rates[index] = match_rate
+        self._observed_match_counts[index] = observed_match_count
+        self._last_seen_times[index] = last_seen_time
@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+import structlog
+
+logger = structlog.get_logger()
+
+# Bad request, unauthorized, forbidden, not found, method not allowed and unsupported media type
+# will not succeed by trying again and every attempt still costs rate-limit quota
+NON_RETRYABLE_STATUS_CODES = {400, 401, 403, 404, 405, 415}
+TOO_MANY_REQUESTS_STATUS_CODE = 429
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+def is_retryable_status_code(status_code: int) -> bool:
+    return status_code not in NON_RETRYABLE_STATUS_CODES
+
+
+def is_server_error_status_code(status_code: int) -> bool:
+    return 500 <= status_code < 600
+
+
+def get_backoff(attempt: int) -> float:
+    # Full jitter keeps clients that failed together from retrying together
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def get_retry_after(retry_after_header: str | None, attempt: int) -> float:
+    if retry_after_header is None:
+        return get_backoff(attempt)
+    return max(0.0, float(retry_after_header))
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"Circuit for {host} is open. Retry after {retry_after:.1f} seconds")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30.0
+
+    def __init__(
+        self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT
+    ):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failure_count_by_host: dict[str, int] = {}
+        self._opened_at_by_host: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def check(self, host: str):
+        # An open circuit fails fast until the reset timeout passes. Then requests are let through
+        # again (half-open) and the first success closes it or the next failure re-opens it
+        with self._lock:
+            opened_at = self._opened_at_by_host.get(host)
+            if opened_at is None:
+                return
+            retry_after = opened_at + self._reset_timeout - time.monotonic()
+            if retry_after > 0:
+                raise CircuitOpenError(host, retry_after)
+
+    def get_retry_after(self, host: str) -> float:
+        with self._lock:
+            opened_at = self._opened_at_by_host.get(host)
+            if opened_at is None:
+                return 0.0
+            return max(0.0, opened_at + self._reset_timeout - time.monotonic())
+
+    def record_success(self, host: str):
+        with self._lock:
+            if host in self._opened_at_by_host:
+                logger.info("Closing circuit", host=host)
+            self._failure_count_by_host.pop(host, None)
+            self._opened_at_by_host.pop(host, None)
+
+    def record_failure(self, host: str):
+        with self._lock:
+            failure_count = self._failure_count_by_host.get(host, 0) + 1
+            self._failure_count_by_host[host] = failure_count
+            if failure_count >= self._failure_threshold:
+                logger.warning(
+                    "Opening circuit",
+                    host=host,
+                    failure_count=failure_count,
+                    reset_timeout=self._reset_timeout,
+                )
+                self._opened_at_by_host[host] = time.monotonic()
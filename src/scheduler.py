@@ -0,0 +1,231 @@
+import heapq
+from bisect import insort
+from collections import deque
+from datetime import datetime, timedelta
+from enum import Enum
+
+from src.estimator import MatchCountEstimator
+from src.player import (
+    MATCH_COUNT_MAXIMUM,
+    MATCH_TIME_WINDOW,
+    Player,
+    get_effective_match_crawl_time,
+)
+from src.registry import PlayerRegistry
+from src.util import now
+
+
+class ScheduleReason(Enum):
+    NEVER_CRAWLED = "never_crawled"
+    STALE = "stale"
+    MANY_NEW_MATCHES = "many_new_matches"
+    MOST_NEW_MATCHES = "most_new_matches"
+
+
+class PlayerScheduler:
+    # Matches older than the match time window can no longer be fetched, so a player is crawled
+    # before then even if others probably have more new matches
+    STALE_PERIOD = MATCH_TIME_WINDOW / 2
+    # Only tells apart players that probably have more new matches than a crawl is meant to get
+    MANY_NEW_MATCH_COUNT = MATCH_COUNT_MAXIMUM / 2
+
+    def __init__(
+        self,
+        player_registry: PlayerRegistry | None = None,
+        match_count_estimator: MatchCountEstimator | None = None,
+        stale_period: timedelta = STALE_PERIOD,
+        many_new_match_count: float = MANY_NEW_MATCH_COUNT,
+    ):
+        # Players are read from the registry when they are picked and written back to it when
+        # they are scheduled again, so the queues only hold what orders them
+        self._player_registry = player_registry if player_registry is not None else PlayerRegistry()
+        self._match_count_estimator = (
+            match_count_estimator if match_count_estimator is not None else MatchCountEstimator()
+        )
+        self._stale_period = stale_period
+        self._many_new_match_count = many_new_match_count
+        # Every (re)schedule bumps the player's version. Queue entries with an older version, or
+        # for a removed player, are dropped when they reach the head instead of being searched for
+        self._version_by_puuid: dict[str, int] = {}
+        self._never_crawled_queue: deque[tuple[str, int]] = deque()
+        # The estimated new match count grows with the time since the last crawl, at a rate the
+        # estimator sets per player and scales the same way for everyone. Among players with the
+        # same rate, the one crawled the longest ago is both the most due and the one with the
+        # highest estimate, so each rate, rounded to a match, gets a queue ordered by crawl time.
+        # Picking a player then only compares the queue heads, one per distinct rate, instead of
+        # every player
+        self._queue_by_match_rate: dict[int, deque[tuple[datetime, str, int]]] = {}
+        # The queues are ordered by the crawl time moved forward by the matches held through other
+        # players, so staleness, which is about the matches that expire, is checked on a heap of
+        # the actual crawl times
+        self._stale_heap: list[tuple[datetime, str, int]] = []
+        match_crawls = []
+        for (
+            puuid,
+            last_match_crawl_time,
+            last_match_count,
+            match_rate,
+            observed_match_count,
+            last_seen_time,
+        ) in self._player_registry.iterate_match_crawls_by_league():
+            match_crawl = self._get_match_crawl(
+                puuid,
+                last_match_crawl_time,
+                last_match_count,
+                match_rate,
+                observed_match_count,
+                last_seen_time,
+            )
+            if last_match_crawl_time is None:
+                self._enqueue(*match_crawl, last_match_crawl_time)
+            else:
+                match_crawls.append((*match_crawl, last_match_crawl_time))
+        match_crawls.sort(key=lambda match_crawl: match_crawl[1])
+        for match_crawl in match_crawls:
+            self._enqueue(*match_crawl)
+
+    def __len__(self) -> int:
+        return len(self._version_by_puuid)
+
+    def schedule(self, player: Player):
+        self._player_registry.put(player)
+        self._enqueue(
+            *self._get_match_crawl(
+                player.puuid,
+                player.last_match_crawl_time,
+                player.last_match_count,
+                player.match_rate,
+                player.observed_match_count,
+                player.last_seen_time,
+            ),
+            player.last_match_crawl_time,
+        )
+
+    def observe_match(self, puuid: str, ended_at: datetime) -> bool:
+        # A scheduled player's match fetched through another player lowers its estimate, which
+        # moves it back in its queue
+        if puuid not in self._version_by_puuid:
+            return False
+        player = self._player_registry.get(puuid)
+        if player is None:
+            return False
+        is_new_to_player = player.observe_match(ended_at)
+        if is_new_to_player:
+            self.schedule(player)
+        else:
+            self._player_registry.put(player)
+        return is_new_to_player
+
+    def observe_match_activity(self, ended_at: datetime):
+        self._match_count_estimator.observe_match(ended_at)
+
+    def estimate_new_match_count(self, player: Player, moment: datetime | None = None) -> float:
+        _, last_match_crawl_time, match_rate = self._get_match_crawl(
+            player.puuid,
+            player.last_match_crawl_time,
+            player.last_match_count,
+            player.match_rate,
+            player.observed_match_count,
+            player.last_seen_time,
+        )
+        if last_match_crawl_time is None:
+            return float("inf")
+        return self._match_count_estimator.estimate_new_match_count(
+            match_rate, last_match_crawl_time, moment or now()
+        )
+
+    def remove(self, puuid: str):
+        self._version_by_puuid.pop(puuid, None)
+
+    def pop_next_player(
+        self, moment: datetime | None = None
+    ) -> tuple[Player, ScheduleReason] | None:
+        # The player is taken out of the schedule and has to be scheduled again once crawled
+        moment = moment or now()
+        while len(self._never_crawled_queue) > 0:
+            puuid, version = self._never_crawled_queue.popleft()
+            if self._is_valid(puuid, version):
+                return self._pop(puuid), ScheduleReason.NEVER_CRAWLED
+
+        while len(self._stale_heap) > 0 and not self._is_valid(*self._stale_heap[0][1:]):
+            heapq.heappop(self._stale_heap)
+        if len(self._stale_heap) > 0 and moment - self._stale_heap[0][0] >= self._stale_period:
+            _, puuid, _ = heapq.heappop(self._stale_heap)
+            return self._pop(puuid), ScheduleReason.STALE
+
+        # Every crawl costs a request for the match ids plus one per new match, so the player
+        # with the most expected new matches also gets the most new matches per request.
+        # Crawl times are moved forward by the matches held through other players, so estimates
+        # may be negative until those matches are made up for
+        best_match_rate, best_estimated_new_match_count = None, float("-inf")
+        for match_rate in sorted(self._queue_by_match_rate, reverse=True):
+            queue = self._queue_by_match_rate[match_rate]
+            while len(queue) > 0 and not self._is_valid(queue[0][1], queue[0][2]):
+                queue.popleft()
+            if len(queue) == 0:
+                del self._queue_by_match_rate[match_rate]
+                continue
+            crawl_time, _, _ = queue[0]
+            estimated_new_match_count = self._match_count_estimator.estimate_new_match_count(
+                match_rate, crawl_time, moment
+            )
+            if estimated_new_match_count > best_estimated_new_match_count:
+                best_match_rate = match_rate
+                best_estimated_new_match_count = estimated_new_match_count
+
+        if best_match_rate is None:
+            return None
+        if best_estimated_new_match_count >= self._many_new_match_count:
+            return self._pop_head(best_match_rate), ScheduleReason.MANY_NEW_MATCHES
+        return self._pop_head(best_match_rate), ScheduleReason.MOST_NEW_MATCHES
+
+    def _get_match_crawl(
+        self,
+        puuid: str,
+        last_match_crawl_time: datetime | None,
+        last_match_count: int | None,
+        match_rate: float | None,
+        observed_match_count: int,
+        last_seen_time: datetime | None,
+    ) -> tuple[str, datetime | None, int]:
+        match_rate = self._match_count_estimator.get_match_rate(last_match_count, match_rate)
+        if last_match_crawl_time is not None:
+            last_match_crawl_time = get_effective_match_crawl_time(
+                last_match_crawl_time, match_rate, observed_match_count, last_seen_time
+            )
+        return puuid, last_match_crawl_time, round(match_rate)
+
+    def _enqueue(
+        self,
+        puuid: str,
+        last_match_crawl_time: datetime | None,
+        match_rate: int,
+        actual_match_crawl_time: datetime | None,
+    ):
+        version = self._version_by_puuid.get(puuid, 0) + 1
+        self._version_by_puuid[puuid] = version
+        if last_match_crawl_time is None or actual_match_crawl_time is None:
+            self._never_crawled_queue.append((puuid, version))
+            return
+        heapq.heappush(self._stale_heap, (actual_match_crawl_time, puuid, version))
+        queue = self._queue_by_match_rate.setdefault(match_rate, deque())
+        entry = (last_match_crawl_time, puuid, version)
+        if len(queue) == 0 or queue[-1] <= entry:
+            queue.append(entry)
+        else:
+            insort(queue, entry)
+
+    def _is_valid(self, puuid: str, version: int) -> bool:
+        return self._version_by_puuid.get(puuid) == version
+
+    def _pop_head(self, match_rate: int) -> Player:
+        _, puuid, _ = self._queue_by_match_rate[match_rate].popleft()
+        return self._pop(puuid)
+
+    def _pop(self, puuid: str) -> Player:
+        # Bumping the version invalidates any other entry left for this player
+        self._version_by_puuid[puuid] += 1
+        # Removing players from the registry rebuilds the scheduler, so queued players are present
+        player = self._player_registry.get(puuid)
+        assert player is not None, f"Scheduled player {puuid} is not in the registry"
+        return player
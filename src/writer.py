@@ -0,0 +1,371 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from enum import Enum
+
+import structlog
+
+from src.client import RawMatch
+from src.database import DatabaseHandler, InvalidRowError
+from src.retry import get_backoff
+from src.util import now
+
+logger = structlog.get_logger()
+
+
+class RecordKind(Enum):
+    LEAGUES = "leagues"
+    MATCH = "match"
+    RAW_MATCH = "raw_match"
+    PLAYER_CRAWL = "player_crawl"
+    REGION_CRAWL = "region_crawl"
+
+
+class Spool:
+    SEGMENT_SUFFIX = ".jsonl"
+    DEAD_LETTER_NAME = "dead_letter"
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Records are appended as JSON lines to segments named by sequence number. Only closed
+        # segments are read, so the reader never sees a line that is still being written, and a
+        # segment is deleted once all of its records are applied. Segments left by a previous
+        # process are read first
+        self._sequences: deque[int] = deque(
+            sorted(
+                int(name.removesuffix(Spool.SEGMENT_SUFFIX))
+                for name in os.listdir(directory)
+                if name.endswith(Spool.SEGMENT_SUFFIX)
+                and name.removesuffix(Spool.SEGMENT_SUFFIX).isdigit()
+            )
+        )
+        self._unapplied_byte_count = sum(
+            os.path.getsize(self._get_path(sequence)) for sequence in self._sequences
+        )
+        if self._unapplied_byte_count > 0:
+            logger.info(
+                "Recovering spooled records",
+                directory=directory,
+                segment_count=len(self._sequences),
+                byte_count=self._unapplied_byte_count,
+            )
+        self._read_offset = 0
+        self._sequences.append(self._sequences[-1] + 1 if len(self._sequences) > 0 else 0)
+        self._file = open(self._get_path(self._sequences[-1]), "ab")
+
+    def get_unapplied_byte_count(self) -> int:
+        with self._lock:
+            return self._unapplied_byte_count
+
+    def append(self, record: dict, payload: bytes | None = None):
+        line = Spool._serialize(record, payload)
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unapplied_byte_count += len(line)
+
+    def read(self, maximum_record_count: int) -> tuple[list[dict], int]:
+        # Returns records from the oldest segment and the offset to commit once they are applied
+        while True:
+            with self._lock:
+                if len(self._sequences) == 1:
+                    if self._file.tell() == 0:
+                        return [], 0
+                    self._rotate()
+                sequence = self._sequences[0]
+                offset = self._read_offset
+            records, offset = self._read_segment(sequence, offset, maximum_record_count)
+            if len(records) > 0:
+                return records, offset
+            # Nothing left in this segment but lines that could not be parsed
+            self.commit(offset)
+
+    def commit(self, offset: int):
+        with self._lock:
+            path = self._get_path(self._sequences[0])
+            self._unapplied_byte_count -= offset - self._read_offset
+            if offset < os.path.getsize(path):
+                self._read_offset = offset
+                return
+            os.remove(path)
+            self._sequences.popleft()
+            self._read_offset = 0
+
+    def quarantine(self, record: dict, error: Exception):
+        # Records that can never be applied are set aside in the dead letter segment, in the same
+        # format as the others, so that they can be inspected and spooled again once fixed
+        record = dict(record)
+        payload = record.pop("payload", None) or None
+        record["error"] = repr(error)
+        line = Spool._serialize(record, payload)
+        with self._lock:
+            with open(self._get_path(Spool.DEAD_LETTER_NAME), "ab") as file:
+                file.write(line)
+
+    def close(self):
+        with self._lock:
+            is_empty = self._file.tell() == 0
+            self._file.close()
+            if is_empty:
+                os.remove(self._get_path(self._sequences[-1]))
+
+    def _read_segment(
+        self, sequence: int, offset: int, maximum_record_count: int
+    ) -> tuple[list[dict], int]:
+        records = []
+        with open(self._get_path(sequence), "rb") as file:
+            file.seek(offset)
+            while len(records) < maximum_record_count:
+                line = file.readline()
+                if len(line) == 0:
+                    break
+                offset += len(line)
+                # A crash can leave the last line of a segment partially written
+                if not line.endswith(b"\n"):
+                    logger.warning("Skipping partially written record", sequence=sequence)
+                    break
+                record, _, payload = line.removesuffix(b"\n").partition(b"\t")
+                try:
+                    record = json.loads(record)
+                    record["payload"] = payload
+                    records.append(record)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping malformed record", sequence=sequence)
+        return records, offset
+
+    def _rotate(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._sequences.append(self._sequences[-1] + 1)
+        self._file = open(self._get_path(self._sequences[-1]), "ab")
+
+    def _get_path(self, sequence: int | str) -> str:
+        name = f"{sequence:012d}" if isinstance(sequence, int) else sequence
+        return os.path.join(self._directory, f"{name}{Spool.SEGMENT_SUFFIX}")
+
+    @staticmethod
+    def _serialize(record: dict, payload: bytes | None) -> bytes:
+        # A payload that is already JSON follows the record after a tab, so it is neither parsed
+        # nor serialized again. Serialized records contain no tabs, and a newline in JSON can only
+        # be whitespace, so both separators stay unambiguous
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode()
+        if payload is not None:
+            line += b"\t" + payload.replace(b"\n", b" ")
+        return line + b"\n"
+
+
+class DatabaseWriter:
+    BATCH_SIZE = 100
+    BATCH_INTERVAL = 1.0
+    DRAIN_POLL_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        database_handler: DatabaseHandler,
+        spool_directory: str,
+        batch_size: int = BATCH_SIZE,
+        batch_interval: float = BATCH_INTERVAL,
+    ):
+        self._database_handler = database_handler
+        # Writes go to the spool and return right away. A background thread applies them to the
+        # database in batches, and only drops them from the spool once they are committed, so
+        # nothing crawled is lost while the database is slow or down, or when the crawler crashes
+        self._spool = Spool(spool_directory)
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._appended_record_count = 0
+        self._applied_record_count = 0
+        self._apply_lag = 0.0
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+        self._thread.start()
+
+    def write_leagues(self, leagues: list[dict], region: str):
+        self._append({"kind": RecordKind.LEAGUES.value, "region": region, "leagues": leagues})
+
+    def write_match(self, match_: dict):
+        self._append({"kind": RecordKind.MATCH.value, "match": match_})
+
+    def write_raw_match(self, raw_match: RawMatch):
+        self._append(
+            {
+                "kind": RecordKind.RAW_MATCH.value,
+                "match_id": raw_match.match_id,
+                "game_end_timestamp": raw_match.game_end_timestamp,
+                "platform_id": raw_match.platform_id,
+                "game_version": raw_match.game_version,
+                "queue_id": raw_match.queue_id,
+            },
+            payload=raw_match.content,
+        )
+
+    def write_player_crawl(self, puuid: str, region: str, crawled_at: datetime, match_count: int):
+        self._append(
+            {
+                "kind": RecordKind.PLAYER_CRAWL.value,
+                "puuid": puuid,
+                "region": region,
+                "crawled_at": crawled_at.isoformat(),
+                "match_count": match_count,
+            }
+        )
+
+    def write_region_crawl(self, region: str, league_crawled_at: datetime):
+        self._append(
+            {
+                "kind": RecordKind.REGION_CRAWL.value,
+                "region": region,
+                "league_crawled_at": league_crawled_at.isoformat(),
+            }
+        )
+
+    def get_unapplied_byte_count(self) -> int:
+        return self._spool.get_unapplied_byte_count()
+
+    def get_applied_record_count(self) -> int:
+        with self._lock:
+            return self._applied_record_count
+
+    def get_apply_lag(self) -> float:
+        # Seconds between spooling and committing the most recently applied record
+        with self._lock:
+            return self._apply_lag
+
+    def wait_until_drained(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.get_unapplied_byte_count() > 0:
+            if time.monotonic() >= deadline:
+                return False
+            self._wake_event.set()
+            time.sleep(DatabaseWriter.DRAIN_POLL_INTERVAL)
+        return True
+
+    def close(self, timeout: float | None = None):
+        # Applies what is left in the spool unless the database fails, in which case the records
+        # stay in the spool for the next start
+        self._stop_event.set()
+        self._wake_event.set()
+        self._thread.join(timeout)
+        self._spool.close()
+
+    def _append(self, record: dict, payload: bytes | None = None):
+        record["spooled_at"] = now().isoformat()
+        self._spool.append(record, payload)
+        with self._lock:
+            self._appended_record_count += 1
+            if self._appended_record_count < self._batch_size:
+                return
+            self._appended_record_count = 0
+        self._wake_event.set()
+
+    def _run(self):
+        while True:
+            stopping = self._stop_event.is_set()
+            records, offset = self._spool.read(self._batch_size)
+            if len(records) == 0:
+                if stopping:
+                    return
+                self._wake_event.wait(self._batch_interval)
+                self._wake_event.clear()
+                continue
+            if not self._apply_batch(records):
+                logger.warning("Failed to apply spooled records. Leaving them in the spool")
+                return
+            self._spool.commit(offset)
+            with self._lock:
+                self._applied_record_count += len(records)
+                self._apply_lag = (
+                    now() - datetime.fromisoformat(records[-1]["spooled_at"])
+                ).total_seconds()
+
+    def _apply_batch(self, records: list[dict]) -> bool:
+        # Returns False if the writer stopped before the records were applied. Records that can
+        # never be applied are quarantined, so that they do not hold up the ones spooled after
+        applied_records = [record for record in records if self._apply(record)]
+        try:
+            return self._flush()
+        except InvalidRowError:
+            pass
+        # Some rows of the batch are invalid, so its records are applied again one at a time to
+        # find their records
+        self._database_handler.discard()
+        for record in applied_records:
+            if not self._apply(record):
+                continue
+            try:
+                if not self._flush():
+                    return False
+            except InvalidRowError as e:
+                self._database_handler.discard()
+                self._quarantine(record, e)
+        return True
+
+    def _flush(self) -> bool:
+        # Retries until the rows are stored, or returns False if the writer stops first. Raises
+        # InvalidRowError, which retrying would not fix
+        attempt = 0
+        while not self._database_handler.flush():
+            if self._stop_event.is_set():
+                return False
+            retry_after = get_backoff(attempt)
+            logger.warning(
+                f"Failed to apply spooled records. Retrying after {retry_after:.2f} seconds",
+                unapplied_byte_count=self.get_unapplied_byte_count(),
+            )
+            self._stop_event.wait(retry_after)
+            attempt += 1
+        return True
+
+    def _apply(self, record: dict) -> bool:
+        # Returns False if the record was quarantined because it is malformed
+        try:
+            self._apply_record(record)
+        except Exception as e:
+            self._quarantine(record, e)
+            return False
+        return True
+
+    def _quarantine(self, record: dict, error: Exception):
+        logger.exception(
+            "Failed to apply spooled record. Moving it to the dead letter segment",
+            kind=record.get("kind"),
+        )
+        self._spool.quarantine(record, error)
+
+    def _apply_record(self, record: dict):
+        kind = RecordKind(record["kind"])
+        spooled_at = datetime.fromisoformat(record["spooled_at"])
+        if kind == RecordKind.LEAGUES:
+            self._database_handler.write_leagues(
+                record["leagues"], record["region"], crawled_at=spooled_at
+            )
+        elif kind == RecordKind.MATCH:
+            self._database_handler.write_match(record["match"], crawled_at=spooled_at)
+        elif kind == RecordKind.RAW_MATCH:
+            raw_match = RawMatch(
+                content=record["payload"],
+                match_id=record["match_id"],
+                game_end_timestamp=record["game_end_timestamp"],
+                platform_id=record["platform_id"],
+                game_version=record["game_version"],
+                queue_id=record["queue_id"],
+            )
+            self._database_handler.write_raw_match(raw_match, crawled_at=spooled_at)
+        elif kind == RecordKind.PLAYER_CRAWL:
+            self._database_handler.write_player_crawl(
+                record["puuid"],
+                record["region"],
+                datetime.fromisoformat(record["crawled_at"]),
+                record["match_count"],
+            )
+        elif kind == RecordKind.REGION_CRAWL:
+            self._database_handler.write_region_crawl(
+                record["region"], datetime.fromisoformat(record["league_crawled_at"])
+            )